@@ -1,9 +1,13 @@
+import atexit
 import logging
+import time
 import unittest
 
 import datetime
-import pymysql.cursors
+from threading import Event, Lock, Thread
+from timeit import default_timer
 
+from dbpool import pooled_connection
 from scannerutil import auth_service, device_id
 
 log = logging.getLogger(__name__)
@@ -29,13 +33,11 @@ MOnocle data:
 def set_account_db_args(new_args):
     global args
     args = new_args
+    account_states.interval = args.db_flush_interval
 
 
 def __account_db_connection():
-    return pymysql.connect(user=args.db_user, password=args.db_pass, database=args.db_name, host=args.db_host,
-                           port=args.db_port,
-                           charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
+    return pooled_connection(args)
 
 
 def db_load_reallocatable(system_id, ban_time, warn_time, ok_if_blinded_before, now):
@@ -73,38 +75,38 @@ def db_find_allocatable_by_level(temp_ban_time, perm_ban_time, warn_time, blind_
 
 
 def db_consume_lures(account):
-    do_update('UPDATE account SET lures=0 WHERE username=%s', account)
+    account_states.set(account, lures=0)
 
 
 def db_set_blinded(account, when):
-    do_update('UPDATE account SET blinded=%s WHERE username=%s', (when, account))
+    account_states.set(account, blinded=when)
 
 
 
 def db_set_rest_time(account, when):
-    do_update('UPDATE account SET rest_until=%s WHERE username=%s', (when, account))
+    account_states.set(account, rest_until=when)
 
 
 def db_set_account_level(account, level):
-    do_update('UPDATE account SET level=%s WHERE username=%s', (level, account))
+    account_states.set(account, level=level)
 
 
 def db_set_egg_count(account, egg_count):
-    do_update('UPDATE account SET eggs=%s WHERE username=%s', (egg_count, account))
+    account_states.set(account, eggs=egg_count)
 
 
 def db_set_lure_count(account, lure_count):
-    do_update('UPDATE account SET lures=%s WHERE username=%s', (lure_count, account))
+    account_states.set(account, lures=lure_count)
 
 def db_set_logged_in_stats(account, lure_count,egg_count,level):
-    do_update('UPDATE account SET lures=%s,level=%s,eggs=%s WHERE username=%s', (lure_count, level, egg_count, account))
+    account_states.set(account, lures=lure_count, level=level, eggs=egg_count)
 
 def db_set_temp_banned(username, when):
-    do_update('UPDATE account SET temp_banned=%s WHERE username=%s', (when, username))
+    account_states.set(username, temp_banned=when)
 
 
 def db_set_behaviour(account, behaviour):
-    do_update('UPDATE account SET behaviour=%s WHERE username=%s', (behaviour, account))
+    account_states.set(account, behaviour=behaviour)
 
 
 def db_load_accounts(system_id):
@@ -123,24 +125,20 @@ def db_load_reallocated_accounts(system_id, from_time, to_time):
 
 
 def db_set_allocated_time(username, allocated):
-    do_update('UPDATE account SET allocated=%s WHERE username=%s', (allocated, username))
+    account_states.set(username, allocated=allocated)
 
 
 def db_update_account(account_info):
-    sql = 'UPDATE account SET temp_banned=%s,blinded=%s,rest_until=%s WHERE username=%s'
-    params = (account_info.banned, account_info.blinded, account_info.rest_until,
-              account_info.username)
-    do_update(sql, params)
+    account_states.set(account_info.username, temp_banned=account_info.banned, blinded=account_info.blinded,
+                       rest_until=account_info.rest_until)
 
 
 def db_set_warned(account_info, when):
-    params = (when, account_info.username)
-    do_update('UPDATE account SET warned=%s WHERE username=%s', params)
+    account_states.set(account_info.username, warned=when)
 
 
 def db_set_perm_banned(account_info, when):
-    params = (when, account_info.username)
-    do_update('UPDATE account SET perm_banned=%s WHERE username=%s', params)
+    account_states.set(account_info.username, perm_banned=when)
 
 
 def db_roll_allocated_date_forward(account_info):
@@ -219,16 +217,48 @@ def update_allocation_end(username, allocation_end):
     do_update("update account set allocation_end=%s where username=%s", (allocation_end, username))
 
 
+INSERT_ACCOUNT_SQL = "insert into account(username,password,provider,model,ios,device_id,system_id,allocated," \
+                     "allocation_end,level) values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+
+
+def insert_account_params(account, system_id, allocated, allocation_end):
+    return (account["username"], account["password"], auth_service(account), account.get("model"), account.get("iOS"),
+            device_id(account), system_id, allocated, allocation_end, account.get("level"))
+
+
 def insert_account(account, system_id, allocated, allocation_end):
-    sql = "insert into account(username,password,provider,model,ios,device_id,system_id,allocated,allocation_end) values (%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-    params = (account["username"], account["password"], auth_service(account), account.get("model"), account.get("iOS"),
-              device_id(account), system_id, allocated, allocation_end)
-    do_update(sql, params)
-    if "level" in account:
-        update_account_level(account["username"], account["level"])
+    do_update(INSERT_ACCOUNT_SQL, insert_account_params(account, system_id, allocated, allocation_end))
+
+
+def load_existing_accounts(usernames):
+    """The rows of the usernames that are in the account table, by lower case username like MySQL compares them"""
+    if not usernames:
+        return {}
+    sql = "SELECT username,system_id,iOS,model,device_id,`level`,allocated,allocation_end FROM account " \
+          "WHERE username IN ({})".format(",".join(["%s"] * len(usernames)))
+    return dict((row["username"].lower(), row) for row in do_fetch_all(sql, list(usernames)))
+
+
+def write_imported_accounts(new_accounts, system_id, allocated, allocation_end, changes):
+    """Inserts new_accounts and sets the changed columns of the existing accounts, {username: {column: value}},
+    in one transaction"""
+    account_states.flush()
+    connection = __account_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            if new_accounts:
+                cursor.executemany(INSERT_ACCOUNT_SQL, [insert_account_params(account, system_id, allocated,
+                                                                              allocation_end)
+                                                        for account in new_accounts])
+            for sql, params in account_states_sql(changes):
+                cursor.execute(sql, params)
+        connection.commit()
+    finally:
+        connection.close()
 
 
 def upsert_account(username, password, provider, system_id):
+    account_states.flush()
     connection = __account_db_connection()
 
     try:
@@ -249,6 +279,7 @@ def upsert_account(username, password, provider, system_id):
 
 
 def do_update(sql, params):
+    account_states.flush()
     connection = __account_db_connection()
     try:
         with connection.cursor() as cursor:
@@ -259,6 +290,7 @@ def do_update(sql, params):
 
 
 def do_fetch_one(sql, params):
+    account_states.flush()
     connection = __account_db_connection()
     try:
         with connection.cursor() as cursor:
@@ -269,6 +301,7 @@ def do_fetch_one(sql, params):
 
 
 def do_fetch_all(sql, params):
+    account_states.flush()
     connection = __account_db_connection()
     try:
         with connection.cursor() as cursor:
@@ -278,6 +311,130 @@ def do_fetch_all(sql, params):
         connection.close()
 
 
+# Returns the statements that write the changed columns of the accounts, for
+# up to 500 accounts each. Each column is set to its new value for the
+# accounts that changed it, and kept for the others.
+def account_states_sql(states, per_statement=500):
+    usernames = list(states)
+    for start in range(0, len(usernames), per_statement):
+        chunk = usernames[start:start + per_statement]
+        columns = sorted(set(column for username in chunk for column in states[username]))
+        assignments = []
+        params = []
+        for column in columns:
+            changed = [username for username in chunk if column in states[username]]
+            assignments.append("`{0}`=CASE username{1} ELSE `{0}` END".format(
+                column, " WHEN %s THEN %s" * len(changed)))
+            for username in changed:
+                params += [username, states[username][column]]
+        sql = "UPDATE account SET {} WHERE username IN ({})".format(
+            ",".join(assignments), ",".join(["%s"] * len(chunk)))
+        yield sql, params + chunk
+
+
+def write_account_states(states):
+    connection = __account_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            for sql, params in account_states_sql(states):
+                cursor.execute(sql, params)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class AccountStateStore(object):
+    '''
+    Account state changes, kept in memory and written to the account table
+    every interval, so setting them never waits for the database. The
+    changes to an account are merged, the last value of each column wins,
+    and all the changed accounts are written at once. Reads and other
+    writes of the account table write the pending changes first, so they
+    see them. A crash loses the changes of the last interval at most.
+    '''
+
+    def __init__(self, interval=1.0, write=write_account_states):
+        self.interval = interval
+        self.write = write
+        self.lock = Lock()
+        # Flushes are written one at a time, so an older flush can never
+        # overwrite a newer one.
+        self.flush_lock = Lock()
+        self.pending = {}
+        self.thread = None
+
+        self.updates = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.accounts_flushed = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def set(self, username, **columns):
+        with self.lock:
+            self.pending.setdefault(username, {}).update(columns)
+            self.updates += 1
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="Account states")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Unable to write account states, retrying in {} seconds: {}".format(self.interval, e))
+
+    def flush(self):
+        # Taken even with nothing pending, a flush being written isn't
+        # pending anymore, but readers still have to wait for it.
+        with self.flush_lock:
+            with self.lock:
+                states, self.pending = self.pending, {}
+            if not states:
+                return
+            start = default_timer()
+            try:
+                self.write(states)
+            except Exception:
+                # Put them back under the changes made since.
+                with self.lock:
+                    for username, columns in states.items():
+                        columns.update(self.pending.get(username, {}))
+                        self.pending[username] = columns
+                    self.failed_flushes += 1
+                raise
+            latency = default_timer() - start
+
+            with self.lock:
+                self.flushes += 1
+                self.accounts_flushed += len(states)
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(latency, self.max_flush_latency)
+
+    def pending_accounts(self):
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'updates': self.updates,
+                'pending_accounts': len(self.pending),
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'accounts_flushed': self.accounts_flushed,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency
+            }
+
+
+account_states = AccountStateStore()
+atexit.register(account_states.flush)
+
+
 '''
  parser = argparse.ArgumentParser(...)
     parser.add_argument...
@@ -319,6 +476,97 @@ class TestDatabase(object):
     db_user = "root"
     db_pass = None
     db_port = None
+    db_pool_size = 1
+    db_pool_timeout = 30.0
+    db_flush_interval = 1.0
+
+
+class FakeAccountTable(object):
+    def __init__(self, failures=0):
+        self.rows = {}
+        self.writes = []
+        self.failures = failures
+
+    def write(self, states):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Database is down")
+        self.writes.append(states)
+        for username, columns in states.items():
+            self.rows.setdefault(username, {}).update(columns)
+
+
+class TestAccountStateStore(unittest.TestCase):
+    def test_merges_changes(self):
+        table = FakeAccountTable()
+        store = AccountStateStore(60, table.write)
+        store.set("tu0", lures=3, level=5)
+        store.set("tu1", blinded=None)
+        store.set("tu0", lures=2)
+        store.flush()
+        store.flush()
+        self.assertEqual([{"tu0": {"lures": 2, "level": 5}, "tu1": {"blinded": None}}], table.writes)
+
+    def test_statements(self):
+        states = {"tu0": {"lures": 2, "level": 5}}
+        sql, params = next(account_states_sql(states))
+        self.assertEqual("UPDATE account SET `level`=CASE username WHEN %s THEN %s ELSE `level` END,"
+                         "`lures`=CASE username WHEN %s THEN %s ELSE `lures` END WHERE username IN (%s)", sql)
+        self.assertEqual(["tu0", 5, "tu0", 2, "tu0"], params)
+
+        states = dict(("tu{}".format(i), {"eggs": i}) for i in range(1200))
+        statements = list(account_states_sql(states))
+        self.assertEqual(3, len(statements))
+        self.assertEqual(1200, sum(len(params) // 3 for sql, params in statements))
+
+    def test_failed_flush_is_retried(self):
+        table = FakeAccountTable(failures=1)
+        store = AccountStateStore(60, table.write)
+        store.set("tu0", lures=3, level=5)
+        self.assertRaises(IOError, store.flush)
+        store.set("tu0", level=6)
+        store.flush()
+        self.assertEqual({"tu0": {"lures": 3, "level": 6}}, table.rows)
+
+    def test_reads_wait_for_flush_being_written(self):
+        table = FakeAccountTable()
+        writing, done = Event(), Event()
+
+        def slow_write(states):
+            writing.set()
+            done.wait()
+            table.write(states)
+
+        store = AccountStateStore(60, slow_write)
+        store.set("tu0", level=6)
+        flusher = Thread(target=store.flush)
+        flusher.start()
+        writing.wait()
+        reader = Thread(target=store.flush)
+        reader.start()
+        reader.join(0.1)
+        try:
+            self.assertTrue(reader.is_alive())
+        finally:
+            done.set()
+        reader.join()
+        self.assertEqual({"tu0": {"level": 6}}, table.rows)
+        flusher.join()
+
+    def test_crash_loses_last_interval_at_most(self):
+        table = FakeAccountTable()
+        store = AccountStateStore(0.05, table.write)
+        start = time.time()
+        while time.time() - start < 1:
+            store.set("tu0", allocated=time.time())
+            time.sleep(0.001)
+            # What the table would have if the scanner crashed now.
+            written = table.rows.get("tu0", {}).get("allocated", start)
+            self.assertLess(time.time() - written, 0.5)
+        last = time.time()
+        store.set("tu0", allocated=last)
+        time.sleep(0.2)
+        self.assertEqual(last, table.rows["tu0"]["allocated"])
 
 
 class DbtestAllocatableAllOutsideAllocationWindow(unittest.TestCase):
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import sys
 import time
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -32,15 +33,19 @@ if args.proxy and not args.proxy_skip_check:
 
 
 def set_account_level_from_args(accounts):
-    if args.level and accounts:
-        for acc in accounts:
+    for acc in accounts:
+        if args.level:
             acc["level"] = args.level
+        yield acc
 
-monocle_accounts = AccountManager.load_accounts(args.accountcsv)
+monocle_accounts = AccountManager.iter_accounts(args.accountcsv)
 if not args.login:
-    set_account_level_from_args(monocle_accounts)
+    monocle_accounts = set_account_level_from_args(monocle_accounts)
 duration = datetime.timedelta(hours=int(args.allocation_duration)) if args.allocation_duration else None
-AccountManager.insert_accounts(monocle_accounts, args.system_id, duration, args.force_system_id, args.skip_assigned)
+AccountManager.insert_accounts(monocle_accounts, args.system_id, duration, args.force_system_id, args.skip_assigned,
+                               args.dry_run)
+if args.dry_run:
+    sys.exit(0)
 
 account_manager = AccountManager(args.system_id, False, args, [], [], Queue(), {}, replace_warned=False)
 account_manager.initialize( args.accountcsv, [])
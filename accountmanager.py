@@ -16,6 +16,8 @@ parser.add_argument('-lg', '--login', action='store_true', default=False,
                     help='Login enough to find level and inventory (but not shadowban)')
 parser.add_argument('-nlg', '--no-login', action='store_true', default=False,
                     help='Dont login, only allocate')
+parser.add_argument('-dry', '--dry-run', action='store_true', default=False,
+                    help='Only report how many accounts would be inserted and updated, write nothing')
 
 parser.add_argument('-lvl', '--level', default=30,
                     help='Level of the loaded accounts  (meaningless with --login)')
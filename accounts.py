@@ -2,15 +2,16 @@ import logging
 import os.path
 import sys
 import time
+import unittest
 from csv import DictReader
 from datetime import datetime, timedelta
-from itertools import cycle
-from threading import Lock
+from heapq import heapify, heappop, heappush
+from itertools import count, cycle, islice
+from threading import Condition, Lock
 
 from accountdbsql import upsert_account, load_accounts, db_consume_lures, db_set_rest_time, db_set_temp_banned, \
-    db_set_account_level, db_set_blinded, db_update_account, db_set_behaviour, db_set_warned, insert_account, \
-    load_account, db_set_ios, db_set_model, db_set_device_id, \
-    update_account_level, db_set_system_id, update_allocated, update_allocation_end, db_set_perm_banned
+    db_set_account_level, db_set_blinded, db_update_account, db_set_behaviour, db_set_warned, db_set_perm_banned, \
+    load_existing_accounts, write_imported_accounts
 from management_errors import GaveUp
 from pogoservice import Account2
 from scannerutil import auth_service
@@ -60,6 +61,11 @@ class AccountManager:
         self.status = status
         self.account_captchas = account_captchas
         self.lock = Lock()
+        # Notified when an account is freed, guarded by self.lock.
+        self.available = Condition(self.lock)
+        self.free_accounts = FreeAccounts([])
+        # Seconds to wait for an account when all of them are allocated or resting.
+        self.free_account_wait = 100
         self.failureLock = Lock()
         self.consecutive_failures = 0
         self.accounts = []
@@ -83,7 +89,8 @@ class AccountManager:
             self.accounts = self.__load_db_account_objects()
         else:
             self.accounts = self.__create_account_objects(file_accts)
-        self.sort_accounts()
+        with self.lock:
+            self.free_accounts = FreeAccounts(self.accounts)
         for acct in self.accounts:
             self.status[acct.username] = acct.status_data()
         if len(self.accounts) > 0:
@@ -98,7 +105,9 @@ class AccountManager:
 
     def add_account(self, account):
         acct = self.create_account2(account)
-        self.accounts.append(acct)
+        with self.lock:
+            self.accounts.append(acct)
+            self.free_accounts.add(acct)
         self.status[acct.username] = acct.status_data()
         return acct
 
@@ -124,7 +133,9 @@ class AccountManager:
 
     def remove_accounts_without_lures(self):
         initial_length = len(self.accounts)
-        self.accounts = [x for x in self.accounts if x.account_info().lures != 0]
+        with self.lock:
+            self.accounts = [x for x in self.accounts if x.account_info().lures != 0]
+            self.free_accounts = FreeAccounts(self.accounts)
         remaining = len(self.accounts)
         log.info(
             "Initial account pool size {}, {} accounts have all lures spent, "
@@ -190,11 +201,11 @@ class AccountManager:
         return newaccount
 
     def has_free(self):
-        return any(s.is_available() for s in self.accounts)
+        return self.free_count() > 0
 
     def free_count(self):
-        return len([s for s in self.accounts if s.is_available()])
-
+        with self.lock:
+            return self.free_accounts.free_count()
 
     def update_initial_inventory(self, account):
         level = account["level"]
@@ -218,79 +229,70 @@ class AccountManager:
         return new_account
 
     def get_account(self, wait_for_account=True):
-        tries = 0
-        if not wait_for_account and not self.has_free():
-            raise OutOfAccounts
-        while not self.has_free() and tries < 10:
-            log.error("No more free accounts, all gone. Maybe some return?. Probably not")
-            time.sleep(10)
-            tries += 1
-        if tries == 10:
-            raise OutOfAccounts
-
-        with self.lock:
-            for account in self.accounts:
-                if self.reallocate and account.try_reallocate():
+        def allocate():
+            if self.reallocate:
+                account = self.free_accounts.reallocate()
+                if account is not None:
                     log.info("Reallocated {}".format(account))
-                    db_update_account(account)
-                    return account
-
-            for account in self.accounts:
-                if account.tryallocate():
                     if self.usingdb:
                         db_update_account(account)
-                    num_free = self.free_count()
-                    if num_free % 10 == 0:
-                        log.info("There are {} accounts remaining in pool".format(str(num_free)))
                     return account
-        raise OutOfAccounts
-
-    def compare_account_dates(self, x, y):
-        if x.allocated is None and y.allocated is None:
-            return 0
-        if x.allocated is None:
-            return -1
-        if y.allocated is None:
-            return 1
-        if x.allocated < y.allocated:
-            return -1
-        elif x.allocated == y.allocated:
-            return 0
-        else:
-            return 1
 
-    def sort_accounts(self):
-        self.accounts.sort(cmp=self.compare_account_dates)
+            account = self.free_accounts.allocate()
+            if account is not None:
+                if self.usingdb:
+                    db_update_account(account)
+                num_free = self.free_accounts.free_count()
+                if num_free % 10 == 0:
+                    log.info("There are {} accounts remaining in pool".format(str(num_free)))
+            return account
 
-    def get_with_behaviour(self, behaviour):
-        tries = 0
-        while not self.has_free() and tries < 10:
-            log.error("No more free accounts, all gone. Maybe some return?. Probably not")
-            time.sleep(10)
-            tries += 1
-        if tries == 10:
-            raise OutOfAccounts
+        return self.__wait_for(allocate, wait_for_account)
 
-        with self.lock:
-            for account in self.accounts:
-                if account.behaviour == behaviour and self.reallocate and account.try_reallocate():
+    def get_with_behaviour(self, behaviour):
+        def allocate():
+            if self.reallocate:
+                account = self.free_accounts.reallocate((behaviour,))
+                if account is not None:
                     log.info("Reallocated {}".format(account))
                     # dont need to update, basically nothing changed
                     return account
-            for account in self.accounts:
-                if account.behaviour == behaviour and account.tryallocate():
-                    db_update_account(account)
-                    return account
-            for account in self.accounts:
-                if account.behaviour is None and account.tryallocate():
-                    db_set_behaviour(account.name(), behaviour)
+            account = self.free_accounts.allocate((behaviour,))
+            if account is not None:
+                if self.usingdb:
                     db_update_account(account)
-                    return account
+                return account
+            account = self.free_accounts.allocate((None,))
+            if account is not None and self.usingdb:
+                db_set_behaviour(account.name(), behaviour)
+                db_update_account(account)
+            return account
+
+        return self.__wait_for(allocate)
+
+    def __wait_for(self, allocate, wait=True):
+        deadline = time.time() + self.free_account_wait
+        with self.lock:
+            account = allocate()
+            if account is None and wait:
+                log.error("No more free accounts, all gone. Maybe some return?. Probably not")
+            while account is None:
+                remaining = deadline - time.time()
+                if not wait or remaining <= 0:
+                    raise OutOfAccounts
+                # Resting accounts don't notify, wake up when the first one is rested.
+                next_ready = self.free_accounts.next_ready()
+                if next_ready is not None:
+                    remaining = min(remaining, next_ready + 0.01)
+                self.available.wait(remaining)
+                account = allocate()
+            return account
 
     def free_account(self, account):
         account.free()
         with self.lock:
-            self.sort_accounts()
+            self.free_accounts.release(account)
+            self.available.notify_all()
 
     def size(self):
         return len(self.accounts)
@@ -329,7 +331,7 @@ class AccountManager:
         log.error("Account is warned " + account_info.name())
         # account_info.()
         if self.usingdb:
-            db_set_warned(account_info.username, datetime.now())
+            db_set_warned(account_info, datetime.now())
 
     def mark_temp_banned(self, account_info):
         # self.account_failures.append(account.as_map())
@@ -367,7 +369,7 @@ class AccountManager:
         new_pogoservice.update_position(recent_position)
         self.free_account(current_account_info)
         if self.usingdb:
-            db_set_rest_time(pogoservice, current_account_info.rest_until)
+            db_set_rest_time(current_account_info.username, current_account_info.rest_until)
         log.info("{} replaced with {}".format(current_account_info.username, new_pogoservice.name()))
         return new_pogoservice
 
@@ -396,46 +398,42 @@ class AccountManager:
         return self.get_account()
 
     @staticmethod
-    def insert_accounts(accounts, system_id, allocation_duration=None, force_system_id=False, skip_assigned=False):
+    def insert_accounts(accounts, system_id, allocation_duration=None, force_system_id=False, skip_assigned=False,
+                        dry_run=False, batch_size=1000):
+        """Inserts the accounts, or updates them if they exist, batch_size at a time in one transaction each.
+        accounts can be any iterable, it's read as the batches are written. With dry_run nothing is written.
+        Returns the number of new, updated, unchanged and skipped accounts."""
         now = datetime.now()
         allocated = now if allocation_duration else None
         allocation_end = now + allocation_duration if allocation_duration else None
         log.info("Allocation end is {}".format(str(allocation_end)))
-        for account in accounts:
-            username_ = account["username"]
-            existing = load_account(username_)
-            if existing:
-                if skip_assigned:
-                    log.info("Account {} is assigned to {}, skipping".format(username_, existing["system_id"]))
-                    continue
-                if existing["system_id"] and system_id and not force_system_id:
-                    if not system_id == existing["system_id"]:
-                        raise ValueError("Account {} exists but is assigned to {}, cannot be loaded for {}".format(
-                            username_, existing["system_id"], system_id))
-                if system_id:
-                    db_set_system_id(username_, system_id)
-                if account.get("iOS") and not existing.get("iOS"):
-                    db_set_ios(username_, account["iOS"])
-                if account.get("model") and not existing.get("model"):
-                    db_set_model(username_, account["model"])
-                if account.get("id") and not existing.get("device_id"):
-                    db_set_device_id(username_, account["id"])
-                if account.get("level") and not existing.get("level"):  # never update
-                    update_account_level(username_, account["level"])
-                if not existing["system_id"] or not existing["allocated"]:
-                    update_allocated(username_, allocated)
-                if not existing["system_id"] or not existing["allocation_end"]:
-                    update_allocation_end(username_, allocation_end)
-
-            else:
-                insert_account(account, system_id, allocated, allocation_end)
+        counts = {"new": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        seen = set()
+        start = time.time()
+        accounts = iter(accounts)
+        while True:
+            batch = list(islice(accounts, batch_size))
+            if not batch:
+                break
+            existing = load_existing_accounts([account["username"] for account in batch])
+            new_accounts, changes = import_changes(batch, existing, seen, counts, system_id, allocated,
+                                                   allocation_end, force_system_id, skip_assigned)
+            if not dry_run:
+                write_imported_accounts(new_accounts, system_id, allocated, allocation_end, changes)
+            log.info("{}{} accounts read, {new} new, {updated} updated, {unchanged} unchanged, {skipped} skipped "
+                     "({rate:.0f} accounts/s)".format("Dry run, " if dry_run else "", len(seen) + counts["skipped"],
+                                                      rate=len(seen) / max(time.time() - start, 0.001), **counts))
+        return counts
 
     @staticmethod
     def load_accounts(accounts_file):  # can be moved back to utils
-
         if accounts_file is None:
             return None
+        return list(AccountManager.iter_accounts(accounts_file))
 
+    @staticmethod
+    def iter_accounts(accounts_file):
+        """The accounts of the file, read as they are iterated for the CSV formats"""
         if not os.path.isfile(accounts_file):
             raise ValueError("The supplied filename " + accounts_file + " does not exist")
 
@@ -443,13 +441,13 @@ class AccountManager:
         with open(accounts_file, 'r') as f1:
             first_line = f1.readline()
         if "username" in first_line and "password" in first_line:
-            return load_accounts_csv_monocle(accounts_file)
+            return iter_accounts_csv_monocle(accounts_file)
 
         if not first_line.startswith("ptc") and not first_line.startswith("google"):
-            return load_accounts_selly_ptc(accounts_file)
+            return iter_accounts_selly_ptc(accounts_file)
 
         with open(accounts_file, 'r') as f:
-            return AccountManager.__load_accounts_rocketmap(f)
+            return iter(AccountManager.__load_accounts_rocketmap(f))
 
     @staticmethod
     def __load_accounts_rocketmap(f):
@@ -561,28 +559,220 @@ class AccountManager:
         return result
 
 
-def load_accounts_csv_monocle(csv_location):
+class FreeAccounts(object):
+    """The accounts of an AccountManager that are not allocated, indexed so
+    finding one doesn't scan the whole pool.
+
+    The account that has been available the longest is handed out first, the
+    ones never allocated in the order they were added. The free ones are in a
+    heap per behaviour keyed by when they became available, those logged in
+    within their search interval also in a heap of reallocatable ones, and
+    the resting ones in a heap keyed by the end of their rest until it's over.
+
+    The behaviour is the one the account had when it was freed, workers set
+    it while they use the account. An account can be sent to rest or banned
+    while free, so it is checked again when it comes out of a heap and filed
+    anew if it moved. Each filing has a generation, entries of an older one
+    are left in the heaps and skipped. Not thread safe, AccountManager holds
+    its lock."""
+
+    def __init__(self, accounts):
+        self.sequence = count()
+        self.positions = {}
+        self.generations = {}
+        # Ids of the accounts that are free and not resting.
+        self.ready_ids = set()
+        self.ready = {}
+        self.recent = {}
+        self.resting = []
+        self.entries = 0
+        for account in accounts:
+            self.add(account)
+
+    def add(self, account):
+        self.positions[id(account)] = next(self.sequence)
+        if not account.is_allocated():
+            self.release(account, datetime.min)
+
+    def release(self, account, available=None):
+        self.__unfile(account)
+        if account.is_banned():
+            return
+        available = available or datetime.now()
+        position = self.positions[id(account)]
+        generation = self.generations[id(account)] = next(self.sequence)
+        if account.is_within_existing_alloc_window():
+            self.__push(self.recent.setdefault(account.behaviour, []), (available, position, generation, account))
+        self.__file(account, available, position, generation)
+        if self.entries > 4 * len(self.positions) + 64:
+            self.__compact()
+
+    def free_count(self):
+        self.__wake()
+        return len(self.ready_ids)
+
+    def next_ready(self):
+        """Seconds until the first resting account has rested, None if none is resting"""
+        self.__wake()
+        while self.resting and not self.__current(self.resting[0]):
+            self.__pop(self.resting)
+        if self.resting:
+            return max(0.0, (self.resting[0][0] - datetime.now()).total_seconds())
+
+    def reallocate(self, behaviours=None):
+        """Reallocates the first account within its search interval with one of the behaviours, or any behaviour
+        if None"""
+        while True:
+            heap = self.__first(self.recent, behaviours)
+            if heap is None:
+                return None
+            account = self.__pop(heap)[-1]
+            if account.try_reallocate():
+                self.__unfile(account)
+                return account
+
+    def allocate(self, behaviours=None):
+        """Allocates the first account that isn't resting with one of the behaviours, or any behaviour if None"""
+        self.__wake()
+        while True:
+            heap = self.__first(self.ready, behaviours)
+            if heap is None:
+                return None
+            available, position, generation, account = self.__pop(heap)
+            self.ready_ids.discard(id(account))
+            if account.tryallocate():
+                self.__unfile(account)
+                return account
+            if account.is_allocated() or account.is_banned():
+                self.__unfile(account)
+            else:
+                self.__file(account, available, position, generation)
+
+    # The heap of heaps with the first current entry, for the behaviours or all of them.
+    def __first(self, heaps, behaviours):
+        first = None
+        for behaviour in list(heaps) if behaviours is None else behaviours:
+            heap = heaps.get(behaviour)
+            while heap:
+                account = heap[0][-1]
+                if not self.__current(heap[0]):
+                    self.__pop(heap)
+                elif account.behaviour != behaviour:
+                    self.__push(heaps.setdefault(account.behaviour, []), self.__pop(heap))
+                else:
+                    break
+            if heap and (first is None or heap[0] < first[0]):
+                first = heap
+        return first
+
+    # Ready, or resting until it's available.
+    def __file(self, account, available, position, generation):
+        if account.is_resting():
+            self.__push(self.resting, (account.rest_until, position, generation, account))
+        else:
+            self.ready_ids.add(id(account))
+            self.__push(self.ready.setdefault(account.behaviour, []), (available, position, generation, account))
+
+    def __unfile(self, account):
+        self.generations.pop(id(account), None)
+        self.ready_ids.discard(id(account))
+
+    def __wake(self):
+        now = datetime.now()
+        while self.resting and self.resting[0][0] <= now:
+            entry = self.__pop(self.resting)
+            if self.__current(entry):
+                self.__file(entry[-1], *entry[:3])
+
+    def __current(self, entry):
+        return self.generations.get(id(entry[-1])) == entry[-2]
+
+    def __push(self, heap, entry):
+        heappush(heap, entry)
+        self.entries += 1
+
+    def __pop(self, heap):
+        self.entries -= 1
+        return heappop(heap)
+
+    def __compact(self):
+        heaps = list(self.ready.values()) + list(self.recent.values()) + [self.resting]
+        self.entries = 0
+        for heap in heaps:
+            heap[:] = [entry for entry in heap if self.__current(entry)]
+            heapify(heap)
+            self.entries += len(heap)
+
+
+def import_changes(batch, existing, seen, counts, system_id, allocated, allocation_end, force_system_id=False,
+                   skip_assigned=False):
+    """The accounts of batch to insert, and the columns to set for those in existing, like they were inserted or
+    updated one at a time. Accounts listed twice are only imported once, seen holds the lower case usernames of
+    the previous batches. Adds to the counts of AccountManager.insert_accounts"""
+    new_accounts = []
+    changes = {}
+    for account in batch:
+        username_ = account["username"]
+        if username_.lower() in seen:
+            log.warning("Account {} is listed more than once, skipping".format(username_))
+            counts["skipped"] += 1
+            continue
+        seen.add(username_.lower())
+        existing_ = existing.get(username_.lower())
+        if existing_ is None:
+            new_accounts.append(account)
+            counts["new"] += 1
+            continue
+        if skip_assigned:
+            log.info("Account {} is assigned to {}, skipping".format(username_, existing_["system_id"]))
+            counts["skipped"] += 1
+            continue
+        if existing_["system_id"] and system_id and not force_system_id:
+            if not system_id == existing_["system_id"]:
+                raise ValueError("Account {} exists but is assigned to {}, cannot be loaded for {}".format(
+                    username_, existing_["system_id"], system_id))
+
+        columns = {}
+        if system_id:
+            columns["system_id"] = system_id
+        if account.get("iOS") and not existing_.get("iOS"):
+            columns["iOS"] = account["iOS"]
+        if account.get("model") and not existing_.get("model"):
+            columns["model"] = account["model"]
+        if account.get("id") and not existing_.get("device_id"):
+            columns["device_id"] = account["id"]
+        if account.get("level") and not existing_.get("level"):  # never update
+            columns["level"] = account["level"]
+        if not existing_["system_id"] or not existing_["allocated"]:
+            columns["allocated"] = allocated
+        if not existing_["system_id"] or not existing_["allocation_end"]:
+            columns["allocation_end"] = allocation_end
+        columns = dict((column, value) for column, value in columns.items() if value != existing_.get(column))
+        if columns:
+            changes[existing_["username"]] = columns
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+    return new_accounts, changes
+
+
+def iter_accounts_csv_monocle(csv_location):
     with open(csv_location, 'rt') as f:
-        accounts = []
-        reader = DictReader(f)
-        for row in reader:
-            accounts.append(dict(row))
-    return accounts
+        for row in DictReader(f):
+            yield dict(row)
 
 
-def load_accounts_selly_ptc(csv_location):
+def iter_accounts_selly_ptc(csv_location):
     with open(csv_location, 'rt') as f:
-        accounts = []
-        for line in f.readlines():
+        for line in f:
             if len(line.strip()) == 0:
                 continue
             withcomma = line.replace(":", ",")
             if withcomma.startswith(","):
                 withcomma = withcomma[1:]
             usrnamepassword = withcomma.split(",")
-            accounts.append({"username": usrnamepassword[0].strip(), "password": usrnamepassword[1].strip(),
-                             "auth_service": "ptc"})
-    return accounts
+            yield {"username": usrnamepassword[0].strip(), "password": usrnamepassword[1].strip(),
+                   "auth_service": "ptc"}
 
 
 class OutOfAccounts:
@@ -590,3 +780,192 @@ class OutOfAccounts:
 
     def __init__(self):
         pass
+
+
+class ImportChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.allocated = datetime(2018, 1, 1)
+        self.existing = {
+            "tu0": {"username": "tu0", "system_id": "fnord", "iOS": None, "model": "iPhone5,2", "device_id": None,
+                    "level": 5, "allocated": datetime(2017, 1, 1), "allocation_end": None},
+            "tu1": {"username": "TU1", "system_id": None, "iOS": None, "model": None, "device_id": None,
+                    "level": None, "allocated": None, "allocation_end": None}}
+
+    def changes(self, batch, system_id="fnord", **kwargs):
+        counts = {"new": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        new_accounts, changes = import_changes(batch, self.existing, set(), counts, system_id, self.allocated, None,
+                                               **kwargs)
+        return [a["username"] for a in new_accounts], changes, counts
+
+    def test_diffs_against_existing(self):
+        batch = [{"username": "tu0", "password": "x", "iOS": "8.1.3", "model": "iPhone9,1", "level": "30"},
+                 {"username": "tu1", "password": "x", "id": "c8a8"},
+                 {"username": "tu2", "password": "x"}]
+        new_accounts, changes, counts = self.changes(batch)
+        self.assertEqual(["tu2"], new_accounts)
+        self.assertEqual({"tu0": {"iOS": "8.1.3"},
+                          "TU1": {"system_id": "fnord", "device_id": "c8a8", "allocated": self.allocated}}, changes)
+        self.assertEqual({"new": 1, "updated": 2, "unchanged": 0, "skipped": 0}, counts)
+
+    def test_duplicates_and_assigned_are_skipped(self):
+        batch = [{"username": "tu0"}, {"username": "tu2"}, {"username": "Tu2"}]
+        new_accounts, changes, counts = self.changes(batch, skip_assigned=True)
+        self.assertEqual(["tu2"], new_accounts)
+        self.assertEqual({}, changes)
+        self.assertEqual({"new": 1, "updated": 0, "unchanged": 0, "skipped": 2}, counts)
+
+    def test_other_system_id(self):
+        self.assertRaises(ValueError, self.changes, [{"username": "tu0"}], "other")
+        new_accounts, changes, counts = self.changes([{"username": "tu0"}], "other", force_system_id=True)
+        self.assertEqual({"tu0": {"system_id": "other"}}, changes)
+
+
+class FakeAccount(object):
+    """The allocation state of an Account2, without the API"""
+    search_interval = 7200
+
+    def __init__(self, behaviour=None, last_login=None):
+        self.behaviour = behaviour
+        self.last_login = last_login
+        self.allocated = False
+        self.banned = None
+        self.rest_until = None
+
+    def is_allocated(self):
+        return self.allocated
+
+    def is_banned(self):
+        return self.banned
+
+    def is_resting(self):
+        if self.rest_until:
+            return self.rest_until > datetime.now()
+
+    def is_within_existing_alloc_window(self):
+        return self.last_login and datetime.now() < (self.last_login + timedelta(seconds=self.search_interval))
+
+    def tryallocate(self):
+        if not self.allocated and not self.is_resting() and not self.is_banned():
+            self.allocated = True
+            return True
+
+    def try_reallocate(self):
+        if not self.allocated and not self.is_banned() and self.is_within_existing_alloc_window():
+            self.allocated = True
+            return True
+        return False
+
+    def free(self):
+        self.allocated = False
+
+
+class FreeAccountsTest(unittest.TestCase):
+    def release(self, free, account, available=None):
+        account.free()
+        free.release(account, available)
+
+    def test_allocate_by_behaviour(self):
+        plain, gyms, stops = FakeAccount(), FakeAccount("gyms"), FakeAccount("pokestops")
+        free = FreeAccounts([plain, gyms, stops])
+        self.assertIs(gyms, free.allocate(["gyms"]))
+        self.assertIsNone(free.allocate(["gyms"]))
+        self.assertIs(stops, free.allocate(["pokestops", "gyms"]))
+        self.assertIs(plain, free.allocate())
+        self.assertIsNone(free.allocate())
+
+    def test_behaviour_changed_while_allocated(self):
+        account = FakeAccount()
+        free = FreeAccounts([account])
+        free.allocate()
+        account.behaviour = "gyms"
+        self.release(free, account)
+        self.assertIsNone(free.allocate([None]))
+        self.assertIs(account, free.allocate(["gyms"]))
+
+    def test_reallocate_by_behaviour(self):
+        recent = FakeAccount("gyms", last_login=datetime.now())
+        other = FakeAccount("gyms")
+        free = FreeAccounts([other, recent])
+        self.assertIsNone(free.reallocate(["pokestops"]))
+        self.assertIs(recent, free.reallocate(["gyms"]))
+        self.assertIsNone(free.reallocate())
+        self.assertIs(other, free.allocate())
+        self.assertIsNone(free.allocate())
+
+    def test_reallocate_skips_expired_window(self):
+        account = FakeAccount(last_login=datetime.now())
+        free = FreeAccounts([account])
+        account.last_login = datetime.now() - timedelta(hours=3)
+        self.assertIsNone(free.reallocate())
+        self.assertIs(account, free.allocate())
+
+    def test_rested_while_free(self):
+        resting, ready = FakeAccount(), FakeAccount()
+        free = FreeAccounts([resting, ready])
+        resting.rest_until = datetime.now() + timedelta(seconds=0.1)
+        self.assertIs(ready, free.allocate())
+        self.assertIsNone(free.allocate())
+        self.assertEqual(0, free.free_count())
+        time.sleep(0.2)
+        self.assertEqual(1, free.free_count())
+        self.assertIs(resting, free.allocate())
+
+    def test_banned_while_free(self):
+        banned, ready = FakeAccount(), FakeAccount()
+        free = FreeAccounts([banned, ready])
+        banned.banned = True
+        self.assertIs(ready, free.allocate())
+        self.assertIsNone(free.allocate())
+        self.assertEqual(0, free.free_count())
+
+        banned.banned = None
+        ready.free()
+        free.release(ready)
+        self.assertEqual(1, free.free_count())
+
+    def test_free_count(self):
+        accounts = [FakeAccount() for _ in range(3)]
+        free = FreeAccounts(accounts)
+        self.assertEqual(3, free.free_count())
+        first = free.allocate()
+        free.allocate()
+        self.assertEqual(1, free.free_count())
+        self.release(free, first)
+        self.assertEqual(2, free.free_count())
+        free.release(accounts[2])
+        self.assertEqual(2, free.free_count())
+
+    def test_longest_available_first(self):
+        accounts = [FakeAccount(behaviour) for behaviour in (None, "gyms", None, "pokestops")]
+        free = FreeAccounts(accounts)
+        self.assertEqual(accounts, [free.allocate() for _ in accounts])
+
+        now = datetime.now()
+        for account, seconds in zip(accounts, (30, 10, 20, 40)):
+            self.release(free, account, now - timedelta(seconds=seconds))
+        self.assertEqual([accounts[3], accounts[0], accounts[2], accounts[1]],
+                         [free.allocate() for _ in accounts])
+
+    def test_next_ready(self):
+        account = FakeAccount()
+        free = FreeAccounts([account])
+        self.assertIsNone(free.next_ready())
+        free.allocate()
+        account.rest_until = datetime.now() + timedelta(minutes=10)
+        self.release(free, account)
+        self.assertAlmostEqual(600, free.next_ready(), delta=1)
+        self.assertIsNone(free.allocate())
+
+        account.rest_until = None
+        free.release(account)
+        self.assertIsNone(free.next_ready())
+        self.assertIs(account, free.allocate())
+
+    def test_stale_entries_are_compacted(self):
+        accounts = [FakeAccount() for _ in range(10)]
+        free = FreeAccounts(accounts)
+        for _ in range(100):
+            for account in accounts:
+                free.release(account)
+        self.assertLessEqual(free.entries, 4 * len(accounts) + 64)
+        self.assertEqual(accounts, [free.allocate() for _ in accounts])
@@ -120,6 +120,11 @@ def add_webhooks(parser):
                         help=('Number of times to retry sending webhook ' +
                               'data on failure.'),
                         type=int, default=3)
+    parser.add_argument('-whrb', '--wh-retry-budget',
+                        help=('Retries earned by each webhook request, so ' +
+                              'a webhook that is down is not flooded with ' +
+                              'retries.'),
+                        type=float, default=0.2)
     parser.add_argument('-wht', '--wh-timeout',
                         help='Timeout (in seconds) for webhook requests.',
                         type=float, default=1.0)
@@ -128,8 +133,36 @@ def add_webhooks(parser):
                               'until next retry will increase.'),
                         type=float, default=0.25)
     parser.add_argument('-whc', '--wh-concurrency',
-                        help=('Async requests pool size.'), type=int,
+                        help=('Maximum number of requests in flight to ' +
+                              'each webhook.'), type=int,
                         default=25)
+    parser.add_argument('-whqs', '--wh-queue-size',
+                        help=('Maximum number of messages waiting for each ' +
+                              'webhook. The oldest ones are dropped when a ' +
+                              'webhook falls behind.'),
+                        type=int, default=10000)
+    parser.add_argument('-whmfs', '--wh-max-frame-size',
+                        help=('Maximum number of messages sent in one ' +
+                              'webhook request, 0 for no limit.'),
+                        type=int, default=1000)
+    parser.add_argument('-whod', '--wh-outbox-dir',
+                        help=('Directory of the persistent webhook outbox. ' +
+                              'Messages are written there before they are ' +
+                              'sent, and sent after a restart or once a ' +
+                              'webhook is back up. Disabled if not set.'),
+                        default=None)
+    parser.add_argument('-whor', '--wh-outbox-retention',
+                        help=('Minutes to keep the messages in the webhook ' +
+                              'outbox if they are not sent.'),
+                        type=int, default=60)
+    parser.add_argument('-whos', '--wh-outbox-size',
+                        help=('Maximum size (in MB) of the webhook outbox. ' +
+                              'The oldest messages are dropped past it.'),
+                        type=int, default=256)
+    parser.add_argument('-whfi', '--wh-frame-interval',
+                        help=('Minimum time (in ms) to wait before sending the'
+                              + ' next webhook data frame.'), type=int,
+                        default=500)
     parser.add_argument('--wh-threads',
                         help=('Number of webhook threads; increase if the ' +
                               'webhook queue falls behind.'),
@@ -198,6 +231,18 @@ def basic_std_parser(name):
     parser.add_argument('--db-host', help='IP or hostname for the database.')
     parser.add_argument(
         '--db-port', help='Port for the database.', type=int, default=3306)
+    parser.add_argument('--db-pool-size',
+                        help=('Maximum number of MySQL connections shared ' +
+                              'by the gym, account and lure DB modules.'),
+                        type=int, default=10)
+    parser.add_argument('--db-pool-timeout',
+                        help=('Time (in seconds) to wait for a free ' +
+                              'connection in the MySQL connection pool.'),
+                        type=float, default=30.0)
+    parser.add_argument('--db-flush-interval',
+                        help=('Time (in seconds) to coalesce account state ' +
+                              'changes before writing them.'),
+                        type=float, default=1.0)
     return parser
 
 
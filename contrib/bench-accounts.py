@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Account allocation benchmark
+
+Times handing out and freeing the accounts of a pool of 10000, like workers
+being started and sent to rest, by scanning the sorted list like
+AccountManager.get_account() used to and with FreeAccounts. Some accounts
+are resting, some within their search interval, of a few behaviours.
+
+FreeAccounts hands out the account available the longest, so the accounts
+differ from the scan's. They are checked not to be handed out twice.
+
+No database is used:
+
+    python contrib/bench-accounts.py
+'''
+
+import os
+import sys
+import random
+import logging
+
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from accounts import FreeAccounts
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+ACCOUNTS = 10000
+ALLOCATIONS = 500
+BEHAVIOURS = (None, 'pokestops', 'gyms')
+
+
+# The allocation state of an Account2, without the API.
+class Account(object):
+    search_interval = 7200
+
+    def __init__(self, idx, now):
+        self.idx = idx
+        self.allocated = False
+        self.banned = None
+        self.rest_until = (now + timedelta(hours=1)
+                           if random.random() < 0.2 else None)
+        self.last_login = (now - timedelta(minutes=30)
+                           if random.random() < 0.05 else None)
+        self.behaviour = random.choice(BEHAVIOURS)
+
+    def is_allocated(self):
+        return self.allocated
+
+    def is_banned(self):
+        return self.banned
+
+    def is_resting(self):
+        if self.rest_until:
+            return self.rest_until > datetime.now()
+
+    def is_within_existing_alloc_window(self):
+        return self.last_login and datetime.now() < (
+            self.last_login + timedelta(seconds=self.search_interval))
+
+    def tryallocate(self):
+        if (not self.allocated and not self.is_resting() and
+                not self.is_banned()):
+            self.allocated = True
+            return True
+
+    def try_reallocate(self):
+        if (not self.allocated and not self.is_banned() and
+                self.is_within_existing_alloc_window()):
+            self.allocated = True
+            return True
+        return False
+
+    def free(self):
+        self.allocated = False
+
+
+# The previous get_account() and free_account(), without the lock.
+class ScannedAccounts(object):
+    def __init__(self, accounts):
+        self.accounts = list(accounts)
+
+    def allocate(self):
+        for account in self.accounts:
+            if account.try_reallocate():
+                return account
+        for account in self.accounts:
+            if account.tryallocate():
+                return account
+
+    def release(self, account):
+        account.free()
+        self.accounts.sort(key=lambda a: a.allocated)
+
+
+class IndexedAccounts(object):
+    def __init__(self, accounts):
+        self.free_accounts = FreeAccounts(accounts)
+
+    def allocate(self):
+        return (self.free_accounts.reallocate() or
+                self.free_accounts.allocate())
+
+    def release(self, account):
+        account.free()
+        self.free_accounts.release(account)
+
+
+# Allocates most of the pool, then frees a random account and allocates one
+# in its place ALLOCATIONS times.
+def run(pool_type):
+    random.seed(42)
+    now = datetime.now()
+    pool = pool_type([Account(idx, now) for idx in range(ACCOUNTS)])
+    start = default_timer()
+    allocated = [pool.allocate() for _ in range(int(ACCOUNTS * 0.7))]
+    for _ in range(ALLOCATIONS):
+        account = allocated.pop(random.randrange(len(allocated)))
+        pool.release(account)
+        allocated.append(pool.allocate())
+    elapsed = default_timer() - start
+    return len(set(allocated)) == len(allocated), elapsed
+
+
+def main():
+    _, scan_time = run(ScannedAccounts)
+    distinct, index_time = run(IndexedAccounts)
+    log.info('%d accounts, %d allocations: %.2fs scanning, %.2fs with '
+             'FreeAccounts (%.1fx)%s.', ACCOUNTS, ALLOCATIONS, scan_time,
+             index_time, scan_time / index_time,
+             '' if distinct else ', ACCOUNTS HANDED OUT TWICE')
+
+
+if __name__ == '__main__':
+    main()
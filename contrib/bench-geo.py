@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Distance benchmark
+
+Times the distance functions of pogom/geo.py from -l to random locations
+around it, one pair at a time and for all of them at once, and the
+distances between all the locations. The error of each one is measured
+against geopy's vincenty(), which is used by the scanners too, for
+locations up to 40 m, 1 km, 10 km and 100 km away.
+
+Then the forts within 40 m of -l are picked out of a map response's worth
+of forts, by computing the distance to each fort in turn like
+fort_within_distance() used to, and with nearest_within_m():
+
+    python contrib/bench-geo.py -os -l 53.55,10.0
+'''
+
+import os
+import sys
+import math
+import random
+import logging
+
+from collections import namedtuple
+from timeit import default_timer
+
+from geopy.distance import vincenty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args
+from pogom.geo import (equi_rect_distance_m, haversine_distance_m,
+                       equi_rect_distances_m, haversine_distances_m,
+                       equi_rect_distance_matrix_m,
+                       haversine_distance_matrix_m, nearest_within_m)
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+LOCATIONS = 20000
+MATRIX = 500
+RANGES = (40, 1000, 10000, 100000)
+FORTS = 300
+REPEATS = 1000
+
+Fort = namedtuple('Fort', ['id', 'latitude', 'longitude'])
+
+
+# Random locations up to distance meters from the center.
+def locations_around(center, distance, count):
+    lat_range = math.degrees(distance / 6371000.0)
+    lng_range = lat_range / math.cos(math.radians(center[0]))
+    locations = []
+    while len(locations) < count:
+        lat = center[0] + random.uniform(-lat_range, lat_range)
+        lng = center[1] + random.uniform(-lng_range, lng_range)
+        if vincenty(center, (lat, lng)).m <= distance:
+            locations.append((lat, lng))
+    return locations
+
+
+def timed(function):
+    start = default_timer()
+    result = function()
+    return result, default_timer() - start
+
+
+def max_error(distances, expected):
+    return max(abs(d - e) / e for d, e in zip(distances, expected) if e)
+
+
+def run_accuracy(center):
+    for distance in RANGES:
+        locations = locations_around(center, distance, 1000)
+        expected = [vincenty(center, loc).m for loc in locations]
+        log.info('Up to %6d m: equirectangular off by %.3f%%, haversine '
+                 'by %.3f%% from vincenty().', distance,
+                 100 * max_error(equi_rect_distances_m(center, locations),
+                                 expected),
+                 100 * max_error(haversine_distances_m(center, locations),
+                                 expected))
+
+
+def run_speed(center):
+    locations = locations_around(center, 10000, LOCATIONS)
+    _, vincenty_time = timed(
+        lambda: [vincenty(center, loc).m for loc in locations])
+    equi_rect, equi_rect_time = timed(
+        lambda: [equi_rect_distance_m(center, loc) for loc in locations])
+    haversine, haversine_time = timed(
+        lambda: [haversine_distance_m(center, loc) for loc in locations])
+    equi_rects, equi_rects_time = timed(
+        lambda: equi_rect_distances_m(center, locations))
+    haversines, haversines_time = timed(
+        lambda: haversine_distances_m(center, locations))
+
+    for name, seconds in (('vincenty()', vincenty_time),
+                          ('equi_rect_distance_m()', equi_rect_time),
+                          ('haversine_distance_m()', haversine_time),
+                          ('equi_rect_distances_m()', equi_rects_time),
+                          ('haversine_distances_m()', haversines_time)):
+        log.info('%-24s %10.0f distances/s (%6.1fx vincenty).', name,
+                 LOCATIONS / seconds, vincenty_time / seconds)
+    log.info('One to many off from one by one by %.1e m equirectangular, '
+             '%.1e m haversine.',
+             max(abs(a - b) for a, b in zip(equi_rects, equi_rect)),
+             max(abs(a - b) for a, b in zip(haversines, haversine)))
+
+    points = locations[:MATRIX]
+    _, loop_time = timed(lambda: [[equi_rect_distance_m(a, b) for b in points]
+                                  for a in points])
+    _, equi_rect_time = timed(
+        lambda: equi_rect_distance_matrix_m(points, points))
+    _, haversine_time = timed(
+        lambda: haversine_distance_matrix_m(points, points))
+    log.info('%d by %d matrix: %.3fs one by one, %.3fs '
+             'equi_rect_distance_matrix_m() (%.1fx), %.3fs '
+             'haversine_distance_matrix_m().', MATRIX, MATRIX, loop_time,
+             equi_rect_time, loop_time / equi_rect_time, haversine_time)
+
+
+# The previous fort_within_distance().
+def fort_within_distance(forts, pos, m):
+    with_distance = [(equi_rect_distance_m(pos, (fort.latitude,
+                                                 fort.longitude)), fort)
+                     for fort in forts]
+    items = [it for it in with_distance if it[0] < m]
+    items.sort()
+    return [item[1] for item in items]
+
+
+def run_forts(center):
+    forts = [Fort(i, lat, lng) for i, (lat, lng) in
+             enumerate(locations_around(center, 500, FORTS))]
+
+    def nearest():
+        indexes, _ = nearest_within_m(
+            center, [(fort.latitude, fort.longitude) for fort in forts], 40)
+        return [forts[idx] for idx in indexes]
+
+    expected, loop_time = timed(
+        lambda: [fort_within_distance(forts, center, 40)
+                 for _ in range(REPEATS)])
+    result, nearest_time = timed(
+        lambda: [nearest() for _ in range(REPEATS)])
+    log.info('%d forts within 40 m of %d: %.0f/s one by one, %.0f/s with '
+             'nearest_within_m() (%.1fx)%s.', len(result[0]), FORTS,
+             REPEATS / loop_time, REPEATS / nearest_time,
+             loop_time / nearest_time,
+             '' if result == expected else ', FORTS DIFFER')
+
+
+def main():
+    args = get_args()
+    center = tuple(float(x) for x in args.location.split(',')[:2])
+    random.seed(42)
+    log.info('NumPy %s.', 'used' if 'numpy' in sys.modules
+             else 'not installed')
+    run_accuracy(center)
+    run_speed(center)
+    run_forts(center)
+
+
+if __name__ == '__main__':
+    main()
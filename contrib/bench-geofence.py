@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Geofence benchmark
+
+Times the point in polygon tests of each fence in the fence files: ray
+casting over every edge, like Geofence.contains() used to, the prepared
+polygon's contains(), and its contains_many() for all the points at once.
+The points are random, in and around the fence's bounding box, and the
+answers are checked to be the same.
+
+The fences of -gf and -gef are used, or the fence files shipped in the
+repository if none are given, and a detailed fence of 1000 points around
+-l, like the outline of a city. Then Geofences.fence_name() looks the points
+up in 2000 small fences around -l, with the index of their bounding boxes
+and by testing every fence in turn:
+
+    python contrib/bench-geofence.py -os -l 0,0 -gf geofence.txt
+'''
+
+import os
+import sys
+import math
+import random
+import logging
+
+from timeit import default_timer
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from pogom.utils import get_args
+from pogom.polygon import PreparedPolygon
+from pogom.geofence import Geofence, Geofences, load_geofence_file
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+POINTS = 20000
+FENCES = 2000
+FENCE_FILES = ('geofence.txt', 'levelup_fences.txt')
+
+
+# The previous Geofence.contains().
+def ray_cast(points, box, x, y):
+    (max_x, max_y), (min_x, min_y) = box
+    if max_x < x or x < min_x or max_y < y or y < min_y:
+        return False
+
+    xinters = None
+    inside = False
+    p1x, p1y = points[0]
+    n = len(points)
+    for i in range(1, n + 1):
+        p2x, p2y = points[i % n]
+        if min(p1y, p2y) < y <= max(p1y, p2y) and x <= max(p1x, p2x):
+            if p1y != p2y:
+                xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+            if p1x == p2x or x <= xinters:
+                inside = not inside
+        p1x, p1y = p2x, p2y
+    return inside
+
+
+# A ragged outline of about 20 km around the center.
+def detailed_fence(center):
+    random.seed(42)
+    points = []
+    for i in range(1000):
+        angle = 2 * math.pi * i / 1000
+        radius = 0.1 * (1 + 0.3 * math.sin(7 * angle) +
+                        0.05 * random.random())
+        points.append((center[0] + radius * math.cos(angle),
+                       center[1] + radius * 1.8 * math.sin(angle)))
+    return Geofence('Detailed', points)
+
+
+# Small fences in a 2 by 2 degrees square around the center, some of them
+# overlapping.
+def small_fences(center):
+    random.seed(42)
+    fences = []
+    for i in range(FENCES):
+        x = center[0] + random.uniform(-1, 1)
+        y = center[1] + random.uniform(-1, 1)
+        radius = random.uniform(0.005, 0.05)
+        fences.append(Geofence('fence{}'.format(i), [
+            (x + radius * math.cos(2 * math.pi * k / 8),
+             y + radius * math.sin(2 * math.pi * k / 8))
+            for k in range(8)]))
+    return fences
+
+
+def timed(function):
+    start = default_timer()
+    result = function()
+    return result, default_timer() - start
+
+
+def run(fence):
+    points = fence.polygon().points
+    (max_x, max_y), (min_x, min_y) = fence.box()
+    margin_x = (max_x - min_x) / 10
+    margin_y = (max_y - min_y) / 10
+    random.seed(42)
+    xs = [random.uniform(min_x - margin_x, max_x + margin_x)
+          for _ in range(POINTS)]
+    ys = [random.uniform(min_y - margin_y, max_y + margin_y)
+          for _ in range(POINTS)]
+
+    box = fence.box()
+    expected, ray_cast_time = timed(
+        lambda: [ray_cast(points, box, x, y) for x, y in zip(xs, ys)])
+    polygon, prepare_time = timed(lambda: PreparedPolygon(points))
+    single, single_time = timed(
+        lambda: [polygon.contains(x, y) for x, y in zip(xs, ys)])
+    many, many_time = timed(lambda: polygon.contains_many(xs, ys))
+
+    log.info('%-20s %5d points: ray casting %7.0f/s, prepared in %6.1f ms, '
+             'contains %8.0f/s (%5.1fx), contains_many %8.0f/s (%5.1fx)%s.',
+             fence.name[:20], len(points), POINTS / ray_cast_time,
+             prepare_time * 1000, POINTS / single_time,
+             ray_cast_time / single_time, POINTS / many_time,
+             ray_cast_time / many_time,
+             '' if expected == single == many else ', ANSWERS DIFFER')
+
+
+def run_index(center):
+    fences = small_fences(center)
+    geofences, index_time = timed(lambda: Geofences(fences))
+    for fence in fences:
+        fence.polygon()
+    random.seed(42)
+    points = [(center[0] + random.uniform(-1, 1),
+               center[1] + random.uniform(-1, 1)) for _ in range(POINTS)]
+
+    def linear(lat, lng):
+        for fence in fences:
+            if fence.contains(lat, lng):
+                return fence.name
+
+    expected, linear_time = timed(
+        lambda: [linear(lat, lng) for lat, lng in points])
+    names, indexed_time = timed(
+        lambda: [geofences.fence_name(lat, lng) for lat, lng in points])
+    log.info('%d fences: indexed in %.1f ms, fence_name %.0f/s with the '
+             'index, %.0f/s testing every fence (%.1fx)%s.', len(fences),
+             index_time * 1000, POINTS / indexed_time, POINTS / linear_time,
+             linear_time / indexed_time,
+             '' if names == expected else ', ANSWERS DIFFER')
+
+
+def main():
+    args = get_args()
+    files = [f for f in (args.geofence_file, args.geofence_excluded_file)
+             if f]
+    files = files or [os.path.join(root, f) for f in FENCE_FILES]
+    log.info('Testing %d points per fence, NumPy %s.', POINTS,
+             'used' if 'numpy' in sys.modules else 'not installed')
+    for path in files:
+        for fence in load_geofence_file(path) or []:
+            run(fence)
+    center = [float(x) for x in args.location.split(',')[:2]]
+    run(detailed_fence(center))
+    run_index(center)
+
+
+if __name__ == '__main__':
+    main()
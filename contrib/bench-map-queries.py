@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Map query benchmark
+
+Times the queries behind /raw_data (Pokemon.get_active, Pokestop.get_stops,
+Gym.get_gyms and ScannedLocation.get_recent) across viewport sizes, for a
+full load and for a timestamp delta poll.
+
+Takes the regular RocketMap database options. Point it at a scratch
+database, it is filled with random data around -l on first use:
+
+    python contrib/bench-map-queries.py -os -l 40.75,-73.98 -D bench.db
+    python contrib/bench-map-queries.py -os -l 40.75,-73.98 --db-type mysql \\
+        --db-host 127.0.0.1 --db-name bench --db-user ... --db-pass ...
+
+Run it before and after a schema change to compare query plans in practice.
+'''
+
+import os
+import sys
+import random
+import logging
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args
+from pogom.models import (init_database, create_tables,
+                          verify_database_schema, bulk_upsert, Pokemon,
+                          Pokestop, Gym, ScannedLocation)
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# Spread of the generated data around the location, in degrees.
+AREA = 0.5
+# Only a small share of all Pokemon rows is active at any time.
+POKEMON = 200000
+ACTIVE_POKEMON = 0.02
+POKESTOPS = 20000
+GYMS = 4000
+SCANNED_LOCATIONS = 20000
+
+VIEWPORTS = (0.005, 0.02, 0.05, 0.2, AREA)
+REPEAT = 20
+
+
+def random_location(position):
+    return (position[0] + (random.random() - 0.5) * AREA,
+            position[1] + (random.random() - 0.5) * AREA)
+
+
+def fill(db, position):
+    random.seed(42)
+    now = datetime.utcnow()
+
+    pokemon = {}
+    for i in range(POKEMON):
+        lat, lng = random_location(position)
+        if random.random() < ACTIVE_POKEMON:
+            disappear_time = now + timedelta(minutes=random.randint(1, 30))
+        else:
+            disappear_time = now - timedelta(minutes=random.randint(1, 2000))
+        encounter_id = b64encode(str(i).encode())
+        pokemon[encounter_id] = {
+            'encounter_id': encounter_id,
+            'spawnpoint_id': '{:x}'.format(random.getrandbits(48)),
+            'pokemon_id': random.randint(1, 251),
+            'latitude': lat,
+            'longitude': lng,
+            'disappear_time': disappear_time,
+            'last_modified': disappear_time - timedelta(minutes=30)
+        }
+
+    pokestops = {}
+    for i in range(POKESTOPS):
+        lat, lng = random_location(position)
+        pokestops[i] = {
+            'pokestop_id': 'stop{}'.format(i),
+            'enabled': True,
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified': now - timedelta(minutes=random.randint(1, 600)),
+            'lure_expiration': None,
+            'active_fort_modifier': None,
+            'last_updated': now - timedelta(minutes=random.randint(1, 600))
+        }
+
+    gyms = {}
+    for i in range(GYMS):
+        lat, lng = random_location(position)
+        gyms[i] = {
+            'gym_id': 'gym{}'.format(i),
+            'team_id': random.randint(0, 3),
+            'guard_pokemon_id': random.randint(1, 251),
+            'slots_available': random.randint(0, 6),
+            'enabled': True,
+            'latitude': lat,
+            'longitude': lng,
+            'total_cp': random.randint(0, 20000),
+            'last_modified': now - timedelta(minutes=random.randint(1, 600)),
+            'last_scanned': now - timedelta(minutes=random.randint(1, 600))
+        }
+
+    scanned_locations = {}
+    for i in range(SCANNED_LOCATIONS):
+        lat, lng = random_location(position)
+        scanned_locations[i] = {
+            'cellid': 'cell{}'.format(i),
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified': now - timedelta(minutes=random.randint(1, 60))
+        }
+
+    for model, rows in ((Pokemon, pokemon), (Pokestop, pokestops),
+                        (Gym, gyms), (ScannedLocation, scanned_locations)):
+        log.info('Inserting %d %s rows.', len(rows), model.__name__)
+        bulk_upsert(model, rows, db)
+
+
+def timed(query, *args):
+    start = default_timer()
+    for _ in range(REPEAT):
+        rows = query(*args)
+    return len(rows), (default_timer() - start) / REPEAT * 1000
+
+
+def main():
+    args = get_args()
+    db = init_database(None)
+    verify_database_schema(db)
+    create_tables(db)
+
+    position = tuple(float(x) for x in args.location.split(','))
+
+    with db.execution_context():
+        if not Pokemon.select().count():
+            fill(db, position)
+
+    # Delta polls ask for everything changed in the last 10 seconds.
+    timestamp = (datetime.utcnow() - timedelta(seconds=10) -
+                 datetime(1970, 1, 1)).total_seconds() * 1000
+
+    queries = (('Pokemon.get_active', Pokemon.get_active),
+               ('Pokestop.get_stops', Pokestop.get_stops),
+               ('Gym.get_gyms', Gym.get_gyms),
+               ('ScannedLocation.get_recent', ScannedLocation.get_recent))
+
+    log.info('%-28s %9s %9s %11s %9s %11s', 'query', 'viewport', 'rows',
+             'full (ms)', 'rows', 'delta (ms)')
+    for size in VIEWPORTS:
+        box = (position[0] - size / 2, position[1] - size / 2,
+               position[0] + size / 2, position[1] + size / 2)
+        for name, query in queries:
+            with db.execution_context():
+                full_rows, full_ms = timed(query, *box)
+                delta_rows, delta_ms = timed(query, *(box + (timestamp,)))
+            log.info('%-28s %9.3f %9d %11.2f %9d %11.2f', name, size,
+                     full_rows, full_ms, delta_rows, delta_ms)
+
+
+if __name__ == '__main__':
+    main()
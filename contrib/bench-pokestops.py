@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Pokestop groups benchmark
+
+Times update_distances() and find_largest_groups() of pokestopModel for the
+stops of the Hamburg routes in hamburg.py, sorted by longitude like the
+database returns them, against the previous versions: a scan of the stops
+up to the longitude cutoff, and a pass over every stop for each group size.
+The neighbours and the groups are checked to be the same.
+
+No database is used:
+
+    python contrib/bench-pokestops.py
+'''
+
+import os
+import sys
+import logging
+
+from itertools import islice
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import hamburg
+from geography import step_position, center_geolocation
+from pokestopModel import (Pokestop, update_distances, find_largest_groups,
+                           find_largest_stop_group)
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+RADIUS = 39
+MIN_SIZES = (3, 2)
+
+
+# The previous update_distances().
+def scan_distances(point_list, radius=39):
+    DISTANCE = 2 * radius
+    for idx, point in enumerate(point_list):
+        cutoff_long = step_position(point.coords, 0, DISTANCE)
+        for point2 in islice(point_list, idx + 1, None):
+            point_longitude = point2.coords[1]
+            if point_longitude > cutoff_long[1]:
+                break
+            point.add_neighbours(point2, DISTANCE)
+
+
+# The previous find_largest_groups().
+def scan_largest_groups(point_list, min_size=3):
+    all_coords = {}
+    for stop in point_list:
+        all_coords[stop.coords] = stop
+
+    result_coords = []
+    max_stop_group = find_largest_stop_group(point_list)
+    for counter in range(max_stop_group, min_size - 1, -1):
+        for poke_stop_ in point_list:
+            intersected_ = poke_stop_.collected_neighbours()
+            if (len(intersected_) == counter and
+                    poke_stop_.coords in all_coords):
+                locations = [n.coords for n in intersected_]
+                result_coords.append((center_geolocation(locations),
+                                      poke_stop_.collected_neighbours()))
+                for location in locations:
+                    if location in all_coords:
+                        del all_coords[location]
+                for stop in intersected_:
+                    stop.neighbours = []
+    return result_coords
+
+
+# The (lat, lng, alt, id) of the stops on the routes, once each.
+def hamburg_stops():
+    stops = {}
+    for name in dir(hamburg):
+        route = getattr(hamburg, name)
+        if name.startswith('_') or not isinstance(route, list):
+            continue
+        for step in route:
+            # Steps are (location, stop, ...) or (location, [stops]), the
+            # grind route has locations only.
+            if not isinstance(step[1], (list, tuple)):
+                continue
+            for stop in (step[1] if isinstance(step[1], list)
+                         else [step[1]]):
+                stops[stop[3]] = stop
+    return sorted(stops.values(), key=lambda stop: (stop[1], stop[0]))
+
+
+def timed(function, *args):
+    start = default_timer()
+    result = function(*args)
+    return result, default_timer() - start
+
+
+def neighbours(point_list):
+    return [[n.id for n in point.neighbours] for point in point_list]
+
+
+def groups(result_coords):
+    return [(center, [stop.id for stop in stops])
+            for center, stops in result_coords]
+
+
+def run(stops, min_size):
+    before = [Pokestop(s[3], s[0], s[1], s[2]) for s in stops]
+    after = [Pokestop(s[3], s[0], s[1], s[2]) for s in stops]
+
+    _, scan_time = timed(scan_distances, before, RADIUS)
+    _, index_time = timed(update_distances, after, RADIUS)
+    same_neighbours = neighbours(before) == neighbours(after)
+    expected, groups_scan_time = timed(scan_largest_groups, before, min_size)
+    result, groups_heap_time = timed(find_largest_groups, after, min_size)
+
+    log.info('%d stops: neighbours in %.2fs by scanning, %.2fs with the '
+             'grid (%.1fx)%s.', len(stops), scan_time, index_time,
+             scan_time / index_time,
+             '' if same_neighbours else ', NEIGHBOURS DIFFER')
+    log.info('%d groups of %d or more stops in %.2fs with a pass per size, '
+             '%.2fs with the heaps (%.1fx)%s.', len(result), min_size,
+             groups_scan_time, groups_heap_time,
+             groups_scan_time / groups_heap_time,
+             '' if groups(expected) == groups(result) else
+             ', GROUPS DIFFER')
+
+
+def main():
+    stops = hamburg_stops()
+    for min_size in MIN_SIZES:
+        run(stops, min_size)
+
+
+if __name__ == '__main__':
+    main()
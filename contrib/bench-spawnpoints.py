@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Spawnpoint window benchmark
+
+Times finding the spawnpoints that could have spawned between two map
+objects requests, by testing could_have_spawned() on every spawnpoint like
+SpawnPoints.points_that_can_spawn() used to, and with the SpawnWindows
+index. The spawnpoints are random, as many as in a cell and as in a city,
+and so are the observations, some of them wrapping around the hour. The
+spawnpoints found are checked to be the same.
+
+No database is used:
+
+    python contrib/bench-spawnpoints.py
+'''
+
+import os
+import sys
+import random
+import logging
+
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from spawnpoint import SpawnPoint, SpawnPoints
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+SIZES = (50, 1000, 10000)
+OBSERVATIONS = 500
+KINDS = ('hhhs', 'hhss', 'hsss', 'hshs', 'ssss')
+
+
+def random_spawnpoints(count):
+    return [SpawnPoint({'id': idx, 'latitude': 53.55, 'longitude': 10.0,
+                        'kind': random.choice(KINDS), 'links': '',
+                        'latest_seen': random.randrange(3600),
+                        'earliest_unseen': random.randrange(3600)})
+            for idx in range(count)]
+
+
+# Map objects requests 10 to 300 seconds apart.
+def random_observations():
+    observations = []
+    for _ in range(OBSERVATIONS):
+        first = random.randrange(3600)
+        observations.append((first, (first + random.randint(10, 300)) % 3600))
+    return observations
+
+
+def timed(function):
+    start = default_timer()
+    result = function()
+    return result, default_timer() - start
+
+
+def run(count):
+    random.seed(42)
+    points = SpawnPoints(random_spawnpoints(count))
+    observations = random_observations()
+
+    expected, scan_time = timed(lambda: [
+        [x for x in points.spawnpoints if x.could_have_spawned_soh(*obs)]
+        for obs in observations])
+    result, index_time = timed(lambda: [
+        points.points_that_can_spawn_soh(*obs) for obs in observations])
+    log.info('%5d spawnpoints: %8.0f queries/s scanning, %8.0f/s with the '
+             'index (%.1fx), %.1f spawnpoints found on average%s.', count,
+             OBSERVATIONS / scan_time, OBSERVATIONS / index_time,
+             scan_time / index_time,
+             sum(len(r) for r in result) / float(OBSERVATIONS),
+             '' if result == expected else ', SPAWNPOINTS DIFFER')
+
+
+def main():
+    for count in SIZES:
+        run(count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+SpeedScan scheduling benchmark
+
+Times SpeedScan.next_item() and task_done() for -w workers scanning a
+random queue in a hive of -st steps around -l, all at the same time. The
+queue is searched once split in tiles, like the scheduler does, and once as
+a single tile, to show what the tiles save.
+
+No database or accounts are used:
+
+    python contrib/bench-speedscan.py -l 40.75,-73.98 -st 30 -w 200 \\
+        -k ... -u ... -p ...
+'''
+
+import os
+import sys
+import random
+import logging
+
+from datetime import datetime, timedelta
+from threading import Thread
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args, cellid, distance
+from pogom.transform import get_new_coords
+from pogom.schedulers import SpeedScan, SpeedQueue
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+CALLS_PER_WORKER = 50
+SPAWNS_PER_CELL = 15
+
+
+def hive_locations(center, steps, step_distance):
+    # Rows of cells 121m apart, covering the hive's bounding square.
+    spacing = step_distance * 1000 * 1.732
+    rows = steps * 2
+    locations = []
+    for row in range(-rows, rows + 1):
+        start = get_new_coords(center, row * spacing * 0.866 / 1000, 0)
+        offset = spacing / 2 if row % 2 else 0
+        for col in range(-rows, rows + 1):
+            loc = get_new_coords(start, (col * spacing + offset) / 1000, 90)
+            locations.append((loc[0], loc[1], 0))
+    return locations
+
+
+def build_scheduler(args, center, locations, tiled):
+    scheduler = SpeedScan([], [], args)
+    scheduler.cell_locs = locations
+    scheduler.cells = [cellid(loc) for loc in locations]
+    scheduler.cell_steps = list(range(len(locations)))
+    if tiled:
+        scheduler._generate_tiles()
+    else:
+        scheduler.cell_tiles = [0] * len(locations)
+        scheduler.tile_centers = [center]
+        scheduler.tile_radii = [max(distance(center, loc)
+                                    for loc in locations)]
+    scheduler.band_spacing = int(10 * 60 / len(locations))
+
+    random.seed(42)
+    items = []
+    for cell in range(len(locations)):
+        if random.random() < 0.1:
+            start = random.randint(0, 3600)
+            items.append((start, start + 240, 0, cell, -1))
+        for _ in range(SPAWNS_PER_CELL):
+            sp = len(scheduler.sp_ids)
+            scheduler.sp_ids.append(str(sp))
+            start = random.randint(0, 3600)
+            kind = 1 if random.random() < 0.2 else 2
+            items.append((start, start + (89 if kind == 1 else 900), kind,
+                          cell, sp))
+
+    now_date = datetime.utcnow()
+    scheduler.refresh_date = now_date
+    scheduler.refresh_ms = now_date.minute * 60 + now_date.second
+    scheduler.queues[0] = SpeedQueue(items, scheduler.cell_tiles,
+                                     len(scheduler.tile_centers))
+    scheduler.ready = True
+    return scheduler
+
+
+def worker(args, scheduler, locations, latencies):
+    loc = random.choice(locations)
+    status = {'username': 'worker-{}'.format(len(latencies)),
+              'latitude': loc[0], 'longitude': loc[1],
+              'last_scan_date': datetime.utcnow() - timedelta(
+                  seconds=args.scan_delay)}
+    for _ in range(CALLS_PER_WORKER):
+        start = default_timer()
+        step, step_location, _, _, _, _ = scheduler.next_item(status)
+        latencies.append(default_timer() - start)
+        if step < 0:
+            continue
+
+        status['latitude'], status['longitude'] = step_location[:2]
+        scheduler.task_done(status, {
+            'scan_secs': scheduler.refresh_ms, 'bad_scan': False,
+            'sp_id_list': []})
+
+
+def run(args, center, locations, tiled):
+    scheduler = build_scheduler(args, center, locations, tiled)
+    threads = []
+    latencies = []
+    start = default_timer()
+    for _ in range(args.workers):
+        t = Thread(target=worker,
+                   args=(args, scheduler, locations, latencies))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = default_timer() - start
+
+    log.info('%-6s %5d tiles, %6d items: %6d calls in %7.3fs, %8.1f '
+             'calls/s, %7.2f ms mean, %7.2f ms max.',
+             'tiled' if tiled else 'single', len(scheduler.tile_centers),
+             len(scheduler.queues[0]), len(latencies), elapsed,
+             len(latencies) / elapsed,
+             sum(latencies) * 1000 / len(latencies),
+             max(latencies) * 1000)
+
+
+def main():
+    args = get_args()
+    center = [float(x) for x in args.location.split(',')[:2]]
+    locations = hive_locations(center, args.step_limit, 0.070)
+    log.info('Simulating %d workers on %d cells.', args.workers,
+             len(locations))
+    for tiled in (False, True):
+        run(args, center, locations, tiled)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Upsert benchmark
+
+Compares the rows/s of the two --db-upsert-mode implementations of
+bulk_upsert() on the Pokemon table: "replace" (peewee's REPLACE INTO) and
+"update" (INSERT ... ON DUPLICATE KEY UPDATE on MySQL, ON CONFLICT DO UPDATE
+on SQLite).
+
+Takes the regular RocketMap database options. Point it at a scratch
+database, the Pokemon table is emptied before every run:
+
+    python contrib/bench-upsert.py -os -l 0,0 -D bench.db
+    python contrib/bench-upsert.py -os -l 0,0 --db-type mysql \\
+        --db-host 127.0.0.1 --db-name bench --db-user ... --db-pass ...
+
+Every batch re-upserts half of the previous batch, like a hive rescanning
+the same spawns.
+'''
+
+import os
+import sys
+import random
+import logging
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args
+from pogom.models import (init_database, create_tables, bulk_upsert,
+                          Pokemon)
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+BATCHES = 200
+BATCH_SIZE = 500
+
+
+def pokemon_batches():
+    random.seed(42)
+    now = datetime.utcnow()
+    encounter_id = 0
+    batches = []
+    previous = []
+    for _ in range(BATCHES):
+        batch = {}
+        # Half of the batch has been seen before, with a fresh despawn time.
+        for p in previous[:BATCH_SIZE // 2]:
+            p = dict(p, disappear_time=p['disappear_time'] +
+                     timedelta(seconds=1), last_modified=now)
+            batch[p['encounter_id']] = p
+        while len(batch) < BATCH_SIZE:
+            encounter_id += 1
+            p = {
+                'encounter_id': b64encode(str(encounter_id).encode()),
+                'spawnpoint_id': '{:x}'.format(random.getrandbits(48)),
+                'pokemon_id': random.randint(1, 251),
+                'latitude': 40.7 + random.random() / 10,
+                'longitude': -74.0 + random.random() / 10,
+                'disappear_time': now + timedelta(minutes=15),
+                'individual_attack': None,
+                'individual_defense': None,
+                'individual_stamina': None,
+                'move_1': None,
+                'move_2': None,
+                'cp': None,
+                'cp_multiplier': None,
+                'height': None,
+                'weight': None,
+                'gender': random.randint(1, 2),
+                'form': None,
+                'last_modified': now
+            }
+            batch[p['encounter_id']] = p
+        previous = list(batch.values())
+        batches.append(batch)
+    return batches
+
+
+def run(args, db, mode, batches):
+    args.db_upsert_mode = mode
+    with db.execution_context():
+        Pokemon.delete().execute()
+
+    rows = 0
+    start = default_timer()
+    for batch in batches:
+        bulk_upsert(Pokemon, batch, db)
+        rows += len(batch)
+    elapsed = default_timer() - start
+
+    log.info('%-8s %8d rows in %7.3fs: %10.1f rows/s.', mode, rows, elapsed,
+             rows / elapsed)
+
+
+def main():
+    args = get_args()
+    db = init_database(None)
+    create_tables(db)
+
+    batches = pokemon_batches()
+    for mode in ('replace', 'update'):
+        run(args, db, mode, batches)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Webhook cache benchmark
+
+Compares the messages/s and memory of the webhook change detection caches:
+the sharded WebhookKeyCache, which keeps a hash of the key fields of each
+message, and a single LFU cache per type of whole messages behind one lock,
+compared field by field, which is how wh_updater used to do it.
+
+The messages are a mix like a hive sends: mostly Pokemon seen a few times
+before they despawn, some of them encountered later, gyms that rarely
+change, and raids. --wh-threads threads check them at the same time, with a
+--wh-lfu-size cache:
+
+    python contrib/bench-webhook-cache.py -os -l 0,0 --wh-threads 4
+'''
+
+import os
+import sys
+import random
+import logging
+import threading
+
+from cachetools import LFUCache
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args
+from pogom.webhook import (WebhookKeyCache, ident_fields, key_fields)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+MESSAGES = 200000
+
+
+class MessageCache(object):
+    # The previous cache: whole messages, one lock for every type.
+    lock = threading.Lock()
+
+    def __init__(self, whtype, maxsize):
+        self.whtype = whtype
+        self.cache = LFUCache(maxsize=maxsize)
+
+    def update(self, ident, message):
+        with self.lock:
+            if ident in self.cache:
+                old = self.cache[ident]
+                if all(old.get(k) == message.get(k)
+                       for k in key_fields[self.whtype]):
+                    return False
+            self.cache[ident] = message
+        return True
+
+
+def pokemon(encounter_id):
+    return {
+        'encounter_id': str(encounter_id),
+        'spawnpoint_id': '{:x}'.format(random.getrandbits(40)),
+        'pokemon_id': random.randint(1, 386),
+        'latitude': 40.75 + random.random() / 10,
+        'longitude': -73.98 + random.random() / 10,
+        'disappear_time': 1500000000 + random.randint(0, 3600),
+        'last_modified_time': 1500000000000,
+        'time_until_hidden_ms': random.randint(0, 3600000),
+        'verified': True, 'seconds_until_despawn': random.randint(0, 3600),
+        'spawn_start': 0, 'spawn_end': 1800, 'player_level': 30,
+        'individual_attack': None, 'individual_defense': None,
+        'individual_stamina': None, 'move_1': None, 'move_2': None,
+        'cp': None, 'cp_multiplier': None, 'weight': None, 'height': None,
+        'gender': random.randint(1, 2), 'form': None, 'pokemon_level': None
+    }
+
+
+def encountered(message):
+    return dict(message, individual_attack=random.randint(0, 15),
+                individual_defense=random.randint(0, 15),
+                individual_stamina=random.randint(0, 15), move_1=216,
+                move_2=90, cp=random.randint(10, 3000), cp_multiplier=0.7,
+                weight=10.5, height=1.2, pokemon_level=30)
+
+
+def gym(gym_id):
+    return {
+        'gym_id': str(gym_id), 'team_id': random.randint(0, 3),
+        'guard_pokemon_id': random.randint(1, 386),
+        'slots_available': random.randint(0, 6),
+        'total_cp': random.randint(0, 20000), 'enabled': True,
+        'latitude': 40.75 + random.random() / 10,
+        'longitude': -73.98 + random.random() / 10,
+        'lowest_pokemon_motivation': 0.5, 'occupied_since': 1500000000,
+        'last_modified': 1500000000, 'raid_active_until': 0,
+        'name': 'Gym {}'.format(gym_id), 'url': 'http://example.com/gym.png'
+    }
+
+
+def raid(gym_id):
+    return {
+        'gym_id': str(gym_id), 'latitude': 40.75 + random.random() / 10,
+        'longitude': -73.98 + random.random() / 10,
+        'spawn': 1500000000, 'start': 1500003600, 'end': 1500006300,
+        'level': random.randint(1, 5), 'pokemon_id': None, 'cp': None,
+        'move_1': None, 'move_2': None, 'team_id': random.randint(0, 3),
+        'name': 'Gym {}'.format(gym_id)
+    }
+
+
+def messages():
+    random.seed(42)
+    result = []
+    seen = []
+    gyms = [gym(i) for i in range(2000)]
+    raids = {}
+    for encounter_id in range(MESSAGES):
+        r = random.random()
+        if r < 0.4 or not seen:
+            seen.append(pokemon(encounter_id))
+            result.append(('pokemon', seen[-1]))
+        elif r < 0.65:
+            # Seen again from the next step, sometimes encountered.
+            i = random.randint(max(len(seen) - 500, 0), len(seen) - 1)
+            if random.random() < 0.1:
+                seen[i] = encountered(seen[i])
+            result.append(('pokemon', seen[i]))
+        elif r < 0.95:
+            i = random.randint(0, len(gyms) - 1)
+            if random.random() < 0.05:
+                gyms[i] = dict(gyms[i], total_cp=random.randint(0, 20000))
+            result.append(('gym', dict(gyms[i])))
+        else:
+            i = random.randint(0, len(gyms) - 1)
+            if i not in raids or random.random() < 0.1:
+                raids[i] = raid(i)
+            result.append(('raid', dict(raids[i])))
+    return result
+
+
+def check(caches, messages, sent):
+    count = 0
+    for whtype, message in messages:
+        # Every message comes off the queue as a new dict.
+        message = dict(message)
+        if caches[whtype].update(message[ident_fields[whtype]], message):
+            count += 1
+    sent.append(count)
+
+
+def run(name, cache_class, args, messages):
+    if tracemalloc:
+        tracemalloc.start()
+    caches = dict((whtype, cache_class(whtype, args.wh_lfu_size))
+                  for whtype in ('pokemon', 'gym', 'raid'))
+    # The threads share the messages, like the wh-updater threads share
+    # the webhook queue.
+    threads = []
+    sent = []
+    start = default_timer()
+    for i in range(args.wh_threads):
+        t = threading.Thread(target=check, args=(
+            caches, messages[i::args.wh_threads], sent))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = default_timer() - start
+
+    memory = ''
+    if tracemalloc:
+        memory = ', {:.1f} MiB held by the caches'.format(
+            tracemalloc.get_traced_memory()[0] / 1024.0 / 1024)
+        tracemalloc.stop()
+    log.info('%-15s %d messages in %.3fs: %.0f messages/s, %d sent%s.',
+             name, len(messages), elapsed, len(messages) / elapsed,
+             sum(sent), memory)
+
+
+def main():
+    args = get_args()
+    log.info('Checking %d messages on %d threads, %d cached per type.',
+             MESSAGES, args.wh_threads, args.wh_lfu_size)
+    mix = messages()
+    run('WebhookKeyCache', WebhookKeyCache, args, mix)
+    run('MessageCache', MessageCache, args, mix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Map response replay benchmark
+
+Replays GET_MAP_OBJECTS and GYM_GET_INFO responses recorded with
+--record-responses through parse_map, process_map and parse_gyms, without
+any accounts, API calls or encounters, and reports the time spent and the
+memory allocated in each stage.
+
+Takes the regular RocketMap database options, plus the recording to replay.
+Point it at a scratch database, the parsed rows are written to it:
+
+    python runserver.py ... --record-responses scans.bin
+    python contrib/replay-responses.py scans.bin -os -l 40.75,-73.98 \\
+        -D replay.db
+
+Use --repeat to replay a short recording several times, and --no-db-writes
+to time the parsing alone.
+'''
+
+import os
+import sys
+import logging
+import argparse
+
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from pogom.utils import get_args
+from pogom import models
+from pogom.models import (init_database, create_tables, parse_map,
+                          process_map, parse_gyms, DbWriteBehind,
+                          queued_batches)
+from pogom.replay import read_responses, decode_response
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+logging.basicConfig(format=(
+    '%(asctime)s [%(module)14s][%(levelname)8s] %(message)s'))
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+STAGES = ('decode', 'parse_map', 'process_map', 'parse_gyms', 'db_writes')
+
+
+class CountingQueue(object):
+    '''
+    Stand-in for the DB and webhook queues. Counts what is put, and hands
+    DB batches to a write-behind stage unless DB writes are disabled.
+    '''
+
+    def __init__(self, write_behind=None):
+        self.write_behind = write_behind
+        self.items = 0
+
+    def put(self, item):
+        self.items += 1
+        if self.write_behind is not None:
+            for model, data in queued_batches(*item):
+                self.write_behind.merge(model, data)
+
+
+class JobCollector(object):
+    # Takes the process_map() jobs of parse_map(), like MapParser does, so
+    # both halves are timed separately.
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, step_location, job):
+        self.jobs.append(job)
+
+
+class NoCPWorkers(object):
+    def is_scanning_active(self):
+        return False
+
+
+class Stages(object):
+
+    def __init__(self):
+        self.calls = dict((stage, 0) for stage in STAGES)
+        self.secs = dict((stage, 0.0) for stage in STAGES)
+        self.allocated = dict((stage, 0) for stage in STAGES)
+
+    def run(self, stage, f, *args):
+        if tracemalloc:
+            before = tracemalloc.get_traced_memory()[0]
+        start = default_timer()
+        result = f(*args)
+        self.secs[stage] += default_timer() - start
+        self.calls[stage] += 1
+        if tracemalloc:
+            self.allocated[stage] += max(
+                0, tracemalloc.get_traced_memory()[0] - before)
+        return result
+
+    def report(self, scans, elapsed):
+        log.info('%-12s %8s %10s %10s%s', 'stage', 'calls', 'total s',
+                 'ms/call', ' %12s' % 'KiB/call' if tracemalloc else '')
+        for stage in STAGES:
+            calls = self.calls[stage]
+            if not calls:
+                continue
+            allocated = ''
+            if tracemalloc:
+                allocated = ' {:12.1f}'.format(
+                    self.allocated[stage] / 1024.0 / calls)
+            log.info('%-12s %8d %10.3f %10.3f%s', stage, calls,
+                     self.secs[stage], self.secs[stage] * 1000 / calls,
+                     allocated)
+
+        log.info('Replayed %d scans in %.3fs: %.1f scans/s.', scans,
+                 elapsed, scans / elapsed if elapsed else 0)
+        if tracemalloc:
+            log.info('Peak traced memory: %.1f MiB.',
+                     tracemalloc.get_traced_memory()[1] / 1024.0 / 1024)
+        else:
+            # Kilobytes on Linux.
+            log.info('Max RSS: %.1f MiB.', resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def replay(args, db, path, write_behind, stages):
+    dbq = CountingQueue(write_behind)
+    whq = CountingQueue()
+    account = {'username': 'replay', 'level': 30}
+    status = {'proxy_url': None}
+    scans = 0
+
+    for name, step_location, scan_date, payload in read_responses(path):
+        response = stages.run('decode', decode_response, name, payload)
+
+        if name == 'GET_MAP_OBJECTS':
+            # Nothing is ever blind in a replay.
+            models.blindnessFailures.clear()
+            collector = JobCollector()
+            map_dict = {'responses': {'GET_MAP_OBJECTS': response}}
+            stages.run('parse_map', parse_map, args, map_dict,
+                       step_location, dbq, whq, None, None, status,
+                       scan_date, account, None, collector)
+            for job in collector.jobs:
+                stages.run('process_map', process_map, *job)
+            scans += 1
+        else:
+            stages.run('parse_gyms', parse_gyms, args,
+                       {response.gym_status_and_defenders
+                        .pokemon_fort_proto.id: response}, whq, dbq)
+
+        if write_behind is not None:
+            stages.run('db_writes', write_behind.flush, db, True)
+
+    log.debug('Put %d DB batches and %d webhook messages.', dbq.items,
+              whq.items)
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('recording')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-db-writes', action='store_true')
+    replay_args, sys.argv[1:] = parser.parse_known_args()
+
+    args = get_args()
+    args.encounter = False
+    args.pokestop_spinning = False
+    args.cp_worker_manager = NoCPWorkers()
+
+    db = init_database(None)
+    create_tables(db)
+
+    write_behind = None
+    if not replay_args.no_db_writes:
+        write_behind = DbWriteBehind()
+
+    if tracemalloc:
+        tracemalloc.start()
+
+    stages = Stages()
+    scans = 0
+    start = default_timer()
+    for _ in range(replay_args.repeat):
+        scans += replay(args, db, replay_args.recording, write_behind,
+                        stages)
+    stages.report(scans, default_timer() - start)
+
+
+if __name__ == '__main__':
+    main()
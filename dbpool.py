@@ -0,0 +1,240 @@
+import logging
+import threading
+import time
+from collections import deque
+from timeit import default_timer
+
+import pymysql.cursors
+from pymysql.constants import SERVER_STATUS
+from pymysql.err import OperationalError
+
+log = logging.getLogger(__name__)
+
+# MySQL connections shared by gymdbsql, accountdbsql and luredbsql. A
+# connection is checked out of the pool for each call, and returned to it
+# when the call closes it, so the threads of a scanner share a few open
+# connections instead of connecting for every query.
+pools = {}
+pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# A connection checked out of the pool. close() returns it to the pool, the
+# rest is the pymysql connection's.
+class PooledConnection(object):
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+
+class ConnectionPool(object):
+    # Seconds a connection can be idle before it's pinged on checkout.
+    check_interval = 30
+    # Seconds to wait before trying to connect again when MySQL refuses.
+    connect_backoff = (1, 2, 5)
+    # Seconds between two logs of the pool's stats.
+    stats_interval = 60
+    # Seconds between two checks for threads that waited too long.
+    watch_interval = 0.1
+
+    def __init__(self, connect, size, timeout):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Idle connections and when they were returned, the last returned
+        # last.
+        self.idle = deque()
+        # Threads waiting for a connection, first come first served, as
+        # (lock, slot, deadline). The connection is handed over in the slot
+        # and the lock released to wake the thread up. Python 2 polls when
+        # waiting with a timeout, so the threads wait without one, and the
+        # watchdog wakes them up at the deadline.
+        self.waiters = deque()
+        self.watchdog = None
+        # Connections open, idle or checked out.
+        self.open = 0
+
+        self.checkouts = self.waited = self.timeouts = 0
+        self.connects = self.reconnects = 0
+        self.wait_total = self.wait_max = 0.0
+        self.stats_timer = default_timer()
+
+    def connection(self):
+        start = default_timer()
+        with self.lock:
+            if self.idle and not self.waiters:
+                connection, returned = self.idle.pop()
+            elif self.open < self.size and not self.waiters:
+                connection, returned = None, None
+                self.open += 1
+            else:
+                waiter, slot = threading.Lock(), []
+                entry = (waiter, slot, start + self.timeout)
+                waiter.acquire()
+                self.waiters.append(entry)
+                self._watch()
+                self.lock.release()
+                try:
+                    waiter.acquire()
+                finally:
+                    self.lock.acquire()
+                    if entry in self.waiters:
+                        self.waiters.remove(entry)
+                if not slot:
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        'No free MySQL connection in {} seconds, {} are '
+                        'checked out.'.format(self.timeout, self.open))
+                # An idle connection, or None to open one instead of a
+                # connection that was dropped.
+                connection, returned = slot[0]
+
+            now = default_timer()
+            self.checkouts += 1
+            if now - start > 0.001:
+                self.waited += 1
+            self.wait_total += now - start
+            self.wait_max = max(self.wait_max, now - start)
+            if now - self.stats_timer > self.stats_interval:
+                self._log_stats(now)
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif (now - returned > self.check_interval and
+                  not self._alive(connection)):
+                with self.lock:
+                    self.reconnects += 1
+                connection = self._connect()
+        except Exception:
+            self._discarded()
+            raise
+        return PooledConnection(self, connection)
+
+    def release(self, connection):
+        try:
+            if not connection.open:
+                raise OperationalError('Connection closed.')
+            # Ends the transaction a read left open, so the next user
+            # doesn't see its snapshot.
+            in_transaction = SERVER_STATUS.SERVER_STATUS_IN_TRANS
+            if connection.server_status & in_transaction:
+                connection.rollback()
+        except Exception as e:
+            log.debug('Dropping MySQL connection: %s', e)
+            self._close(connection)
+            self._discarded()
+            return
+
+        with self.lock:
+            if self.waiters:
+                waiter, slot, _ = self.waiters.popleft()
+                slot.append((connection, default_timer()))
+                waiter.release()
+            else:
+                self.idle.append((connection, default_timer()))
+
+    def _watch(self):
+        if self.watchdog is None:
+            self.watchdog = threading.Thread(target=self._expire_waiters,
+                                             name='MySQL pool watchdog')
+            self.watchdog.daemon = True
+            self.watchdog.start()
+
+    # Wakes up the threads that waited for a connection until their
+    # deadline, with nothing in their slot. They all wait as long, so the
+    # first ones are the ones to expire.
+    def _expire_waiters(self):
+        while True:
+            time.sleep(self.watch_interval)
+            now = default_timer()
+            with self.lock:
+                while self.waiters and self.waiters[0][2] <= now:
+                    waiter, _, _ = self.waiters.popleft()
+                    waiter.release()
+
+    def _connect(self):
+        for backoff in self.connect_backoff + (None,):
+            try:
+                connection = self.connect()
+                with self.lock:
+                    self.connects += 1
+                return connection
+            except OperationalError as e:
+                if backoff is None:
+                    raise
+                log.warning('Unable to connect to MySQL, retrying in %d '
+                            'seconds: %s', backoff, e)
+                time.sleep(backoff)
+
+    def _alive(self, connection):
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Exception as e:
+            log.debug('Idle MySQL connection is gone: %s', e)
+            self._close(connection)
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    # The connection is gone, a waiting thread can open one instead.
+    def _discarded(self):
+        with self.lock:
+            if self.waiters:
+                waiter, slot, _ = self.waiters.popleft()
+                slot.append((None, None))
+                waiter.release()
+            else:
+                self.open -= 1
+
+    def _log_stats(self, now):
+        log.info('MySQL pool: %d checkouts, %d waited (%.1f ms avg, %.0f ms '
+                 'max), %d timed out, %d connects, %d reconnects, %d of %d '
+                 'connections open, %d idle, %d threads waiting.',
+                 self.checkouts, self.waited,
+                 self.wait_total * 1000 / self.checkouts,
+                 self.wait_max * 1000, self.timeouts, self.connects,
+                 self.reconnects, self.open, self.size, len(self.idle),
+                 len(self.waiters))
+
+        self.checkouts = self.waited = self.timeouts = 0
+        self.connects = self.reconnects = 0
+        self.wait_total = self.wait_max = 0.0
+        self.stats_timer = now
+
+
+# Checks out a connection to the database of args, from the pool shared by
+# everything that uses the same database.
+def pooled_connection(args):
+    key = (args.db_host, args.db_port, args.db_user, args.db_name)
+    pool = pools.get(key)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(key)
+            if pool is None:
+                pool = pools[key] = ConnectionPool(
+                    lambda: pymysql.connect(
+                        user=args.db_user, password=args.db_pass,
+                        database=args.db_name, host=args.db_host,
+                        port=args.db_port, charset='utf8mb4',
+                        cursorclass=pymysql.cursors.DictCursor),
+                    args.db_pool_size, args.db_pool_timeout)
+    return pool.connection()
@@ -322,6 +322,8 @@ def run_for_spawnpoints(runner, encounter_id, runner_spawnpoints):
 def process_collection(pokemons, cell_spawn_points, prev_map_objects, rares, this_map_objects, cell_id,
                        seen_encounters, first_scan):
     seen_blinds = False
+    # The window is the same for every new encounter of the map objects, look it up once
+    possible_spawn_points = None
     for pkmn in pokemons:
         encounter_id = pkmn["encounter_id"]
         pokemon_id = pkmn["pokemon_id"]
@@ -338,7 +340,9 @@ def process_collection(pokemons, cell_spawn_points, prev_map_objects, rares, thi
                 else:
                     log.debug("Spawn point {} not in db".format(pkmn["spawn_point_id"]))  # todo warning
             elif not first_scan:
-                possible_spawn_points = cell_spawn_points.points_that_can_spawn(prev_map_objects, this_map_objects)
+                if possible_spawn_points is None:
+                    possible_spawn_points = cell_spawn_points.points_that_can_spawn(prev_map_objects,
+                                                                                    this_map_objects)
                 if len(possible_spawn_points) == 1:
                     point = possible_spawn_points[0]
                     pkmn["longitude"] = point.longitude
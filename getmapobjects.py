@@ -2,11 +2,9 @@ import logging
 import sys
 import unittest
 
-from geopy.distance import vincenty
-
 import pokemon_data
+from pogom.geo import equi_rect_distances_m, nearest_within_m
 from pokemon_data import pokemon_name
-from scannerutil import equi_rect_distance_m
 
 log = logging.getLogger(__name__)
 
@@ -84,7 +82,8 @@ def catchable_pokemon(response):
 
 def catchable_pokemon_by_distance(response, pos):
     wilds = catchable_pokemon(response)
-    with_distance = [(vincenty(pos, (x.latitude, x.longitude)).m, x) for x in wilds]
+    distances = equi_rect_distances_m(pos, [(x.latitude, x.longitude) for x in wilds])
+    with_distance = list(zip(distances, wilds))
     with_distance.sort(key=lambda tup: tup[0], reverse=True)
     return with_distance
 
@@ -235,8 +234,9 @@ def find_pokestop(map_objects, pokestop_id):
 def nearest_pokstop(map_objects, pos):
     result = None
     closest = sys.maxsize
-    for pokestop in parse_pokestops(map_objects):
-        distance = equi_rect_distance_m(pos, (pokestop.latitude, pokestop.longitude))
+    pokestops = parse_pokestops(map_objects)
+    distances = equi_rect_distances_m(pos, [(x.latitude, x.longitude) for x in pokestops])
+    for pokestop, distance in zip(pokestops, distances):
         if distance < closest:
             result = pokestop
             closest = distance
@@ -265,10 +265,9 @@ def pokstops_within_distance(map_objects, pos, m):
 
 
 def fort_within_distance(forts, pos, m):
-    with_distance = [(equi_rect_distance_m(pos, (fort.latitude, fort.longitude)), fort) for fort in forts]
-    items = [it for it in with_distance if it[0] < m]
-    items.sort()
-    return map(lambda item: item[1], items)
+    forts = list(forts)
+    nearest, _ = nearest_within_m(pos, [(fort.latitude, fort.longitude) for fort in forts], m)
+    return [forts[idx] for idx in nearest]
 
 
 def __check_speed_violation(cells):
@@ -9,6 +9,8 @@ log = logging.getLogger(__name__)
 import pymysql.cursors
 from pymysql import IntegrityError
 
+from dbpool import pooled_connection
+
 args = None
 
 '''
@@ -51,10 +53,7 @@ def set_args(new_args):
 
 
 def __gymmapconnection():
-    return pymysql.connect(user=args.db_user, password=args.db_pass, database=args.db_name, host=args.db_host,
-                           port=args.db_port,
-                           charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
+    return pooled_connection(args)
 
 
 def log_gym_change_in_db(g, previous_gym_name, kmh, distance):
@@ -190,7 +189,10 @@ def update_gym_members(gym, added, removed, gym_last_previous_scan):
             upsert_full_gym_member(connection, gymid, member["pokemon_data"], lastScanned, last_modified_gym,
                                    gym_last_previous_scan)
     finally:
-        connection.commit()
+        try:
+            connection.commit()
+        finally:
+            connection.close()
 
 
 def update_defenders(gym, added, removed, gym_last_previous_scan):
@@ -214,7 +216,10 @@ def do_update_defenders(gym, added, removed, gym_last_previous_scan):
         for memberId, member in added.items():
             insert_defender(connection, gymid, lastScanned, last_modified_gym, member["pokemon_data"])
     finally:
-        connection.commit()
+        try:
+            connection.commit()
+        finally:
+            connection.close()
 
 
 def update_last_scanned_members(connection, gym_id, last_scanned):
@@ -1,6 +1,6 @@
 import logging
 
-import pymysql.cursors
+from dbpool import pooled_connection
 
 log = logging.getLogger(__name__)
 
@@ -24,10 +24,7 @@ def set_lure_db_args(new_args):
 
 
 def __lure_db_connection():
-    return pymysql.connect(user=args.db_user, password=args.db_pass, database=args.db_name, host=args.db_host,
-                           port=args.db_port,
-                           charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
+    return pooled_connection(args)
 
 
 def lures(username):
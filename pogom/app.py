@@ -4,8 +4,10 @@
 import calendar
 import logging
 
-from flask import Flask, abort, jsonify, render_template, request,\
-    make_response, send_from_directory
+from itertools import chain
+
+from flask import Flask, Response, abort, jsonify, render_template,\
+    request, make_response, send_from_directory, stream_with_context
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
@@ -18,10 +20,14 @@ from .models import (Pokemon, Gym, Pokestop, ScannedLocation,
                      SpawnPoint)
 from .utils import now, dottedQuadToNum
 from .blacklist import fingerprints, get_ip_blacklist
+from .jsonstream import json_response
 
 log = logging.getLogger(__name__)
 compress = Compress()
 
+# raw_data keys holding lists (or dicts) of map objects.
+map_data_keys = ('pokemons', 'pokestops', 'gyms', 'scanned', 'spawnpoints')
+
 
 class Pogom(Flask):
 
@@ -45,6 +51,9 @@ class Pogom(Flask):
             self.blacklist = []
             self.blacklist_keys = []
 
+        # Serves the map queries from memory when set.
+        self.live_cache = None
+
         # Routes
         self.json_encoder = CustomJSONEncoder
         self.route("/", methods=['GET'])(self.fullmap)
@@ -135,6 +144,9 @@ class Pogom(Flask):
     def set_control_flags(self, control):
         self.control_flags = control
 
+    def set_live_cache(self, live_cache):
+        self.live_cache = live_cache
+
     def set_heartbeat_control(self, heartb):
         self.heartbeat = heartb
 
@@ -244,6 +256,11 @@ class Pogom(Flask):
         lastslocs = request.args.get('lastslocs')
         lastspawns = request.args.get('lastspawns')
 
+        # Map objects are read from the database while the response is
+        # sent, and optionally encoded as compact rows.
+        stream = args.stream_map_data
+        compact = request.args.get('compact', 'false') == 'true'
+
         if request.args.get('luredonly', 'true') == 'true':
             luredonly = True
         else:
@@ -275,6 +292,21 @@ class Pogom(Flask):
         else:
             newArea = False
 
+        # Active objects come from the live cache if there is one.
+        active_pokemon = self.live_cache or Pokemon
+        active_pokestops = self.live_cache or Pokestop
+        active_gyms = self.live_cache or Gym
+
+        # The live cache also tracks what changed since the sequence token
+        # of the previous request. Unknown or expired tokens get everything
+        # in view again, like the first request after a switch is turned on.
+        changes = None
+        if self.live_cache:
+            d['seq'] = self.live_cache.token()
+            changes = self.live_cache.changes_since(request.args.get('seq'))
+            if changes is None:
+                lastpokemon = lastpokestops = lastgyms = None
+
         # Pass current coords as old coords.
         d['oSwLat'] = swLat
         d['oSwLng'] = swLng
@@ -285,77 +317,97 @@ class Pogom(Flask):
                 not args.no_pokemon):
             if request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
-                d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
-                                                         neLat, neLng)
+                d['pokemons'] = active_pokemon.get_active_by_id(
+                    ids, swLat, swLng, neLat, neLng)
             elif lastpokemon != 'true':
                 # If this is first request since switch on, load
                 # all pokemon on screen.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = active_pokemon.get_active(
+                    swLat, swLng, neLat, neLng, stream=stream)
             else:
                 # If map is already populated only request modified Pokemon
                 # since last request time.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
-                                                   timestamp=timestamp)
+                if changes is not None:
+                    d['pokemons'] = self.live_cache.get_changed_pokemon(
+                        changes, swLat, swLng, neLat, neLng)
+                else:
+                    d['pokemons'] = active_pokemon.get_active(
+                        swLat, swLng, neLat, neLng, timestamp=timestamp,
+                        stream=stream)
                 if newArea:
                     # If screen is moved add newly uncovered Pokemon to the
                     # ones that were modified since last request time.
-                    d['pokemons'] = d['pokemons'] + (
-                        Pokemon.get_active(swLat, swLng, neLat, neLng,
-                                           oSwLat=oSwLat, oSwLng=oSwLng,
-                                           oNeLat=oNeLat, oNeLng=oNeLng))
+                    d['pokemons'] = chain(d['pokemons'], (
+                        active_pokemon.get_active(
+                            swLat, swLng, neLat, neLng,
+                            oSwLat=oSwLat, oSwLng=oSwLng,
+                            oNeLat=oNeLat, oNeLng=oNeLng, stream=stream)))
 
             if request.args.get('eids'):
                 # Exclude id's of pokemon that are hidden.
                 eids = [int(x) for x in request.args.get('eids').split(',')]
-                d['pokemons'] = [
-                    x for x in d['pokemons'] if x['pokemon_id'] not in eids]
+                d['pokemons'] = (
+                    x for x in d['pokemons'] if x['pokemon_id'] not in eids)
 
             if request.args.get('reids'):
                 reids = [int(x) for x in request.args.get('reids').split(',')]
-                d['pokemons'] = d['pokemons'] + (
-                    Pokemon.get_active_by_id(reids, swLat, swLng,
-                                             neLat, neLng))
+                d['pokemons'] = chain(d['pokemons'], (
+                    active_pokemon.get_active_by_id(reids, swLat, swLng,
+                                                    neLat, neLng)))
                 d['reids'] = reids
 
         if (request.args.get('pokestops', 'true') == 'true' and
                 not args.no_pokestops):
             if lastpokestops != 'true':
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    lured=luredonly)
+                d['pokestops'] = active_pokestops.get_stops(
+                    swLat, swLng, neLat, neLng, lured=luredonly,
+                    stream=stream)
             else:
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                                    timestamp=timestamp)
+                if changes is not None:
+                    d['pokestops'] = self.live_cache.get_changed_stops(
+                        changes, swLat, swLng, neLat, neLng)
+                else:
+                    d['pokestops'] = active_pokestops.get_stops(
+                        swLat, swLng, neLat, neLng, timestamp=timestamp,
+                        stream=stream)
                 if newArea:
-                    d['pokestops'] = d['pokestops'] + (
-                        Pokestop.get_stops(swLat, swLng, neLat, neLng,
-                                           oSwLat=oSwLat, oSwLng=oSwLng,
-                                           oNeLat=oNeLat, oNeLng=oNeLng,
-                                           lured=luredonly))
+                    d['pokestops'] = chain(d['pokestops'], (
+                        active_pokestops.get_stops(
+                            swLat, swLng, neLat, neLng,
+                            oSwLat=oSwLat, oSwLng=oSwLng,
+                            oNeLat=oNeLat, oNeLng=oNeLng,
+                            lured=luredonly, stream=stream)))
 
         if request.args.get('gyms', 'true') == 'true' and not args.no_gyms:
             if lastgyms != 'true':
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
+                d['gyms'] = active_gyms.get_gyms(swLat, swLng, neLat, neLng)
             else:
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng,
-                                         timestamp=timestamp)
+                if changes is not None:
+                    d['gyms'] = self.live_cache.get_changed_gyms(
+                        changes, swLat, swLng, neLat, neLng)
+                else:
+                    d['gyms'] = active_gyms.get_gyms(
+                        swLat, swLng, neLat, neLng, timestamp=timestamp)
                 if newArea:
                     d['gyms'].update(
-                        Gym.get_gyms(swLat, swLng, neLat, neLng,
-                                     oSwLat=oSwLat, oSwLng=oSwLng,
-                                     oNeLat=oNeLat, oNeLng=oNeLng))
+                        active_gyms.get_gyms(swLat, swLng, neLat, neLng,
+                                             oSwLat=oSwLat, oSwLng=oSwLng,
+                                             oNeLat=oNeLat, oNeLng=oNeLng))
 
         if request.args.get('scanned', 'true') == 'true':
             if lastslocs != 'true':
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
-                                                          neLat, neLng)
+                d['scanned'] = ScannedLocation.get_recent(
+                    swLat, swLng, neLat, neLng, stream=stream)
             else:
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng,
-                                                          neLat, neLng,
-                                                          timestamp=timestamp)
+                d['scanned'] = ScannedLocation.get_recent(
+                    swLat, swLng, neLat, neLng, timestamp=timestamp,
+                    stream=stream)
                 if newArea:
-                    d['scanned'] = d['scanned'] + ScannedLocation.get_recent(
-                        swLat, swLng, neLat, neLng, oSwLat=oSwLat,
-                        oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng)
+                    d['scanned'] = chain(d['scanned'], (
+                        ScannedLocation.get_recent(
+                            swLat, swLng, neLat, neLng, oSwLat=oSwLat,
+                            oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng,
+                            stream=stream)))
 
         if request.args.get('seen', 'false') == 'true':
             d['seen'] = Pokemon.get_seen(int(request.args.get('duration')))
@@ -396,6 +448,10 @@ class Pogom(Flask):
                   args.status_page_password):
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
+
+        if stream or compact:
+            return json_response(d, map_data_keys, stream, compact)
+
         return jsonify(d)
 
     def loc(self):
@@ -432,6 +488,7 @@ class Pogom(Flask):
     def list_pokemon(self):
         # todo: Check if client is Android/iOS/Desktop for geolink, currently
         # only supports Android.
+        args = get_args()
         pokemon_list = []
 
         # Allow client to specify location.
@@ -439,7 +496,10 @@ class Pogom(Flask):
         lon = request.args.get('lon', self.current_location[1], type=float)
         origin_point = LatLng.from_degrees(lat, lon)
 
-        for pokemon in Pokemon.get_active(None, None, None, None):
+        # The list is sorted by distance, so only the full rows are
+        # streamed off the cursor and the page is rendered while it's sent.
+        for pokemon in Pokemon.get_active(None, None, None, None,
+                                          stream=args.stream_map_data):
             pokemon_point = LatLng.from_degrees(pokemon['latitude'],
                                                 pokemon['longitude'])
             diff = pokemon_point - origin_point
@@ -466,18 +526,23 @@ class Pogom(Flask):
             }
             pokemon_list.append((entry, entry['distance']))
         pokemon_list = [y[0] for y in sorted(pokemon_list, key=lambda x: x[1])]
-        args = get_args()
         visibility_flags = {
             'custom_css': args.custom_css,
             'custom_js': args.custom_js
         }
+        context = {
+            'pokemon_list': pokemon_list,
+            'origin_lat': lat,
+            'origin_lng': lon,
+            'show': visibility_flags
+        }
 
-        return render_template('mobile_list.html',
-                               pokemon_list=pokemon_list,
-                               origin_lat=lat,
-                               origin_lng=lon,
-                               show=visibility_flags
-                               )
+        if args.stream_map_data:
+            self.update_template_context(context)
+            template = self.jinja_env.get_template('mobile_list.html')
+            return Response(stream_with_context(template.generate(context)))
+
+        return render_template('mobile_list.html', **context)
 
     def get_stats(self):
         args = get_args()
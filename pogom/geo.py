@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import math
+
+from cHaversine import haversine
+
+# NumPy is optional, the distances to many locations are computed one by one
+# without it.
+try:
+    import numpy
+except ImportError:
+    pass
+
+# Radius of the earth in km of the equirectangular approximation, and in
+# meters and degrees to radians of cHaversine's haversine().
+EQUI_RECT_RADIUS = 6371
+HAVERSINE_RADIUS = 6367444.7
+HAVERSINE_RADIANS = 0.0174532925
+
+
+# Return equirectangular approximation distance in km.
+def equi_rect_distance(loc1, loc2):
+    r = EQUI_RECT_RADIUS
+    lat1 = math.radians(loc1[0])
+    lat2 = math.radians(loc2[0])
+    x = (math.radians(loc2[1]) - math.radians(loc1[1])
+         ) * math.cos(0.5 * (lat2 + lat1))
+    y = lat2 - lat1
+    return r * math.sqrt(x * x + y * y)
+
+
+def equi_rect_distance_m(loc1, loc2):
+    return equi_rect_distance(loc1, loc2) * 1000
+
+
+# Return haversine distance in meters.
+def haversine_distance_m(pos1, pos2):
+    return haversine((tuple(pos1))[0:2], (tuple(pos2))[0:2])
+
+
+# Distances in meters from pos to each of the locations, as a list.
+def equi_rect_distances_m(pos, locations):
+    if 'numpy' not in sys.modules:
+        return [equi_rect_distance_m(pos, loc) for loc in locations]
+    lats, lngs = _columns(locations)
+    return _equi_rect_m(float(pos[0]), float(pos[1]), lats, lngs).tolist()
+
+
+def haversine_distances_m(pos, locations):
+    if 'numpy' not in sys.modules:
+        return [haversine_distance_m(pos, loc) for loc in locations]
+    lats, lngs = _columns(locations)
+    return _haversine_m(float(pos[0]), float(pos[1]), lats, lngs).tolist()
+
+
+# Distances in meters from each of the locations to each of the others, as
+# a list of rows.
+def equi_rect_distance_matrix_m(locations, others):
+    if 'numpy' not in sys.modules:
+        return [equi_rect_distances_m(loc, others) for loc in locations]
+    lats, lngs = _columns(locations)
+    other_lats, other_lngs = _columns(others)
+    return _equi_rect_m(lats[:, None], lngs[:, None], other_lats,
+                        other_lngs).tolist()
+
+
+def haversine_distance_matrix_m(locations, others):
+    if 'numpy' not in sys.modules:
+        return [haversine_distances_m(loc, others) for loc in locations]
+    lats, lngs = _columns(locations)
+    other_lats, other_lngs = _columns(others)
+    return _haversine_m(lats[:, None], lngs[:, None], other_lats,
+                        other_lngs).tolist()
+
+
+# Indexes of the locations closer than m meters to pos, nearest first, and
+# their equirectangular distances.
+def nearest_within_m(pos, locations, m):
+    distances = equi_rect_distances_m(pos, locations)
+    nearest = sorted((d, idx) for idx, d in enumerate(distances) if d < m)
+    return [idx for d, idx in nearest], [d for d, idx in nearest]
+
+
+def _columns(locations):
+    lats = numpy.array([loc[0] for loc in locations], dtype=float)
+    lngs = numpy.array([loc[1] for loc in locations], dtype=float)
+    return lats, lngs
+
+
+# Same as equi_rect_distance_m(), on arrays.
+def _equi_rect_m(lat1, lng1, lat2, lng2):
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    x = (numpy.radians(lng2) - numpy.radians(lng1)) * numpy.cos(
+        0.5 * (lat2 + lat1))
+    y = lat2 - lat1
+    return EQUI_RECT_RADIUS * numpy.sqrt(x * x + y * y) * 1000
+
+
+# Same as haversine_distance_m(), on arrays.
+def _haversine_m(lat1, lng1, lat2, lng2):
+    phi1 = lat1 * HAVERSINE_RADIANS
+    phi2 = lat2 * HAVERSINE_RADIANS
+    dphi = phi2 - phi1
+    dtheta = (lng2 - lng1) * HAVERSINE_RADIANS
+    a = (numpy.sin(dphi / 2) ** 2 +
+         numpy.cos(phi1) * numpy.cos(phi2) * numpy.sin(dtheta / 2) ** 2)
+    return HAVERSINE_RADIUS * 2 * numpy.arctan2(numpy.sqrt(a),
+                                                numpy.sqrt(1 - a))
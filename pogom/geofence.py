@@ -1,158 +1,349 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import sys
+import re
+import math
 import timeit
 import logging
+import traceback
 
-from .utils import get_args
+from collections import defaultdict
+
+from .polygon import PreparedPolygon
 
 log = logging.getLogger(__name__)
 
-args = get_args()
-
-# Trying to import matplotlib, which is not compatible with all hardware.
-# Matlplotlib is faster for big calculations.
-try:
-    from matplotlib.path import Path
-except ImportError as e:
-    # Pass as this is an optional requirement. We're going to check later if it
-    # was properly imported and only use it if it's installed.
-    pass
-
-
-class Geofences:
-    def __init__(self):
-        self.geofenced_areas = []
-        self.excluded_areas = []
-        self.use_matplotlib = 'matplotlib' in sys.modules
-
-        if args.geofence_file or args.geofence_excluded_file:
-            log.info('Loading geofenced or excluded areas.')
-            self.geofenced_areas = self.parse_geofences_file(
-                args.geofence_file, excluded=False)
-            self.excluded_areas = self.parse_geofences_file(
-                args.geofence_excluded_file, excluded=True)
-            log.info('Loaded %d geofenced and %d excluded areas.',
-                     len(self.geofenced_areas),
-                     len(self.excluded_areas))
+
+def is_inside_box(pos, box):
+    return is_inside_box_coords(pos, box[0], box[1])
+
+
+def is_inside_box_coords(pos, top_left, bottom_right):
+    latmatch = top_left[0] >= pos[0] >= bottom_right[0]
+    longmatch = top_left[1] <= pos[1] <= bottom_right[1]
+    return latmatch and longmatch
+
+
+class Geofence(object):
+    # Expects points to be (lat, lng) pairs.
+    def __init__(self, name, points, excluded=False):
+        self.name = name
+        self.excluded = excluded
+        self.__points = points
+
+        self.__min_x = self.__max_x = points[0][0] if points else 0
+        self.__min_y = self.__max_y = points[0][1] if points else 0
+        for p in points:
+            self.__min_x = min(p[0], self.__min_x)
+            self.__max_x = max(p[0], self.__max_x)
+            self.__min_y = min(p[1], self.__min_y)
+            self.__max_y = max(p[1], self.__max_y)
+        self.__polygon = None
+
+    def polygon(self):
+        # Prepared on first use, most loaded fences are filtered out.
+        if self.__polygon is None:
+            self.__polygon = PreparedPolygon(self.__points)
+        return self.__polygon
+
+    def box(self):
+        return (self.__max_x, self.__max_y), (self.__min_x, self.__min_y)
+
+    def contains(self, x, y):
+        return self.polygon().contains(x, y)
+
+    def contains_many(self, xs, ys):
+        return self.polygon().contains_many(xs, ys)
+
+    def contains_fort(self, fort):
+        if isinstance(fort, dict):
+            return self.contains(fort["latitude"], fort["longitude"])
+        else:
+            return self.contains(fort.latitude, fort.longitude)
+
+    def get_name(self):
+        return self.name
+
+    def __str__(self):
+        return self.name
+
+
+class BoxIndex(object):
+    '''
+    R-tree of the bounding boxes of fences, packed once with the
+    Sort-Tile-Recursive algorithm. Finds the fences whose box contains a
+    point in logarithmic time.
+    '''
+
+    # Children of each node.
+    node_size = 16
+
+    def __init__(self, boxes):
+        # Nodes are (min_x, min_y, max_x, max_y, index, children), leaves
+        # have the index of their box and no children.
+        nodes = [(min_x, min_y, max_x, max_y, i, None)
+                 for i, ((max_x, max_y), (min_x, min_y)) in enumerate(boxes)]
+        while len(nodes) > self.node_size:
+            nodes = self._pack(nodes)
+        self.roots = nodes
+
+    def _pack(self, nodes):
+        size = self.node_size
+        pages = int(math.ceil(len(nodes) / float(size)))
+        per_slice = int(math.ceil(math.sqrt(pages))) * size
+        nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+        parents = []
+        for start in range(0, len(nodes), per_slice):
+            column = sorted(nodes[start:start + per_slice],
+                            key=lambda n: n[1] + n[3])
+            for first in range(0, len(column), size):
+                children = column[first:first + size]
+                parents.append((min(n[0] for n in children),
+                                min(n[1] for n in children),
+                                max(n[2] for n in children),
+                                max(n[3] for n in children),
+                                None, children))
+        return parents
+
+    # Returns the indexes of the boxes containing the point, in order.
+    def query(self, x, y):
+        result = []
+        stack = list(self.roots)
+        while stack:
+            min_x, min_y, max_x, max_y, index, children = stack.pop()
+            if x < min_x or x > max_x or y < min_y or y > max_y:
+                continue
+            if children is None:
+                result.append(index)
+            else:
+                stack.extend(children)
+        result.sort()
+        return result
+
+
+class Geofences(object):
+    '''
+    Named fences, and areas excluded from them, indexed by their bounding
+    boxes. A point is within the fences if it's in one of them, or if there
+    are none, and not in an excluded area. When fences overlap, the first
+    one in the file is the one a point is in.
+    '''
+
+    def __init__(self, fences, excluded=()):
+        self.fences = list(fences)
+        self.excluded = list(excluded)
+        self.index = BoxIndex([fence.box() for fence in self.fences])
+        self.excluded_index = BoxIndex([area.box()
+                                        for area in self.excluded])
 
     def is_enabled(self):
-        return (self.geofenced_areas or self.excluded_areas)
+        return bool(self.fences or self.excluded)
+
+    def box(self):
+        lats = []
+        lngs = []
+        for fence in self.fences:
+            (max_lat, max_lng), (min_lat, min_lng) = fence.box()
+            lats += [max_lat, min_lat]
+            lngs += [max_lng, min_lng]
+        return (max(lats), min(lngs)), (min(lats), max(lngs))
+
+    def within_fences(self, latitude, longitude):
+        if self._containing(self.excluded, self.excluded_index, latitude,
+                            longitude):
+            return False
+        if len(self.fences) == 0:
+            return True
+        return bool(self._containing(self.fences, self.index, latitude,
+                                     longitude))
+
+    def within_fences_many(self, latitudes, longitudes):
+        excluded = self._contain_many(self.excluded, self.excluded_index,
+                                      latitudes, longitudes)
+        if len(self.fences) == 0:
+            return [not e for e in excluded]
+        inside = self._contain_many(self.fences, self.index, latitudes,
+                                    longitudes)
+        return [i and not e for i, e in zip(inside, excluded)]
 
+    def fence_name(self, lat, lng):
+        names = self.fence_names(lat, lng, first=True)
+        return names[0] if names else None
+
+    def fence_names(self, lat, lng, first=False):
+        if self._containing(self.excluded, self.excluded_index, lat, lng):
+            return []
+        return [fence.name for fence in
+                self._containing(self.fences, self.index, lat, lng, first)]
+
+    def pos_within_fences(self, pos):
+        return self.within_fences(pos[0], pos[1])
+
+    def filter_fence_names(self, fence_names):
+        if fence_names is not None and len(fence_names) > 0:
+            fences_to_use = []
+            for fence in self.fences:
+                if fence.name in fence_names:
+                    fences_to_use.append(fence)
+            if len(fence_names) != len(fences_to_use):
+                raise ValueError(
+                    "One or more required fences is missing, required {} "
+                    "found only {}".format(str(fence_names),
+                                           str(len(fences_to_use))))
+            log.info("Using geofences {}".format(
+                [str(fence) for fence in fences_to_use]))
+            return Geofences(fences_to_use, self.excluded)
+        else:
+            return self
+
+    def filter_forts(self, gyms):
+        inside = self.within_fences_many([loc["latitude"] for loc in gyms],
+                                         [loc["longitude"] for loc in gyms])
+        result = [loc for loc, within in zip(gyms, inside) if within]
+        log.info("There are {} stops within fence".format(str(len(result))))
+        return result
+
+    # Geofences the hex locations, as (lat, lng, alt) tuples, or the
+    # spawnpoints of the spawnpoint scanner, as dicts.
     def get_geofenced_coordinates(self, coordinates):
-        log.info('Using matplotlib: %s.', self.use_matplotlib)
         log.info('Found %d coordinates to geofence.', len(coordinates))
-        geofenced_coordinates = []
         startTime = timeit.default_timer()
-        for c in coordinates:
-            # Coordinate is not valid if in one excluded area.
-            if self._is_excluded(c):
-                continue
+        if coordinates and isinstance(coordinates[0], dict):
+            lats = [c['lat'] for c in coordinates]
+            lngs = [c['lng'] for c in coordinates]
+        else:
+            lats = [c[0] for c in coordinates]
+            lngs = [c[1] for c in coordinates]
 
-            # Coordinate is geofenced if in one geofenced area.
-            if self.geofenced_areas:
-                for va in self.geofenced_areas:
-                    if self._in_area(c, va):
-                        geofenced_coordinates.append(c)
-                        break
-            else:
-                geofenced_coordinates.append(c)
+        inside = self.within_fences_many(lats, lngs)
+        geofenced_coordinates = [c for c, within in zip(coordinates, inside)
+                                 if within]
 
         elapsedTime = timeit.default_timer() - startTime
         log.info('Geofenced to %s coordinates in %.2fs.',
                  len(geofenced_coordinates), elapsedTime)
         return geofenced_coordinates
 
-    def _is_excluded(self, coordinate):
-        for ea in self.excluded_areas:
-            if self._in_area(coordinate, ea):
-                return True
+    # Returns the fences containing the point, or only the first one.
+    @staticmethod
+    def _containing(fences, index, lat, lng, first=True):
+        result = []
+        for i in index.query(lat, lng):
+            if fences[i].contains(lat, lng):
+                result.append(fences[i])
+                if first:
+                    break
+        return result
 
-        return False
+    # Returns whether any of the fences contains each of the points. Each
+    # fence tests the points in its box at once.
+    @staticmethod
+    def _contain_many(fences, index, lats, lngs):
+        candidates = defaultdict(list)
+        for k, (lat, lng) in enumerate(zip(lats, lngs)):
+            for i in index.query(lat, lng):
+                candidates[i].append(k)
 
-    def _in_area(self, coordinate, area):
-        if args.spawnpoint_scanning:
-            point = {'lat': coordinate['lat'], 'lon': coordinate['lng']}
-        else:
-            point = {'lat': coordinate[0], 'lon': coordinate[1]}
-        polygon = area['polygon']
-        if self.use_matplotlib:
-            return self.is_point_in_polygon_matplotlib(point, polygon)
-        else:
-            return self.is_point_in_polygon_custom(point, polygon)
+        result = [False] * len(lats)
+        for i, points in candidates.items():
+            inside = fences[i].contains_many([lats[k] for k in points],
+                                             [lngs[k] for k in points])
+            for k, within in zip(points, inside):
+                if within:
+                    result[k] = True
+        return result
 
-    @staticmethod
-    def parse_geofences_file(geofence_file, excluded):
-        geofences = []
-        # Read coordinates of excluded areas from file.
-        if geofence_file:
-            with open(geofence_file) as f:
-                for line in f:
-                    line = line.strip()
-                    if len(line) == 0:  # Empty line.
-                        continue
-                    elif line.startswith("["):  # Name line.
-                        name = line.replace("[", "").replace("]", "")
-                        geofences.append({
-                            'excluded': excluded,
-                            'name': name,
-                            'polygon': []
-                        })
-                        log.debug('Found geofence: %s.', name)
-                    else:  # Coordinate line.
-                        lat, lon = line.split(",")
-                        LatLon = {'lat': float(lat), 'lon': float(lon)}
-                        geofences[-1]['polygon'].append(LatLon)
 
-        return geofences
+def within_fences(latitude, longitude, fences):
+    if len(fences) == 0:
+        return True
+    for fence in fences:
+        if fence.contains(latitude, longitude):
+            return True
+    return False
 
-    @staticmethod
-    def is_point_in_polygon_matplotlib(point, polygon):
-        pointTuple = (point['lat'], point['lon'])
-        polygonTupleList = []
-        for c in polygon:
-            coordinateTuple = (c['lat'], c['lon'])
-            polygonTupleList.append(coordinateTuple)
 
-        polygonTupleList.append(polygonTupleList[0])
-        path = Path(polygonTupleList)
-        return path.contains_point(pointTuple)
+def filter_for_geofence(gyms, fence_file, fence_name):
+    fences_to_use = get_geofences(fence_file, fence_name)
+    inside = fences_to_use.within_fences_many(
+        [loc["latitude"] for loc in gyms], [loc["longitude"] for loc in gyms])
+    return [loc for loc, within in zip(gyms, inside) if within]
 
-    @staticmethod
-    def is_point_in_polygon_custom(point, polygon):
-        # Initialize first coordinate as default.
-        maxLat = polygon[0]['lat']
-        minLat = polygon[0]['lat']
-        maxLon = polygon[0]['lon']
-        minLon = polygon[0]['lon']
-
-        for coords in polygon:
-            maxLat = max(coords['lat'], maxLat)
-            minLat = min(coords['lat'], minLat)
-            maxLon = max(coords['lon'], maxLon)
-            minLon = min(coords['lon'], minLon)
-
-        if ((point['lat'] > maxLat) or (point['lat'] < minLat) or
-                (point['lon'] > maxLon) or (point['lon'] < minLon)):
-            return False
 
-        inside = False
-        lat1, lon1 = polygon[0]['lat'], polygon[0]['lon']
-        N = len(polygon)
-        for n in range(1, N+1):
-            lat2, lon2 = polygon[n % N]['lat'], polygon[n % N]['lon']
-            if (min(lon1, lon2) < point['lon'] <= max(lon1, lon2) and
-                    point['lat'] <= max(lat1, lat2)):
-                        if lon1 != lon2:
-                            latIntersection = (
-                                (point['lon'] - lon1) *
-                                (lat2 - lat1) / (lon2 - lon1) +
-                                lat1)
-
-                        if lat1 == lat2 or point['lat'] <= latIntersection:
-                            inside = not inside
-
-            lat1, lon1 = lat2, lon2
-
-        return inside
+def group_by_geofence(gyms, fence_file, fence_name):
+    fences_to_use = get_geofences(fence_file, fence_name)
+    result = defaultdict(list)
+
+    for loc in gyms:
+        fence_name = fences_to_use.fence_name(loc["latitude"],
+                                              loc["longitude"])
+        if fence_name:
+            result[fence_name].append(
+                str(loc["latitude"]) + "," + str(loc["longitude"]))
+
+    return result
+
+
+def get_geofences(fence_file, fence_names, excluded_file=None):
+    fences = []
+    excluded = []
+    if fence_file:
+        fences = load_geofence_file(fence_file)
+        if not fences:
+            log.error("No geofences in file or file {} missing ?".format(
+                fence_file))
+    if excluded_file:
+        excluded = load_geofence_file(excluded_file, excluded=True)
+        if not excluded:
+            log.error("No excluded areas in file or file {} missing "
+                      "?".format(excluded_file))
+    if fences is None or excluded is None:
+        raise ValueError("Unable to load geofences")
+    geofences = Geofences(fences, excluded)
+    if excluded_file:
+        log.info('Loaded %d geofenced and %d excluded areas.', len(fences),
+                 len(excluded))
+    return geofences.filter_fence_names(fence_names)
+
+
+# Load in a geofence file
+def load_geofence_file(file_path, excluded=False):
+    try:
+        geofences = []
+        name_pattern = re.compile("(?<=\[)([^]]+)(?=\])")
+        coor_patter = re.compile("[-+]?[0-9]*\.?[0-9]*" + "[ \t]*,[ \t]*" +
+                                 "[-+]?[0-9]*\.?[0-9]*")
+        with open(file_path, 'r') as f:
+            lines = f.read().splitlines()
+        name = "geofence"
+        points = []
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            match_name = name_pattern.search(line)
+            if match_name:
+                if len(points) > 0:
+                    geofences.append(Geofence(name, points, excluded))
+                    log.info("Geofence {} loaded.".format(name))
+                    points = []
+                name = match_name.group(0)
+            elif coor_patter.match(line):
+                lat, lng = list(map(float, line.split(",")))
+                points.append([lat, lng])
+            else:
+                log.error("Geofence was unable to parse this line: "
+                          "{}".format(line))
+                log.error("All lines should be either '[name]' or "
+                          "'lat,lng'.")
+        if len(points) > 0:
+            geofences.append(Geofence(name, points, excluded))
+            log.info("Geofence {} added.".format(name))
+        return geofences
+    except IOError:
+        log.error("IOError: Please make sure a file with read/write "
+                  "permissions exsist at {}".format(file_path))
+    except Exception as e:
+        log.error("Encountered error while loading Geofence: {}: {}".format(
+            type(e).__name__, e))
+    log.debug("Stack trace: \n {}".format(traceback.format_exc()))
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import zlib
+
+from flask import Response, current_app, request, stream_with_context
+
+# Encoded chunks are joined up to this size before they are sent.
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_rows(rows, encoder, compact=False):
+    '''
+    Encodes a list, iterator or dict of row dicts one row at a time.
+
+    Compact rows are sent as {"fields": [...], "rows": [[...], ...]}: the
+    field names of the first row once, then one list of values per row. A
+    dict of rows is sent as its values in compact form.
+    '''
+    if compact:
+        if isinstance(rows, dict):
+            rows = rows.values()
+        fields = None
+        for row in rows:
+            if fields is None:
+                fields = list(row)
+                yield '{{"fields":{},"rows":['.format(encoder.encode(fields))
+            else:
+                yield ','
+            yield encoder.encode([row.get(field) for field in fields])
+        yield '{"fields":[],"rows":[]}' if fields is None else ']}'
+    elif isinstance(rows, dict):
+        yield '{'
+        for i, (key, row) in enumerate(rows.items()):
+            yield '{}{}:{}'.format(',' if i else '', encoder.encode(key),
+                                   encoder.encode(row))
+        yield '}'
+    else:
+        yield '['
+        for i, row in enumerate(rows):
+            if i:
+                yield ','
+            yield encoder.encode(row)
+        yield ']'
+
+
+def iter_json(d, encoder, row_keys, compact=False):
+    yield '{'
+    for i, (key, value) in enumerate(d.items()):
+        yield '{}{}:'.format(',' if i else '', encoder.encode(key))
+        if key in row_keys:
+            for chunk in iter_rows(value, encoder, compact):
+                yield chunk
+        else:
+            yield encoder.encode(value)
+    yield '}'
+
+
+def join_chunks(chunks, size=CHUNK_SIZE):
+    buf = []
+    buf_size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def json_response(d, row_keys, stream=False, compact=False):
+    '''
+    JSON response for d, with the values of row_keys encoded row by row.
+
+    A streamed response is encoded while it is sent, so the rows in d can be
+    iterators still reading from the database. It is gzipped here since
+    flask-compress would buffer the whole response.
+    '''
+    encoder = current_app.json_encoder(separators=(',', ':'))
+    chunks = iter_json(d, encoder, row_keys, compact)
+    if not stream:
+        return Response(''.join(chunks), mimetype='application/json')
+
+    chunks = join_chunks(chunks)
+    headers = {}
+    if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), headers=headers,
+                    mimetype='application/json')
@@ -0,0 +1,475 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import time
+
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from datetime import datetime
+from threading import Lock
+from timeit import default_timer
+
+from s2sphere import CellId, LatLng, LatLngRect, RegionCoverer
+
+from .models import (Pokemon, Pokestop, Gym, Raid, GymDetails, GymMember,
+                     GymPokemon, Trainer)
+from .transform import transform_from_wgs_to_gcj
+from .utils import (get_args, get_pokemon_details, get_pokemon_name,
+                    get_pokemon_types)
+
+log = logging.getLogger(__name__)
+
+args = get_args()
+
+# Change kind and key column of the models tracked in the change buffer.
+change_keys = {
+    Pokemon: ('pokemon', 'encounter_id'),
+    Pokestop: ('pokestop', 'pokestop_id'),
+    Gym: ('gym', 'gym_id'),
+    Raid: ('gym', 'gym_id'),
+    GymDetails: ('gym', 'gym_id')
+}
+
+# Columns returned by Pokestop.get_stops().
+pokestop_columns = ('active_fort_modifier', 'enabled', 'latitude',
+                    'longitude', 'last_modified', 'lure_expiration',
+                    'pokestop_id')
+
+
+class CellIndex(object):
+    '''
+    Objects bucketed by S2 cell at a fixed level. A viewport is covered by a
+    handful of (coarser) cells, each of which maps to a contiguous range of
+    bucket cell ids.
+    '''
+
+    def __init__(self, level=13, max_cells=16):
+        self.level = level
+        self.max_cells = max_cells
+        self.buckets = {}
+        # Sorted ids of all non-empty buckets.
+        self.cell_ids = []
+        self.key_cells = {}
+
+    def __len__(self):
+        return len(self.key_cells)
+
+    def add(self, key, lat, lng, obj):
+        cell_id = CellId.from_lat_lng(
+            LatLng.from_degrees(lat, lng)).parent(self.level).id()
+        if self.key_cells.get(key, cell_id) != cell_id:
+            self.remove(key)
+
+        bucket = self.buckets.get(cell_id)
+        if bucket is None:
+            bucket = self.buckets[cell_id] = {}
+            insort(self.cell_ids, cell_id)
+        bucket[key] = (lat, lng, obj)
+        self.key_cells[key] = cell_id
+
+    def remove(self, key):
+        cell_id = self.key_cells.pop(key, None)
+        if cell_id is None:
+            return
+
+        bucket = self.buckets[cell_id]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[cell_id]
+            del self.cell_ids[bisect_left(self.cell_ids, cell_id)]
+
+    def get(self, key):
+        cell_id = self.key_cells.get(key)
+        if cell_id is None:
+            return None
+        return self.buckets[cell_id][key]
+
+    def all(self):
+        for bucket in self.buckets.values():
+            for entry in bucket.values():
+                yield entry
+
+    def within(self, swLat, swLng, neLat, neLng):
+        rect = LatLngRect.from_point_pair(LatLng.from_degrees(swLat, swLng),
+                                          LatLng.from_degrees(neLat, neLng))
+        coverer = RegionCoverer()
+        coverer.max_level = self.level
+        coverer.max_cells = self.max_cells
+
+        for cell in coverer.get_covering(rect):
+            last = cell.range_max().id()
+            i = bisect_left(self.cell_ids, cell.range_min().id())
+            while i < len(self.cell_ids) and self.cell_ids[i] <= last:
+                for entry in self.buckets[self.cell_ids[i]].values():
+                    lat, lng = entry[0], entry[1]
+                    if swLat <= lat <= neLat and swLng <= lng <= neLng:
+                        yield entry
+                i += 1
+
+
+def in_box(lat, lng, box):
+    return box[0] <= lat <= box[2] and box[1] <= lng <= box[3]
+
+
+def to_box(swLat, swLng, neLat, neLng):
+    if not (swLat and swLng and neLat and neLng):
+        return None
+    return (float(swLat), float(swLng), float(neLat), float(neLng))
+
+
+class LiveCache(object):
+    '''
+    In-process store of active Pokemon, Pokestops, gyms and raids, fed with
+    the same (model, data) batches parse_map() and parse_gyms() put on the
+    DB update queue. Answers the /raw_data map queries with the same
+    results as the Pokemon, Pokestop and Gym query methods.
+
+    Every change gets the next sequence number and is kept in a ring buffer,
+    so a client that has seen sequence N only needs the objects changed
+    since then.
+    '''
+
+    # Seconds defender details wait for their GymMember rows before they
+    # are dropped.
+    defender_ttl = 300
+
+    def __init__(self, max_changes=100000):
+        self.lock = Lock()
+        # Sequence numbers restart with the process, the epoch tells a
+        # client's token from a previous run apart.
+        self.epoch = int(time.time())
+        self.seq = 0
+        # Ring buffer of (seq, kind, key).
+        self.changes = deque(maxlen=max_changes)
+        self.pokemon = CellIndex()
+        # Heap of (disappear_time, encounter_id).
+        self.pokemon_expiry = []
+        self.pokestops = CellIndex()
+        self.gyms = CellIndex()
+        self.gym_names = {}
+        self.gym_members = {}
+        self.raids = {}
+        # Defender details are only kept until their GymMember rows arrive,
+        # as (time added, row) in the order they were added.
+        self.gym_pokemon = OrderedDict()
+        self.trainers = OrderedDict()
+
+        self.ingesters = {
+            Pokemon: self._add_pokemon,
+            Pokestop: self._add_pokestop,
+            Gym: self._add_gym,
+            Raid: self._add_raid,
+            GymDetails: self._add_gym_details,
+            GymPokemon: self._add_gym_pokemon,
+            Trainer: self._add_trainer
+        }
+
+    def load(self):
+        now_date = datetime.utcnow()
+        with Pokemon.database().execution_context():
+            pokemon = list(Pokemon
+                           .select()
+                           .where(Pokemon.disappear_time > now_date)
+                           .dicts())
+            pokestops = list(Pokestop.select().dicts())
+            gyms = Gym.get_gyms(None, None, None, None)
+
+        with self.lock:
+            for p in pokemon:
+                self._add_pokemon(p)
+            for p in pokestops:
+                self._add_pokestop(p)
+            for gym_id, g in gyms.items():
+                self.gym_names[gym_id] = g.pop('name')
+                self.gym_members[gym_id] = g.pop('pokemon')
+                raid = g.pop('raid')
+                if raid:
+                    self.raids[gym_id] = raid
+                self.gyms.add(gym_id, g['latitude'], g['longitude'], g)
+
+        log.info('Live cache loaded %d Pokemon, %d pokestops and %d gyms.',
+                 len(self.pokemon), len(self.pokestops), len(self.gyms))
+
+    def ingest(self, model, data):
+        with self.lock:
+            self._ingest(model, data)
+
+    # Ingests (model, data) batches that belong together, like the gym
+    # details, defenders, trainers and members of one parse_gyms(), at once
+    # and in order, so queries never see part of them.
+    def ingest_batches(self, batches):
+        with self.lock:
+            for model, data in batches:
+                self._ingest(model, data)
+
+    def _ingest(self, model, data):
+        if model is GymMember:
+            self._add_gym_members(list(data.values()))
+            for m in data.values():
+                self._changed('gym', m['gym_id'])
+            return
+
+        add = self.ingesters.get(model)
+        if add is None:
+            return
+
+        kind, key = change_keys.get(model, (None, None))
+        meta = model._meta
+        defaults = meta.get_default_dict()
+        for row in data.values():
+            add(dict((name, row.get(name, defaults.get(name)))
+                     for name in meta.sorted_field_names))
+            if kind:
+                self._changed(kind, row[key])
+
+    def _changed(self, kind, key):
+        self.seq += 1
+        self.changes.append((self.seq, kind, key))
+
+    def token(self):
+        with self.lock:
+            return '{}-{}'.format(self.epoch, self.seq)
+
+    def changes_since(self, token):
+        '''
+        Returns the keys of all objects changed after a token returned by
+        token(), by kind, or None if the client needs a full resync because
+        the token is from another run or has fallen out of the buffer.
+        '''
+        try:
+            epoch, seq = [int(x) for x in token.split('-')]
+        except (AttributeError, ValueError):
+            return None
+
+        with self.lock:
+            oldest = self.changes[0][0] if self.changes else self.seq + 1
+            if epoch != self.epoch or seq > self.seq or seq < oldest - 1:
+                return None
+
+            changed = {'pokemon': set(), 'pokestop': set(), 'gym': set()}
+            for change_seq, kind, key in reversed(self.changes):
+                if change_seq <= seq:
+                    break
+                changed[kind].add(key)
+
+        return changed
+
+    def _add_pokemon(self, p):
+        (p['pokemon_name'], p['pokemon_rarity'],
+         p['pokemon_types']) = get_pokemon_details()[p['pokemon_id']]
+        lat, lng = p['latitude'], p['longitude']
+        if args.china:
+            p['latitude'], p['longitude'] = \
+                transform_from_wgs_to_gcj(lat, lng)
+
+        self.pokemon.add(p['encounter_id'], lat, lng, p)
+        heapq.heappush(self.pokemon_expiry,
+                       (p['disappear_time'], p['encounter_id']))
+
+    def _add_pokestop(self, p):
+        stop = dict((name, p[name]) for name in pokestop_columns)
+        lat, lng = stop['latitude'], stop['longitude']
+        if args.china:
+            stop['latitude'], stop['longitude'] = \
+                transform_from_wgs_to_gcj(lat, lng)
+
+        self.pokestops.add(stop['pokestop_id'], lat, lng,
+                           (p['last_updated'], stop))
+
+    def _add_gym(self, g):
+        self.gyms.add(g['gym_id'], g['latitude'], g['longitude'], g)
+
+    def _add_raid(self, r):
+        if r['pokemon_id']:
+            r['pokemon_name'] = get_pokemon_name(r['pokemon_id'])
+            r['pokemon_types'] = get_pokemon_types(r['pokemon_id'])
+        self.raids[r['gym_id']] = r
+
+    def _add_gym_details(self, d):
+        self.gym_names[d['gym_id']] = d['name']
+        # parse_gyms() replaces all members of a gym it has details for.
+        self.gym_members[d['gym_id']] = []
+
+    def _add_gym_pokemon(self, p):
+        self._add_defender_detail(self.gym_pokemon, p['pokemon_uid'], p)
+
+    def _add_trainer(self, t):
+        self._add_defender_detail(self.trainers, t['name'], t)
+
+    # Adds to gym_pokemon or trainers, dropping the entries that never got
+    # their GymMember rows.
+    def _add_defender_detail(self, details, key, row):
+        now = default_timer()
+        details.pop(key, None)
+        details[key] = (now, row)
+        while details:
+            added, _ = next(iter(details.values()))
+            if now - added < self.defender_ttl:
+                break
+            details.popitem(last=False)
+
+    def _add_gym_members(self, members):
+        last_scanned = datetime.utcnow()
+        used_pokemon = set()
+        used_trainers = set()
+        for m in members:
+            p = self.gym_pokemon.get(m['pokemon_uid'])
+            if p is None:
+                continue
+            p = p[1]
+            trainer = self.trainers.get(p['trainer_name'])
+            trainer = trainer[1] if trainer else None
+            self.gym_members.setdefault(m['gym_id'], []).append({
+                'gym_id': m['gym_id'],
+                'pokemon_cp': p['cp'],
+                'cp_decayed': m['cp_decayed'],
+                'deployment_time': m['deployment_time'],
+                'last_scanned': m.get('last_scanned', last_scanned),
+                'pokemon_id': p['pokemon_id'],
+                'pokemon_name': get_pokemon_name(p['pokemon_id']),
+                'trainer_name': p['trainer_name'],
+                'trainer_level': trainer['level'] if trainer else None
+            })
+            used_pokemon.add(m['pokemon_uid'])
+            used_trainers.add(p['trainer_name'])
+
+        for uid in used_pokemon:
+            del self.gym_pokemon[uid]
+        for name in used_trainers:
+            self.trainers.pop(name, None)
+
+    def _expire_pokemon(self, now_date):
+        expiry = self.pokemon_expiry
+        while expiry and expiry[0][0] <= now_date:
+            disappear_time, encounter_id = heapq.heappop(expiry)
+            entry = self.pokemon.get(encounter_id)
+            # Skip heap entries outdated by a later sighting.
+            if entry is not None and entry[2]['disappear_time'] <= now_date:
+                self.pokemon.remove(encounter_id)
+
+    @staticmethod
+    def _select(index, box, old_box=None):
+        if box is None:
+            entries = index.all()
+        else:
+            entries = index.within(*box)
+
+        if old_box is None:
+            return [entry[2] for entry in entries]
+        return [entry[2] for entry in entries
+                if not in_box(entry[0], entry[1], old_box)]
+
+    @staticmethod
+    def _select_keys(index, keys, box):
+        entries = [index.get(key) for key in keys]
+        return [entry[2] for entry in entries if entry is not None and
+                (box is None or in_box(entry[0], entry[1], box))]
+
+    @staticmethod
+    def _pokestop_output(stop, now_date):
+        # Expired lures read as unlured, like clean_db_loop() leaves them.
+        if stop['lure_expiration'] and stop['lure_expiration'] < now_date:
+            stop = dict(stop, lure_expiration=None, active_fort_modifier=None)
+        return stop
+
+    def _gym_output(self, g):
+        g = dict(g)
+        gym_id = g['gym_id']
+        g['name'] = self.gym_names.get(gym_id)
+        g['pokemon'] = [p for p in self.gym_members.get(gym_id, ())
+                        if p['last_scanned'] > g['last_modified']]
+        g['raid'] = self.raids.get(gym_id)
+        return g
+
+    # The stream arguments match the model methods, rows are already in
+    # memory here.
+    def get_active(self, swLat, swLng, neLat, neLng, timestamp=0,
+                   oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None,
+                   stream=False):
+        box = to_box(swLat, swLng, neLat, neLng)
+        old_box = to_box(oSwLat, oSwLng, oNeLat, oNeLng)
+        with self.lock:
+            self._expire_pokemon(datetime.utcnow())
+            if box is None or timestamp > 0:
+                pokemon = self._select(self.pokemon, box)
+            else:
+                pokemon = self._select(self.pokemon, box, old_box)
+
+        if box is not None and timestamp > 0:
+            since = datetime.utcfromtimestamp(timestamp / 1000)
+            pokemon = [p for p in pokemon if p['last_modified'] > since]
+
+        return pokemon
+
+    def get_active_by_id(self, ids, swLat, swLng, neLat, neLng):
+        ids = set(ids)
+        return [p for p in self.get_active(swLat, swLng, neLat, neLng)
+                if p['pokemon_id'] in ids]
+
+    def get_stops(self, swLat, swLng, neLat, neLng, timestamp=0,
+                  oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None,
+                  lured=False, stream=False):
+        box = to_box(swLat, swLng, neLat, neLng)
+        old_box = to_box(oSwLat, oSwLng, oNeLat, oNeLng)
+        if box is None or timestamp > 0:
+            old_box = None
+
+        with self.lock:
+            entries = self._select(self.pokestops, box, old_box)
+
+        if box is not None and timestamp > 0:
+            since = datetime.utcfromtimestamp(timestamp / 1000)
+            entries = [e for e in entries if e[0] > since]
+
+        now_date = datetime.utcnow()
+        pokestops = []
+        for _, stop in entries:
+            stop = self._pokestop_output(stop, now_date)
+            if (box is not None and not timestamp and lured and
+                    stop['active_fort_modifier'] is None):
+                continue
+            pokestops.append(stop)
+
+        return pokestops
+
+    def get_gyms(self, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
+                 oSwLng=None, oNeLat=None, oNeLng=None):
+        box = to_box(swLat, swLng, neLat, neLng)
+        old_box = to_box(oSwLat, oSwLng, oNeLat, oNeLng)
+        if box is None or timestamp > 0:
+            old_box = None
+
+        with self.lock:
+            results = self._select(self.gyms, box, old_box)
+            if box is not None and timestamp > 0:
+                since = datetime.utcfromtimestamp(timestamp / 1000)
+                results = [g for g in results if g['last_scanned'] > since]
+
+            gyms = {}
+            for g in results:
+                gyms[g['gym_id']] = self._gym_output(g)
+
+        return gyms
+
+    def get_changed_pokemon(self, changes, swLat, swLng, neLat, neLng):
+        box = to_box(swLat, swLng, neLat, neLng)
+        with self.lock:
+            self._expire_pokemon(datetime.utcnow())
+            return self._select_keys(self.pokemon, changes['pokemon'], box)
+
+    def get_changed_stops(self, changes, swLat, swLng, neLat, neLng):
+        box = to_box(swLat, swLng, neLat, neLng)
+        with self.lock:
+            entries = self._select_keys(self.pokestops, changes['pokestop'],
+                                        box)
+
+        now_date = datetime.utcnow()
+        return [self._pokestop_output(stop, now_date) for _, stop in entries]
+
+    def get_changed_gyms(self, changes, swLat, swLng, neLat, neLng):
+        box = to_box(swLat, swLng, neLat, neLng)
+        with self.lock:
+            return dict((g['gym_id'], self._gym_output(g)) for g in
+                        self._select_keys(self.gyms, changes['gym'], box))
@@ -6,9 +6,13 @@ import itertools
 import calendar
 import sys
 import gc
+import os
+import json
 import time
 import geopy
 import math
+import hashlib
+import sqlite3
 
 from peewee import (InsertQuery, Check, CompositeKey, ForeignKeyField,
                     SmallIntegerField, IntegerField, CharField, DoubleField,
@@ -21,6 +25,11 @@ from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from playhouse.sqlite_ext import SqliteExtDatabase
 from datetime import datetime, timedelta
 from base64 import b64encode
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter
+from threading import Lock, Thread
+from queue import Queue, Empty
 from cachetools import TTLCache
 from cachetools import cached
 from timeit import default_timer
@@ -28,11 +37,11 @@ from timeit import default_timer
 from apiwrapper import EncounterPokemon
 from management_errors import GaveUp, GaveUpApiAction, NoMoreWorkers, TooFarAway, SkippedDueToOptional
 
-from .utils import (get_pokemon_name, get_pokemon_rarity, get_pokemon_types,
-                    get_args, cellid, in_radius, date_secs, clock_between,
-                    get_move_name, get_move_damage, get_move_energy,
-                    get_move_type, calc_pokemon_level)
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .utils import (get_pokemon_name, get_pokemon_types,
+                    get_pokemon_details, get_args, cellid, in_radius,
+                    date_secs, clock_between, get_move_name, get_move_damage,
+                    get_move_energy, get_move_type, calc_pokemon_level)
+from .transform import transform_many_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
 
 from .account import (check_login, setup_api,
@@ -47,7 +56,7 @@ args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
 
-db_schema_version = 20
+db_schema_version = 21
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
@@ -164,12 +173,34 @@ class LatLongModel(BaseModel):
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
         if args.china:
-            for result in results:
-                result['latitude'], result['longitude'] = \
-                    transform_from_wgs_to_gcj(
-                        result['latitude'], result['longitude'])
+            cls.transform_to_gcj(results)
         return results
 
+    @staticmethod
+    def transform_to_gcj(rows):
+        latitudes, longitudes = transform_many_from_wgs_to_gcj(
+            [r['latitude'] for r in rows], [r['longitude'] for r in rows])
+        for row, latitude, longitude in zip(rows, latitudes, longitudes):
+            row['latitude'] = latitude
+            row['longitude'] = longitude
+
+    # Completes a list of rows for the map, in one pass over all of them.
+    @classmethod
+    def add_details(cls, rows):
+        if args.china:
+            cls.transform_to_gcj(rows)
+        return rows
+
+    # Adds details to rows read off a cursor, a batch at a time.
+    @classmethod
+    def iter_with_details(cls, rows, batch_size=500):
+        rows = iter(rows)
+        batch = list(itertools.islice(rows, batch_size))
+        while batch:
+            for row in cls.add_details(batch):
+                yield row
+            batch = list(itertools.islice(rows, batch_size))
+
 
 class Pokemon(LatLongModel):
     # We are base64 encoding the ids delivered by the api
@@ -195,11 +226,25 @@ class Pokemon(LatLongModel):
         null=True, index=True, default=datetime.utcnow)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        # Map queries filter on time first, which leaves only the few
+        # active rows to be bounding-boxed from the same index.
+        indexes = ((('latitude', 'longitude'), False),
+                   (('disappear_time', 'latitude', 'longitude'), False),
+                   (('last_modified', 'latitude', 'longitude'), False),)
+
+    @classmethod
+    def add_details(cls, pokemon):
+        details = get_pokemon_details()
+        for p in pokemon:
+            (p['pokemon_name'], p['pokemon_rarity'],
+             p['pokemon_types']) = details[p['pokemon_id']]
+        if args.china:
+            cls.transform_to_gcj(pokemon)
+        return pokemon
 
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, stream=False):
         now_date = datetime.utcnow()
         query = Pokemon.select()
         if not (swLat and swLng and neLat and neLng):
@@ -244,20 +289,16 @@ class Pokemon(LatLongModel):
                               (Pokemon.longitude <= neLng))))
                      .dicts())
 
+        # Streamed rows are read off the cursor a batch at a time as the
+        # response is encoded.
+        if stream:
+            return Pokemon.iter_with_details(query.iterator())
+
         # Performance:  disable the garbage collector prior to creating a
         # (potentially) large dict with append().
         gc.disable()
 
-        pokemon = []
-        for p in list(query):
-
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemon.append(p)
+        pokemon = Pokemon.add_details(list(query))
 
         # Re-enable the GC.
         gc.enable()
@@ -287,15 +328,7 @@ class Pokemon(LatLongModel):
         # (potentially) large dict with append().
         gc.disable()
 
-        pokemon = []
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemon.append(p)
+        pokemon = Pokemon.add_details(list(query))
 
         # Re-enable the GC.
         gc.enable()
@@ -416,11 +449,13 @@ class Pokestop(LatLongModel):
         null=True, index=True, default=datetime.utcnow)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude'), False),
+                   (('last_updated', 'latitude', 'longitude'), False),)
 
     @staticmethod
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
+                  oSwLng=None, oNeLat=None, oNeLng=None, lured=False,
+                  stream=False):
 
         query = Pokestop.select(Pokestop.active_fort_modifier,
                                 Pokestop.enabled, Pokestop.latitude,
@@ -484,16 +519,14 @@ class Pokestop(LatLongModel):
                             (Pokestop.longitude <= neLng))
                      .dicts())
 
+        if stream:
+            return Pokestop.iter_with_details(query.iterator())
+
         # Performance:  disable the garbage collector prior to creating a
         # (potentially) large dict with append().
         gc.disable()
 
-        pokestops = []
-        for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokestops.append(p)
+        pokestops = Pokestop.add_details(list(query))
 
         # Re-enable the GC.
         gc.enable()
@@ -514,7 +547,8 @@ class Gym(LatLongModel):
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude'), False),
+                   (('last_scanned', 'latitude', 'longitude'), False),)
 
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
@@ -815,7 +849,8 @@ class ScannedLocation(LatLongModel):
     width = SmallIntegerField(default=0)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude'), False),
+                   (('last_modified', 'latitude', 'longitude'), False),)
         constraints = [Check('band1 >= -1'), Check('band1 < 3600'),
                        Check('band2 >= -1'), Check('band2 < 3600'),
                        Check('band3 >= -1'), Check('band3 < 3600'),
@@ -826,7 +861,7 @@ class ScannedLocation(LatLongModel):
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
-                   oSwLng=None, oNeLat=None, oNeLng=None):
+                   oSwLng=None, oNeLat=None, oNeLng=None, stream=False):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
         if timestamp > 0:
             query = (ScannedLocation
@@ -865,6 +900,9 @@ class ScannedLocation(LatLongModel):
                      .order_by(ScannedLocation.last_modified.asc())
                      .dicts())
 
+        if stream:
+            return query.iterator()
+
         return list(query)
 
     # DB format of a new location.
@@ -934,15 +972,20 @@ class ScannedLocation(LatLongModel):
     @staticmethod
     def link_spawn_points(scans, initial, spawn_points, distance,
                           scan_spawn_point, force=False):
+        # Sorted on latitude, so each cell only checks the spawnpoints of
+        # its band.
+        spawn_points = sorted(spawn_points, key=itemgetter('latitude'))
+        latitudes = [sp['latitude'] for sp in spawn_points]
         for cell, scan in scans.items():
             if initial[cell]['done'] and not force:
                 continue
             # Difference in degrees at the equator for 70m is actually 0.00063
             # degrees and gets smaller the further north or south you go
             deg_at_lat = 0.0007 / math.cos(math.radians(scan['loc'][0]))
-            for sp in spawn_points:
-                if (abs(sp['latitude'] - scan['loc'][0]) > 0.0008 or
-                        abs(sp['longitude'] - scan['loc'][1]) > deg_at_lat):
+            first = bisect_left(latitudes, scan['loc'][0] - 0.0008)
+            last = bisect_right(latitudes, scan['loc'][0] + 0.0008)
+            for sp in itertools.islice(spawn_points, first, last):
+                if abs(sp['longitude'] - scan['loc'][1]) > deg_at_lat:
                     continue
                 if in_radius((sp['latitude'], sp['longitude']),
                              scan['loc'], distance * 1000):
@@ -966,9 +1009,10 @@ class ScannedLocation(LatLongModel):
             result = list(query)
         return result
 
-    # Return list of dicts for upcoming valid band times.
+    # Return (spawnpoint id, cell id) pairs of the links of the spawnpoints
+    # of the hive's cells, to cells of the hive or of another active hive.
     @staticmethod
-    def get_cell_to_linked_spawn_points(cellids, location_change_date):
+    def get_spawn_point_links(cellids, location_change_date):
         # Get all spawnpoints from the hive's cells
         sp_from_cells = (ScanSpawnPoint
                          .select(ScanSpawnPoint.spawnpoint)
@@ -976,38 +1020,27 @@ class ScannedLocation(LatLongModel):
                          .alias('spcells'))
         # A new SL (new ones are created when the location changes) or
         # it can be a cell from another active hive
-        one_sp_scan = (
-            ScanSpawnPoint.select(
-                ScanSpawnPoint.spawnpoint,
-                fn.MAX(ScanSpawnPoint.scannedlocation).alias('cellid'))
-            .join(
-                sp_from_cells,
-                on=sp_from_cells.c.spawnpoint_id == ScanSpawnPoint.spawnpoint)
-            .join(
-                ScannedLocation,
-                on=(ScannedLocation.cellid == ScanSpawnPoint.scannedlocation))
-            .where(((ScannedLocation.last_modified >= (location_change_date)) &
-                    (ScannedLocation.last_modified >
-                     (datetime.utcnow() - timedelta(minutes=60)))) | (
-                         ScannedLocation.cellid << cellids))
-            .group_by(ScanSpawnPoint.spawnpoint).alias('maxscan'))
-        # As scan locations overlap,spawnpoints can belong to up to 3 locations
-        # This sub-query effectively assigns each SP to exactly one location.
-        ret = {}
-        with SpawnPoint.database().execution_context():
-            query = (SpawnPoint
-                     .select(SpawnPoint, one_sp_scan.c.cellid)
-                     .join(one_sp_scan, on=(SpawnPoint.id ==
-                                            one_sp_scan.c.spawnpoint_id))
-                     .where(one_sp_scan.c.cellid << cellids)
-                     .dicts())
-            spawns = list(query)
-            for item in spawns:
-                if item['cellid'] not in ret:
-                    ret[item['cellid']] = []
-                ret[item['cellid']].append(item)
-
-        return ret
+        with ScanSpawnPoint.database().execution_context():
+            query = (
+                ScanSpawnPoint.select(ScanSpawnPoint.spawnpoint,
+                                      ScanSpawnPoint.scannedlocation)
+                .join(
+                    sp_from_cells,
+                    on=(sp_from_cells.c.spawnpoint_id ==
+                        ScanSpawnPoint.spawnpoint))
+                .join(
+                    ScannedLocation,
+                    on=(ScannedLocation.cellid ==
+                        ScanSpawnPoint.scannedlocation))
+                .where(((ScannedLocation.last_modified >=
+                         (location_change_date)) &
+                        (ScannedLocation.last_modified >
+                         (datetime.utcnow() - timedelta(minutes=60)))) | (
+                             ScannedLocation.cellid << cellids))
+                .tuples())
+            links = list(query)
+
+        return links
 
     # Return list of dicts for upcoming valid band times.
     @staticmethod
@@ -1421,50 +1454,49 @@ class SpawnPoint(LatLongModel):
         end = sp['latest_seen'] - (3 - links.index('-')) * 900 + no_tth_adjust
         return [start % 3600, end % 3600]
 
-    # Return a list of dicts with the next spawn times.
+    # Return a list of dicts with the next spawn times of a spawnpoint, and
+    # the end in seconds after the hour of its earliest window, scanned or
+    # not. The list doesn't change before then unless the spawnpoint does.
     @staticmethod
-    def get_times(cell, scan, now_date, scan_delay,
-                  cell_to_linked_spawn_points, sp_by_id):
+    def get_times(sp, scan, now_date, scan_delay):
         result = []
         now_secs = date_secs(now_date)
-        linked_spawn_points = (cell_to_linked_spawn_points[cell]
-                               if cell in cell_to_linked_spawn_points else [])
-
-        for sp in linked_spawn_points:
 
-            if sp['missed_count'] > 5:
-                continue
+        if sp['missed_count'] > 5:
+            return result, None
 
-            endpoints = SpawnPoint.start_end(sp, scan_delay)
-            SpawnPoint.add_if_not_scanned('spawn', result, sp, scan,
-                                          endpoints[0], endpoints[1], now_date,
-                                          now_secs, sp_by_id)
+        endpoints = SpawnPoint.start_end(sp, scan_delay)
+        expires = SpawnPoint.add_if_not_scanned('spawn', result, sp, scan,
+                                                endpoints[0], endpoints[1],
+                                                now_date, now_secs)
 
-            # Check to see if still searching for valid TTH.
-            if SpawnPoint.tth_found(sp):
-                continue
+        # Check to see if still searching for valid TTH.
+        if SpawnPoint.tth_found(sp):
+            return result, expires
 
-            # Add a spawnpoint check between latest_seen and earliest_unseen.
-            start = sp['latest_seen']
-            end = sp['earliest_unseen']
+        # Add a spawnpoint check between latest_seen and earliest_unseen.
+        start = sp['latest_seen']
+        end = sp['earliest_unseen']
 
-            # So if the gap between start and end < 89 seconds make the gap
-            # 89 seconds
-            if ((end > start and end - start < 89) or
-                    (start > end and (end + 3600) - start < 89)):
-                end = (start + 89) % 3600
-            # So we move the search gap on 45 to within 45 and 89 seconds from
-            # the last scan. TTH appears in the last 90 seconds of the Spawn.
-            start = sp['latest_seen'] + 45
+        # So if the gap between start and end < 89 seconds make the gap
+        # 89 seconds
+        if ((end > start and end - start < 89) or
+                (start > end and (end + 3600) - start < 89)):
+            end = (start + 89) % 3600
+        # So we move the search gap on 45 to within 45 and 89 seconds from
+        # the last scan. TTH appears in the last 90 seconds of the Spawn.
+        start = sp['latest_seen'] + 45
 
-            SpawnPoint.add_if_not_scanned('TTH', result, sp, scan, start, end,
-                                          now_date, now_secs, sp_by_id)
+        expires = min(expires, SpawnPoint.add_if_not_scanned(
+            'TTH', result, sp, scan, start, end, now_date, now_secs))
 
-        return result
+        return result, expires
 
+    # Appends the window to l unless the spawnpoint was scanned since it
+    # started, and returns its end.
     @staticmethod
     def add_if_not_scanned(kind, l, sp, scan, start,
-                           end, now_date, now_secs, sp_by_id):
+                           end, now_date, now_secs):
         # Make sure later than now_secs.
         while end < now_secs:
             start, end = start + 3600, end + 3600
@@ -1476,10 +1508,12 @@ class SpawnPoint(LatLongModel):
         while start < 0:
             start, end = start + 3600, end + 3600
 
-        last_scanned = sp_by_id[sp['id']]['last_scanned']
+        last_scanned = sp['last_scanned']
         if ((now_date - last_scanned).total_seconds() > now_secs - start):
             l.append(ScannedLocation._q_init(scan, start, end, kind, sp['id']))
 
+        return end
+
     @staticmethod
     def select_in_hex_by_cellids(cellids, location_change_date):
         # Get all spawnpoints from the hive's cells
@@ -1567,6 +1601,161 @@ class ScanSpawnPoint(BaseModel):
         primary_key = CompositeKey('spawnpoint', 'scannedlocation')
 
 
+class SpawnPointLinks(object):
+    '''
+    Links between the cells of a SpeedScan hive and its spawnpoints, so
+    queue refreshes don't have to join ScanSpawnPoint to assign each
+    spawnpoint to a cell.
+
+    Like the join did, a spawnpoint belongs to the highest of its linked
+    cells, from this hive or from another hive active since the location
+    change, and only to this hive if that cell is one of its own. The links
+    are queried when the hive changes or once they're max_age seconds old,
+    and the spawnpoints seen by each scan are linked as they're found. With
+    a directory, they're saved to it so a restart of the same hive loads
+    them instead of querying them again.
+    '''
+
+    def __init__(self, directory=None, max_age=3600):
+        self.directory = directory
+        self.max_age = max_age
+        self.lock = Lock()
+        self.cells = set()
+        self.bounds = None
+        self.location_change_date = None
+        # Spawnpoint id -> set of linked cell ids.
+        self.links = {}
+        # Links found by scans since the hive changed. They're kept to be
+        # added to the next query, which may run before they're written.
+        self.found = {}
+        self.built = None
+        self.saved = True
+
+    # Starts over with the cells of a new hive, from its snapshot if there's
+    # a recent one.
+    def reset(self, cellids, locations, location_change_date):
+        # Spawnpoints are linked to cells up to 70m away.
+        margin = 0.001 / math.cos(math.radians(locations[0][0]))
+        with self.lock:
+            self.cells = set(cellids)
+            self.bounds = (max(loc[0] for loc in locations) + 0.001,
+                           max(loc[1] for loc in locations) + margin,
+                           min(loc[0] for loc in locations) - 0.001,
+                           min(loc[1] for loc in locations) - margin)
+            self.location_change_date = location_change_date
+            self.links = {}
+            self.found = {}
+            self.built = None
+            self.saved = True
+            self._load()
+
+    def _path(self):
+        key = hashlib.sha1(','.join(sorted(self.cells)).encode('utf-8'))
+        return os.path.join(self.directory,
+                            'links-{}.json'.format(key.hexdigest()))
+
+    def _load(self):
+        if not self.directory or not os.path.isfile(self._path()):
+            return
+
+        try:
+            with open(self._path()) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning('Unable to load spawnpoint links from %s: %s',
+                        self._path(), repr(e))
+            return
+
+        if (set(snapshot['cells']) != self.cells or
+                time.time() - snapshot['built'] > self.max_age):
+            return
+        self.links = dict((sp, set(cells))
+                          for sp, cells in snapshot['links'].items())
+        self.built = snapshot['built']
+        log.info('Loaded the links of %d spawnpoints from %s.',
+                 len(self.links), self._path())
+
+    def _save(self):
+        with self.lock:
+            path = self._path()
+            snapshot = {'cells': sorted(self.cells), 'built': self.built,
+                        'links': dict((sp, sorted(cells)) for sp, cells in
+                                      self.links.items())}
+            self.saved = True
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Replaced at once, so a crash can't leave half a snapshot.
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            getattr(os, 'replace', os.rename)(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to save spawnpoint links to %s: %s', path,
+                        repr(e))
+
+    # Links the spawnpoints seen by a scan to its cell, like process_map()
+    # does in ScanSpawnPoint.
+    def add(self, cell, sp_ids):
+        with self.lock:
+            if cell not in self.cells:
+                return
+            for sp_id in sp_ids:
+                if cell not in self.links.setdefault(sp_id, set()):
+                    self.links[sp_id].add(cell)
+                    self.found.setdefault(sp_id, set()).add(cell)
+                    self.saved = False
+
+    # Return the spawnpoints of each cell of the hive, as lists of dicts.
+    def get_cell_to_linked_spawn_points(self):
+        with self.lock:
+            cellids = list(self.cells)
+            location_change_date = self.location_change_date
+            stale = (self.built is None or
+                     time.time() - self.built > self.max_age)
+
+        if stale:
+            built = time.time()
+            links = {}
+            for sp_id, cell in ScannedLocation.get_spawn_point_links(
+                    cellids, location_change_date):
+                links.setdefault(sp_id, set()).add(cell)
+            log.info('Queried the links of %d spawnpoints.', len(links))
+            with self.lock:
+                for sp_id, cells in self.found.items():
+                    links.setdefault(sp_id, set()).update(cells)
+                self.links = links
+                self.built = built
+                self.saved = False
+
+        with self.lock:
+            sp_cells = {}
+            for sp_id, cells in self.links.items():
+                cell = max(cells)
+                if cell in self.cells:
+                    sp_cells[sp_id] = cell
+            n, e, s, w = self.bounds
+            save = self.directory and not self.saved
+        if save:
+            self._save()
+
+        ret = {}
+        with SpawnPoint.database().execution_context():
+            query = (SpawnPoint
+                     .select()
+                     .where((SpawnPoint.latitude <= n) &
+                            (SpawnPoint.latitude >= s) &
+                            (SpawnPoint.longitude >= w) &
+                            (SpawnPoint.longitude <= e))
+                     .dicts())
+            for sp in query:
+                cell = sp_cells.get(sp['id'])
+                if cell is not None:
+                    ret.setdefault(cell, []).append(sp)
+
+        return ret
+
+
 class SpawnpointDetectionData(BaseModel):
     id = Utf8mb4CharField(primary_key=True, max_length=54)
     # Removed ForeignKeyField since it caused MySQL issues.
@@ -1906,33 +2095,24 @@ def hex_bounds(center, steps=None, radius=None):
 
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e.
+# Parses the GET_MAP_OBJECTS response of a scan. Only what the scheduler and
+# the search worker need right away is done here, the rest of the processing
+# is handed to process_map(), on a map parser thread if there is one.
 def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
-              key_scheduler, api, status, now_date, account, account_sets):
-    pokemon = {}
-    pokestops = {}
+              key_scheduler, api, status, now_date, account, account_sets,
+              map_parser=None):
     gyms = {}
-    raids = {}
-    skipped = 0
-    filtered = 0
-    stopsskipped = 0
     forts = []
     forts_count = 0
     wild_pokemon = []
     wild_pokemon_count = 0
     nearby_pokemon = 0
-    spawn_points = {}
-    scan_spawn_points = {}
-    sightings = {}
-    new_spawn_points = []
-    sp_id_list = []
 
     # Consolidate the individual lists in each cell into two lists of Pokemon
     # and a list of forts.
     cells = map_dict['responses']['GET_MAP_OBJECTS'].map_cells
     # Get the level for the pokestop spin, and to send to webhook.
     level = account['level']
-    # Use separate level indicator for our L30 encounters.
-    encounter_level = level
 
     found_niantic_rare = False
     for cell in cells:
@@ -1997,6 +2177,85 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
             log.warning('No nearby or wild Pokemon but there are visible '
                         'gyms or pokestops. Possible speed violation.')
 
+    # The spawnpoints seen and the gyms found, for task_done() and gym info.
+    sp_id_list = [p.spawn_point_id for p in wild_pokemon]
+
+    if not args.no_gyms:
+        for f in forts:
+            if f.type == 0:
+                gym_display = f.gym_display
+                gyms[f.id] = {
+                    'gym_id':
+                        f.id,
+                    'team_id':
+                        f.owned_by_team,
+                    'guard_pokemon_id':
+                        f.guard_pokemon_id,
+                    'slots_available':
+                        gym_display.slots_available,
+                    'total_cp':
+                        gym_display.total_gym_cp,
+                    'enabled':
+                        f.enabled,
+                    'latitude':
+                        f.latitude,
+                    'longitude':
+                        f.longitude,
+                    'last_modified':
+                        datetime.utcfromtimestamp(
+                            f.last_modified_timestamp_ms / 1000.0),
+                }
+
+    # Spinning also needs this worker's API.
+    if args.pokestop_spinning:
+        for f in forts:
+            # Spin Pokestop with 50% chance.
+            if f.type == 1 and pokestop_spinnable(f, step_location):
+                spin_pokestop(api, account, args, f, step_location)
+
+    job = (args, step_location, now_date, wild_pokemon, nearby_pokemon, forts,
+           gyms, level, db_update_queue, wh_update_queue, key_scheduler, api,
+           status, account, account_sets)
+    # Encounters that aren't done by the CP workers use this worker's API,
+    # they can't wait for a map parser thread.
+    uses_api = (args.encounter and
+                not args.cp_worker_manager.is_scanning_active())
+    if map_parser is None or uses_api:
+        process_map(*job)
+    else:
+        map_parser.put(step_location, job)
+
+    # No wild or nearby Pokemon is marked as a bad scan, possibly due to a
+    # speed violation.
+    return {
+        'count': wild_pokemon_count + forts_count,
+        'gyms': gyms,
+        'sp_id_list': sp_id_list,
+        'bad_scan': not nearby_pokemon and not wild_pokemon,
+        'scan_secs': now_secs
+    }
+
+
+# Classifies the spawnpoints of a scan, does the encounters and builds the
+# webhook messages and DB rows of everything found.
+def process_map(args, step_location, now_date, wild_pokemon, nearby_pokemon,
+                forts, gyms, level, db_update_queue, wh_update_queue,
+                key_scheduler, api, status, account, account_sets):
+    pokemon = {}
+    pokestops = {}
+    raids = {}
+    skipped = 0
+    filtered = 0
+    stopsskipped = 0
+    spawn_points = {}
+    scan_spawn_points = {}
+    sightings = {}
+    new_spawn_points = []
+    sp_id_list = [p.spawn_point_id for p in wild_pokemon]
+    now_secs = date_secs(now_date)
+    # Use separate level indicator for our L30 encounters.
+    encounter_level = level
+
     scan_loc = ScannedLocation.get_by_loc(step_location)
     done_already = scan_loc['done']
     ScannedLocation.update_band(scan_loc, now_date)
@@ -2035,9 +2294,6 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                 'tth_secs': None
             }
 
-            # Keep a list of sp_ids to return.
-            sp_id_list.append(p.spawn_point_id)
-
             # time_till_hidden_ms was overflowing causing a negative integer.
             # It was also returning a value above 3.6M ms.
             if 0 < p.time_till_hidden_ms < 3600000:
@@ -2292,28 +2548,6 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                             raid_active_until
                     }))
 
-                gyms[f.id] = {
-                    'gym_id':
-                        f.id,
-                    'team_id':
-                        f.owned_by_team,
-                    'guard_pokemon_id':
-                        f.guard_pokemon_id,
-                    'slots_available':
-                        gym_display.slots_available,
-                    'total_cp':
-                        gym_display.total_gym_cp,
-                    'enabled':
-                        f.enabled,
-                    'latitude':
-                        f.latitude,
-                    'longitude':
-                        f.longitude,
-                    'last_modified':
-                        datetime.utcfromtimestamp(
-                            f.last_modified_timestamp_ms / 1000.0),
-                }
-
                 if not args.no_raids and f.type == 0:
                     if f.HasField('raid_info'):
                         raids[f.id] = {
@@ -2355,16 +2589,6 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                             })
                             wh_update_queue.put(('raid', wh_raid))
 
-        # Let db do it's things while we try to spin.
-        if args.pokestop_spinning:
-            for f in forts:
-                # Spin Pokestop with 50% chance.
-                if f.type == 1 and pokestop_spinnable(f, step_location):
-                    spin_pokestop(api, account, args, f, step_location)
-
-        # Helping out the GC.
-        del forts
-
     log.info('Parsing found Pokemon: %d (%d filtered), nearby: %d, ' +
              'pokestops: %d, gyms: %d, raids: %d.',
              len(pokemon) + skipped,
@@ -2432,25 +2656,6 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
         if sightings:
             db_update_queue.put((SpawnpointDetectionData, sightings))
 
-    if not nearby_pokemon and not wild_pokemon:
-        # After parsing the forts, we'll mark this scan as bad due to
-        # a possible speed violation.
-        return {
-            'count': wild_pokemon_count + forts_count,
-            'gyms': gyms,
-            'sp_id_list': sp_id_list,
-            'bad_scan': True,
-            'scan_secs': now_secs
-        }
-
-    return {
-        'count': wild_pokemon_count + forts_count,
-        'gyms': gyms,
-        'sp_id_list': sp_id_list,
-        'bad_scan': False,
-        'scan_secs': now_secs
-    }
-
 
 def encounter_pokemon(args, pokemon, account, api, account_sets, status,
                       key_scheduler):
@@ -2673,60 +2878,241 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
         if 'gym-info' in args.wh_types:
             wh_update_queue.put(('gym_details', webhook_data))
 
-    # All this database stuff is synchronous (not using the upsert queue) on
-    # purpose.  Since the search workers load the GymDetails model from the
-    # database to determine if a gym needs to be rescanned, we need to be sure
-    # the GymDetails get fully committed to the database before moving on.
-    #
-    # We _could_ synchronously upsert GymDetails, then queue the other tables
-    # for upsert, but that would put that Gym's overall information in a weird
-    # non-atomic state.
-
-    # Upsert all the models.
-    if gym_details:
-        db_update_queue.put((GymDetails, gym_details))
-    if gym_pokemon:
-        db_update_queue.put((GymPokemon, gym_pokemon))
-    if trainers:
-        db_update_queue.put((Trainer, trainers))
-
-    # Get rid of all the gym members, we're going to insert new records.
-    if gym_details:
-        with GymMember.database().execution_context():
-            DeleteQuery(GymMember).where(
-                GymMember.gym_id << list(gym_details.keys())).execute()
-
-    # Insert new gym members.
-    if gym_members:
-        db_update_queue.put((GymMember, gym_members))
+    # Upsert all the models, as one queue item so a gym's members are never
+    # applied before its details and defenders. The write-behind replaces
+    # the members of each gym in gym_details with the new records.
+    batches = [(model, data) for model, data in (
+        (GymDetails, gym_details), (GymPokemon, gym_pokemon),
+        (Trainer, trainers), (GymMember, gym_members)) if data]
+    if batches:
+        db_update_queue.put((None, batches))
 
     log.info('Upserted gyms: %d, gym members: %d.',
              len(gym_details),
              len(gym_members))
 
 
-def db_updater(q, db):
+class MapParser(object):
+    '''
+    Pool of threads running process_map() for parse_map(), so search workers
+    can send their next request right away.
+
+    Scans of the same location always go to the same thread, in order, so
+    its bands and spawnpoints aren't updated by two threads at once. A
+    worker whose thread's queue is full waits for it, so scanning slows
+    down to what the threads can process.
+    '''
+
+    def __init__(self, threads, queue_size=0):
+        self.queues = []
+        for i in range(threads):
+            q = Queue(maxsize=queue_size)
+            t = Thread(target=self.process, name='map-parser-{}'.format(i),
+                       args=(q,))
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+
+    def put(self, step_location, job):
+        q = self.queues[hash(cellid(step_location)) % len(self.queues)]
+        q.put(job)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    @staticmethod
+    def process(q):
+        while True:
+            job = q.get()
+            try:
+                process_map(*job)
+            except Exception as e:
+                log.exception('Map processing failed: %s', repr(e))
+            q.task_done()
+
+
+class DbWriteBehind(object):
+    '''
+    Write-behind stage between the DB update queue and bulk_upsert().
+
+    Pending (model, data) batches are merged per model and deduplicated on
+    primary key, the last writer wins. Each model is flushed in a single
+    transaction once its window has elapsed or it holds max_rows rows.
+
+    Rows of some models replace all the rows of another they own, like a
+    gym's details replace its members. The owned rows pending for them are
+    dropped, and the rest are deleted in the transaction that writes the
+    new ones.
+    '''
+
+    # Model -> (owned model, field) of the rows its rows replace.
+    replaces = {GymDetails: (GymMember, 'gym_id')}
+
+    def __init__(self, window=1.0, max_rows=5000):
+        self.window = window
+        self.max_rows = max_rows
+        self.lock = Lock()
+        self.pending = OrderedDict()
+        self.pending_since = {}
+        # Model -> (field, values) of the rows to delete on its next flush.
+        self.deletes = {}
+        # Models currently being flushed by a db-updater thread. Another
+        # thread may not flush the same model until it's done, so newer rows
+        # can never be overwritten by an older, slower flush.
+        self.flushing = set()
+
+        self.flushes = 0
+        self.rows_received = 0
+        self.rows_merged = 0
+        self.rows_flushed = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @staticmethod
+    def _row_key(model, row):
+        pk = model._meta.primary_key
+        if not pk:
+            # Tables like GymMember have no primary key at all.
+            return None
+        elif isinstance(pk, CompositeKey):
+            names = pk.field_names
+        else:
+            names = (pk.name,)
+
+        try:
+            return tuple(row[name] for name in names)
+        except KeyError:
+            # Auto-increment primary key, nothing to deduplicate on.
+            return None
+
+    def merge(self, model, data):
+        with self.lock:
+            if model in self.replaces:
+                owned, field = self.replaces[model]
+                self._replace(owned, field,
+                              set(row[field] for row in data.values()))
+
+            rows = self._pending(model)
+            for row in data.values():
+                key = self._row_key(model, row)
+                if key is None:
+                    key = object()
+                elif key in rows:
+                    self.rows_merged += 1
+                rows[key] = row
+
+            self.rows_received += len(data)
+
+    def _pending(self, model):
+        rows = self.pending.get(model)
+        if rows is None:
+            rows = self.pending[model] = OrderedDict()
+            self.pending_since[model] = default_timer()
+        return rows
+
+    # Drops the pending rows of model with a value of field in values, and
+    # deletes the written ones on the next flush of model.
+    def _replace(self, model, field, values):
+        rows = self._pending(model)
+        for key in [key for key, row in rows.items()
+                    if row[field] in values]:
+            del rows[key]
+        self.deletes.setdefault(model, (field, set()))[1].update(values)
+
+    def take_due(self, force=False):
+        now = default_timer()
+        due = []
+        with self.lock:
+            for model in list(self.pending.keys()):
+                if model in self.flushing:
+                    continue
+
+                rows = self.pending[model]
+                if (force or len(rows) >= self.max_rows or
+                        now - self.pending_since[model] >= self.window):
+                    del self.pending[model]
+                    del self.pending_since[model]
+                    self.flushing.add(model)
+                    due.append((model, rows, self.deletes.pop(model, None)))
+
+        return due
+
+    def flush(self, db, force=False):
+        for model, rows, deletes in self.take_due(force):
+            start_timer = default_timer()
+            try:
+                with db.atomic():
+                    if deletes:
+                        field, values = deletes
+                        DeleteQuery(model).where(
+                            getattr(model, field) << list(values)).execute()
+                    if rows:
+                        bulk_upsert(model, rows, db)
+            finally:
+                with self.lock:
+                    self.flushing.discard(model)
+
+            latency = default_timer() - start_timer
+            with self.lock:
+                self.flushes += 1
+                self.rows_flushed += len(rows)
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(latency, self.max_flush_latency)
+
+            log.debug('Upserted to %s, %d records (%d rows pending) in '
+                      '%.6f seconds.', model.__name__, len(rows),
+                      self.pending_rows(), latency)
+
+    def pending_rows(self):
+        with self.lock:
+            return sum(len(rows) for rows in self.pending.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending_models': len(self.pending),
+                'pending_rows': sum(
+                    len(rows) for rows in self.pending.values()),
+                'flushes': self.flushes,
+                'rows_received': self.rows_received,
+                'rows_merged': self.rows_merged,
+                'rows_flushed': self.rows_flushed,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency
+            }
+
+
+# The (model, data) batches of a DB queue item. An item with no model holds
+# a list of batches that go together, like the tables of parse_gyms().
+def queued_batches(model, data):
+    if model is None:
+        return data
+    return [(model, data)]
+
+
+def db_updater(q, db, write_behind, live_cache=None):
     # The forever loop.
     while True:
         try:
             # Loop the queue.
             while True:
-                model, data = q.get()
-
-                start_timer = default_timer()
-                bulk_upsert(model, data, db)
-                q.task_done()
-
-                log.debug('Upserted to %s, %d records (upsert queue '
-                          'remaining: %d) in %.6f seconds.',
-                          model.__name__,
-                          len(data),
-                          q.qsize(),
-                          default_timer() - start_timer)
-
-                # Helping out the GC.
-                del model
-                del data
+                try:
+                    model, data = q.get(timeout=write_behind.window)
+                    batches = queued_batches(model, data)
+                    for batch_model, batch_data in batches:
+                        write_behind.merge(batch_model, batch_data)
+                    if live_cache:
+                        live_cache.ingest_batches(batches)
+                    q.task_done()
+
+                    # Helping out the GC.
+                    del model
+                    del data
+                    del batches
+                except Empty:
+                    pass
+
+                write_behind.flush(db)
 
                 if q.qsize() > 50:
                     log.warning(
@@ -2796,8 +3182,99 @@ def clean_db_loop(args):
             log.exception('Exception in clean_db_loop: %s', repr(e))
 
 
+# Columns rewritten by the 'update' upsert mode when the row already exists.
+# Tables not listed here rewrite every column outside their primary key.
+upsert_update_columns = {
+    Pokemon: ('pokemon_id', 'disappear_time', 'individual_attack',
+              'individual_defense', 'individual_stamina', 'move_1', 'move_2',
+              'cp', 'cp_multiplier', 'weight', 'height', 'gender', 'form',
+              'last_modified'),
+    ScannedLocation: ('last_modified', 'done', 'band1', 'band2', 'band3',
+                      'band4', 'band5', 'midpoint', 'width'),
+    SpawnPoint: ('last_scanned', 'kind', 'links', 'missed_count',
+                 'latest_seen', 'earliest_unseen')
+}
+
+# INSERT ... ON CONFLICT DO UPDATE was added in SQLite 3.24.
+sqlite_upsert_supported = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+upsert_sql_cache = {}
+
+
+def upsert_sql(cls, names, num_rows, db):
+    key = (cls, names, num_rows)
+    sql = upsert_sql_cache.get(key)
+    if sql is not None:
+        return sql
+
+    meta = cls._meta
+
+    def quote(column):
+        return '{0}{1}{0}'.format(db.quote_char, column)
+
+    pk = meta.primary_key
+    if not pk:
+        pk_names = ()
+    elif isinstance(pk, CompositeKey):
+        pk_names = pk.field_names
+    else:
+        pk_names = (pk.name,)
+
+    update_names = upsert_update_columns.get(cls, names)
+    update = [quote(meta.fields[name].db_column) for name in update_names
+              if name in names and name not in pk_names]
+
+    row = '(' + ', '.join([db.interpolation] * len(names)) + ')'
+    sql = 'INSERT INTO {} ({}) VALUES {}'.format(
+        quote(meta.db_table),
+        ', '.join(quote(meta.fields[name].db_column) for name in names),
+        ', '.join([row] * num_rows))
+
+    if args.db_type == 'mysql':
+        if update:
+            sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '{0}=VALUES({0})'.format(column) for column in update)
+        elif pk_names:
+            sql = 'INSERT IGNORE' + sql[len('INSERT'):]
+    elif pk_names:
+        conflict = ', '.join(quote(meta.fields[name].db_column)
+                             for name in pk_names)
+        if update:
+            sql += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                conflict, ', '.join('{0}=excluded.{0}'.format(column)
+                                    for column in update))
+        else:
+            sql += ' ON CONFLICT ({}) DO NOTHING'.format(conflict)
+
+    upsert_sql_cache[key] = sql
+    return sql
+
+
+def upsert_rows(cls, rows, db):
+    # Unlike REPLACE, which deletes and re-inserts the row (rewriting every
+    # index and burning auto-increment ids), this updates existing rows in
+    # place and only touches the columns in upsert_update_columns.
+    meta = cls._meta
+    defaults = meta.get_default_dict()
+
+    present = set(defaults)
+    for row in rows:
+        present.update(row)
+    names = tuple(name for name in meta.sorted_field_names
+                  if name in present)
+    fields = [meta.fields[name] for name in names]
+
+    params = []
+    for row in rows:
+        for name, field in zip(names, fields):
+            params.append(field.db_value(row.get(name, defaults.get(name))))
+
+    db.execute_sql(upsert_sql(cls, names, len(rows), db), params)
+
+
 def bulk_upsert(cls, data, db):
-    num_rows = len(list(data.values()))
+    rows = list(data.values())
+    num_rows = len(rows)
     i = 0
 
     if args.db_type == 'mysql':
@@ -2807,41 +3284,51 @@ def bulk_upsert(cls, data, db):
         # so we need to limit how many rows we insert for it.
         step = 50
 
-    with db.atomic():
-        while i < num_rows:
-            log.debug('Inserting items %d to %d.', i, min(i + step, num_rows))
-            try:
-                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
-                # unable to recognize strings to update unicode keys for
-                # foreign key fields, thus giving lots of foreign key
-                # constraint errors.
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+    use_update = args.db_upsert_mode == 'update' and (
+        args.db_type == 'mysql' or sqlite_upsert_supported)
 
-                # Use peewee's own implementation of the insert_many() method.
-                InsertQuery(cls, rows=list(data.values())[
-                            i:min(i + step, num_rows)]).upsert().execute()
-
-                if args.db_type == 'mysql':
-                    db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
-
-            except Exception as e:
-                # If there is a DB table constraint error, dump the data and
-                # don't retry.
-                #
-                # Unrecoverable error strings:
-                unrecoverable = ['constraint', 'has no attribute',
-                                 'peewee.IntegerField object at']
-                has_unrecoverable = [x for x in unrecoverable if x in str(e)]
-                if has_unrecoverable:
-                    log.exception('%s. Data is:', repr(e))
-                    log.warning(list(data.items()))
-                else:
-                    log.warning('%s... Retrying...', repr(e))
-                    time.sleep(1)
-                    continue
+    with db.atomic():
+        # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
+        # unable to recognize strings to update unicode keys for
+        # foreign key fields, thus giving lots of foreign key
+        # constraint errors.
+        if args.db_type == 'mysql':
+            db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
 
-            i += step
+        try:
+            while i < num_rows:
+                log.debug('Inserting items %d to %d.', i,
+                          min(i + step, num_rows))
+                try:
+                    if use_update:
+                        upsert_rows(cls, rows[i:i + step], db)
+                    else:
+                        # Use peewee's own implementation of the
+                        # insert_many() method.
+                        InsertQuery(cls,
+                                    rows=rows[i:i + step]).upsert().execute()
+
+                except Exception as e:
+                    # If there is a DB table constraint error, dump the data
+                    # and don't retry.
+                    #
+                    # Unrecoverable error strings:
+                    unrecoverable = ['constraint', 'has no attribute',
+                                     'peewee.IntegerField object at']
+                    has_unrecoverable = [x for x in unrecoverable
+                                         if x in str(e)]
+                    if has_unrecoverable:
+                        log.exception('%s. Data is:', repr(e))
+                        log.warning(rows[i:i + step])
+                    else:
+                        log.warning('%s... Retrying...', repr(e))
+                        time.sleep(1)
+                        continue
+
+                i += step
+        finally:
+            if args.db_type == 'mysql':
+                db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
 
 
 def create_tables(db):
@@ -3168,5 +3655,22 @@ def database_migrate(db, old_ver):
             migrator.add_column('gym', 'total_cp',
                                 SmallIntegerField(null=False, default=0)))
 
+    if old_ver < 21:
+        log.info('This DB schema update can take some time. '
+                 'Please be patient.')
+
+        # Composite time/location indexes for the map queries. Tables
+        # dropped by an earlier step are recreated with them by
+        # create_tables().
+        indexes = [
+            (Pokemon, ('disappear_time', 'latitude', 'longitude')),
+            (Pokemon, ('last_modified', 'latitude', 'longitude')),
+            (Pokestop, ('last_updated', 'latitude', 'longitude')),
+            (Gym, ('last_scanned', 'latitude', 'longitude')),
+            (ScannedLocation, ('last_modified', 'latitude', 'longitude'))
+        ]
+        migrate(*[migrator.add_index(model._meta.db_table, columns, False)
+                  for model, columns in indexes if model.table_exists()])
+
     # Always log that we're done.
     log.info('Schema upgrade complete.')
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import math
+
+# NumPy is optional, contains_many() checks the points one by one without it.
+try:
+    import numpy
+except ImportError:
+    pass
+
+
+class PreparedPolygon(object):
+    '''
+    Polygon of (lat, lng) points, prepared for point in polygon tests.
+
+    The bounding box of the polygon is split in a grid of cells, marked
+    inside, outside, or on the boundary when an edge touches them. Points in
+    inside and outside cells are answered by the grid. Points in boundary
+    cells are ray cast like before, over the edges that reach their row of
+    cells only, so the answers are the same as when ray casting over every
+    edge.
+    '''
+
+    OUTSIDE = 0
+    INSIDE = 1
+    BOUNDARY = 2
+
+    # Grid cells per polygon edge, and maximum cells per side of the grid.
+    cells_per_edge = 4
+    max_grid_size = 256
+
+    def __init__(self, points):
+        self.points = [(float(x), float(y)) for x, y in points]
+        n = len(self.points)
+        # Edges as (p1x, p1y, p2x, p2y), from each point to the next one.
+        self.edges = [self.points[i - 1] + self.points[i % n]
+                      for i in range(1, n + 1)]
+
+        xs = [p[0] for p in self.points] or [0.0]
+        ys = [p[1] for p in self.points] or [0.0]
+        self.min_x, self.max_x = min(xs), max(xs)
+        self.min_y, self.max_y = min(ys), max(ys)
+
+        size = int(math.ceil(math.sqrt(self.cells_per_edge * n)))
+        self.grid_size = max(1, min(size, self.max_grid_size))
+        self.cell_width = (self.max_x - self.min_x) / self.grid_size or 1.0
+        self.cell_height = (self.max_y - self.min_y) / self.grid_size or 1.0
+        # Points are placed in cells with rounding errors, and ray cast with
+        # some more, so edges this close to a cell touch it too.
+        self.margin = (1e-9 * max(self.cell_width, self.cell_height) +
+                       1e-11)
+
+        self.row_edges = self._row_edges()
+        self.cells = self._cells()
+
+    def contains(self, x, y):
+        # Quick check the boundary box of the entire polygon.
+        if (self.max_x < x or x < self.min_x or self.max_y < y or
+                y < self.min_y):
+            return False
+
+        i = min(int((x - self.min_x) / self.cell_width),
+                self.grid_size - 1)
+        j = min(int((y - self.min_y) / self.cell_height),
+                self.grid_size - 1)
+        state = self.cells[j * self.grid_size + i]
+        if state != self.BOUNDARY:
+            return state == self.INSIDE
+        return self._ray_cast(x, y, self.row_edges[j])
+
+    # Returns whether the polygon contains each of the points, as a list.
+    def contains_many(self, xs, ys):
+        if 'numpy' not in sys.modules:
+            return [self.contains(x, y) for x, y in zip(xs, ys)]
+
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        in_box = ((xs >= self.min_x) & (xs <= self.max_x) &
+                  (ys >= self.min_y) & (ys <= self.max_y))
+        i = numpy.minimum(((xs - self.min_x) / self.cell_width)
+                          .clip(0, self.grid_size).astype(int),
+                          self.grid_size - 1)
+        j = numpy.minimum(((ys - self.min_y) / self.cell_height)
+                          .clip(0, self.grid_size).astype(int),
+                          self.grid_size - 1)
+        cells = numpy.frombuffer(bytes(self.cells), dtype=numpy.uint8)
+        state = numpy.where(in_box, cells[j * self.grid_size + i],
+                            self.OUTSIDE)
+
+        result = state == self.INSIDE
+        for k in numpy.flatnonzero(state == self.BOUNDARY).tolist():
+            result[k] = self._ray_cast(float(xs[k]), float(ys[k]),
+                                       self.row_edges[int(j[k])])
+        return result.tolist()
+
+    # Ray casting over the edges, as in the original Geofence.contains().
+    @staticmethod
+    def _ray_cast(x, y, edges):
+        xinters = None
+        inside = False
+        for p1x, p1y, p2x, p2y in edges:
+            if min(p1y, p2y) < y <= max(p1y, p2y) and x <= max(p1x, p2x):
+                if p1y != p2y:
+                    xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                if p1x == p2x or x <= xinters:
+                    inside = not inside
+        return inside
+
+    # Lists the edges that reach each row of cells. Only those can cross
+    # the ray of a point in the row.
+    def _row_edges(self):
+        rows = [[] for _ in range(self.grid_size)]
+        for edge in self.edges:
+            first, last = self._cell_range(min(edge[1], edge[3]),
+                                           max(edge[1], edge[3]),
+                                           self.min_y, self.cell_height)
+            for j in range(first, last + 1):
+                rows[j].append(edge)
+        return rows
+
+    def _cells(self):
+        size = self.grid_size
+        cells = bytearray(size * size)
+        for x1, y1, x2, y2 in self.edges:
+            first_i, last_i = self._cell_range(min(x1, x2), max(x1, x2),
+                                               self.min_x, self.cell_width)
+            first_j, last_j = self._cell_range(min(y1, y2), max(y1, y2),
+                                               self.min_y, self.cell_height)
+            for j in range(first_j, last_j + 1):
+                for i in range(first_i, last_i + 1):
+                    if (cells[j * size + i] != self.BOUNDARY and
+                            self._edge_touches_cell(x1, y1, x2, y2, i, j)):
+                        cells[j * size + i] = self.BOUNDARY
+
+        # Edges don't touch the cells of an area of non boundary cells, so
+        # they're all inside or outside, like the center of the first one.
+        seen = bytearray(size * size)
+        for start in range(size * size):
+            if seen[start] or cells[start] == self.BOUNDARY:
+                continue
+            i, j = start % size, start // size
+            state = self.OUTSIDE
+            if self._ray_cast(self.min_x + (i + 0.5) * self.cell_width,
+                              self.min_y + (j + 0.5) * self.cell_height,
+                              self.row_edges[j]):
+                state = self.INSIDE
+
+            seen[start] = 1
+            area = [start]
+            while area:
+                cell = area.pop()
+                cells[cell] = state
+                i, j = cell % size, cell // size
+                for n, valid in ((cell - 1, i > 0), (cell + 1, i < size - 1),
+                                 (cell - size, j > 0),
+                                 (cell + size, j < size - 1)):
+                    if (valid and not seen[n] and
+                            cells[n] != self.BOUNDARY):
+                        seen[n] = 1
+                        area.append(n)
+        return cells
+
+    # Cells from low to high, with the margin, in the grid.
+    def _cell_range(self, low, high, origin, cell_size):
+        first = int(math.floor((low - self.margin - origin) / cell_size))
+        last = int(math.floor((high + self.margin - origin) / cell_size))
+        return (max(first, 0), min(last, self.grid_size - 1))
+
+    # Clips the edge to the cell, with the margin (Liang-Barsky).
+    def _edge_touches_cell(self, x1, y1, x2, y2, i, j):
+        left = self.min_x + i * self.cell_width - self.margin
+        right = self.min_x + (i + 1) * self.cell_width + self.margin
+        bottom = self.min_y + j * self.cell_height - self.margin
+        top = self.min_y + (j + 1) * self.cell_height + self.margin
+        dx, dy = x2 - x1, y2 - y1
+        t0, t1 = 0.0, 1.0
+        for p, q in ((-dx, x1 - left), (dx, right - x1),
+                     (-dy, y1 - bottom), (dy, top - y1)):
+            if p == 0:
+                if q < 0:
+                    return False
+            elif p < 0:
+                t0 = max(t0, q / p)
+            else:
+                t1 = min(t1, q / p)
+            if t0 > t1:
+                return False
+        return True
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import calendar
+import importlib
+import struct
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Protobuf classes of the responses that can be recorded, by response name.
+# The record kind is the index in this tuple.
+response_protos = (
+    ('GET_MAP_OBJECTS',
+     'pgoapi.protos.pogoprotos.networking.responses.'
+     'get_map_objects_response_pb2', 'GetMapObjectsResponse'),
+    ('GYM_GET_INFO',
+     'pgoapi.protos.pogoprotos.networking.responses.'
+     'gym_get_info_response_pb2', 'GymGetInfoResponse'))
+
+# Record header: kind, scan time (seconds since the epoch), step location
+# latitude, longitude and altitude, and length of the serialized response.
+record_header = struct.Struct('<BddddI')
+
+
+class ResponseRecorder(object):
+    '''
+    Appends API responses to a file, together with the step location and
+    time of their scan, for contrib/replay-responses.py.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.kinds = dict((name, kind) for kind, (name, _, _) in
+                          enumerate(response_protos))
+        self.lock = Lock()
+        self.file = open(path, 'ab')
+        log.info('Recording API responses to %s.', path)
+
+    def record(self, name, step_location, scan_date, response):
+        step_location = tuple(step_location) + (0,) * (3 - len(step_location))
+        payload = response.SerializeToString()
+        header = record_header.pack(
+            self.kinds[name], calendar.timegm(scan_date.timetuple()) +
+            scan_date.microsecond / 1e6, step_location[0], step_location[1],
+            step_location[2], len(payload))
+        with self.lock:
+            self.file.write(header + payload)
+            self.file.flush()
+
+
+# Yields (name, step_location, scan_date, payload) for every response in a
+# recording.
+def read_responses(path):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+            kind, timestamp, lat, lng, alt, size = record_header.unpack(
+                header)
+            payload = f.read(size)
+            if len(payload) < size:
+                log.warning('Recording %s ends with a truncated response.',
+                            path)
+                break
+            yield (response_protos[kind][0], (lat, lng, alt),
+                   datetime.utcfromtimestamp(timestamp), payload)
+
+
+def decode_response(name, payload):
+    if not hasattr(decode_response, 'classes'):
+        decode_response.classes = dict(
+            (proto_name, getattr(importlib.import_module(module), cls))
+            for proto_name, module, cls in response_protos)
+    response = decode_response.classes[name]()
+    response.ParseFromString(payload)
+    return response
@@ -52,20 +52,26 @@ import time
 import sys
 from timeit import default_timer
 from threading import Lock
-from copy import deepcopy
 import traceback
+from bisect import bisect_left
 from collections import Counter
 from queue import Empty
 from operator import itemgetter
 from datetime import datetime, timedelta
 from .transform import get_new_coords
 from .models import (hex_bounds, SpawnPoint, ScannedLocation,
-                     ScanSpawnPoint, HashKeys)
+                     ScanSpawnPoint, SpawnPointLinks, HashKeys)
 from .utils import now, cur_sec, cellid, distance
 from .altitude import get_altitude
-from .geofence import Geofences
+from .geofence import get_geofences
 from functools import reduce
 
+# NumPy is optional, SpeedScan keeps its queue in lists without it.
+try:
+    import numpy
+except ImportError:
+    pass
+
 log = logging.getLogger(__name__)
 
 
@@ -77,7 +83,8 @@ class BaseScheduler(object):
     def __init__(self, queues, status, args):
         self.queues = queues
         self.status = status
-        self.geofences = Geofences()
+        self.geofences = get_geofences(args.geofence_file, None,
+                                       args.geofence_excluded_file)
         self.args = args
         self.scan_location = False
         self.ready = False
@@ -483,6 +490,123 @@ class SpawnScan(BaseScheduler):
 # After finishing the spawnpoint search or if timing isn't right for any of
 # the remaining search bands, workers will search the nearest scan location
 # that has a new spawn.
+class SpeedQueue(object):
+    '''
+    SpeedScan's queue, one column per item field instead of a dict per item.
+
+    Items are sorted on start. start and end are in seconds after the hour
+    of the queue refresh, kind indexes kinds, cell indexes SpeedScan.cells
+    and sp indexes SpeedScan.sp_ids, or is -1 for bands. Workers update an
+    item's state, and the delay after start of a TIMED scan.
+
+    The items are also split in groups by kind and by the tile of their
+    cell, for SpeedScan.next_item() to search the groups that can hold the
+    best item for a worker first.
+    '''
+
+    kinds = ('band', 'TTH', 'spawn')
+    # Score of each kind at 0m, bands are top priority to find new spawns
+    # first.
+    scores = (1e12, 1e6, 1)
+    PENDING, MISSED, SCANNED, TIMED = range(4)
+
+    def __init__(self, items, cell_tiles, tiles):
+        # Items are (start, end, kind, cell, sp) tuples.
+        columns = list(zip(*items)) or [()] * 5
+        if 'numpy' in sys.modules:
+            start = numpy.array(columns[0], dtype=float)
+            order = numpy.argsort(start, kind='mergesort')
+            self.start = start[order]
+            self.end = numpy.array(columns[1], dtype=float)[order]
+            self.kind = numpy.array(columns[2], dtype=numpy.int8)[order]
+            self.cell = numpy.array(columns[3], dtype=numpy.int32)[order]
+            self.sp = numpy.array(columns[4], dtype=numpy.int32)[order]
+            self.state = numpy.zeros(len(items), dtype=numpy.int8)
+            self.delay = numpy.zeros(len(items))
+            rows = zip(self.start.tolist(), self.end.tolist(),
+                       self.kind.tolist(), self.cell.tolist(),
+                       self.sp.tolist())
+        else:
+            order = sorted(range(len(items)), key=columns[0].__getitem__)
+            self.start, self.end, self.kind, self.cell, self.sp = (
+                [column[i] for i in order] for column in columns)
+            self.state = [self.PENDING] * len(items)
+            self.delay = [0] * len(items)
+            rows = zip(self.start, self.end, self.kind, self.cell, self.sp)
+
+        # Positions of the items of each spawnpoint.
+        self.sp_items = {}
+        # (i, start, end, cell) of the items of each group, sorted on start.
+        # Group tile * len(kinds) + kind holds the items of a kind in a tile.
+        self.cell_tiles = cell_tiles
+        self.groups = [[] for _ in range(tiles * len(self.kinds))]
+        for i, (start, end, kind, cell, sp) in enumerate(rows):
+            if sp >= 0:
+                self.sp_items.setdefault(sp, []).append(i)
+            self.groups[cell_tiles[cell] * len(self.kinds) + kind].append(
+                (i, start, end, cell))
+        # Items before the head of a group are done or ended.
+        self.group_heads = [0] * len(self.groups)
+
+        # Position -> [worker name, parked_last_update] of parked items.
+        self.parked = {}
+
+    def __len__(self):
+        return len(self.start)
+
+    # Marks the pending items that ended before ms as missed, and returns
+    # their number.
+    def mark_missed(self, ms):
+        if 'numpy' in sys.modules:
+            missed = (self.state == self.PENDING) & (self.end < ms)
+            self.state[missed] = self.MISSED
+            return int(numpy.count_nonzero(missed))
+
+        missed = 0
+        for i, state in enumerate(self.state):
+            if state == self.PENDING and self.end[i] < ms:
+                self.state[i] = self.MISSED
+                missed += 1
+        return missed
+
+    # Puts an item back in the queue, moving the head of its group back to
+    # it. Callers hold SpeedScan.lock_next_item, which guards the heads.
+    def release(self, i):
+        self.state[i] = self.PENDING
+        g = self.cell_tiles[self.cell[i]] * len(self.kinds) + self.kind[i]
+        # Groups are in queue order, so they're sorted on position too.
+        position = bisect_left(self.groups[g], (i,))
+        self.group_heads[g] = min(self.group_heads[g], position)
+
+    # Number of pending items of each kind that can be scanned at ms.
+    def waiting(self, ms):
+        if 'numpy' in sys.modules:
+            kinds = self.kind[(self.state == self.PENDING) &
+                              (self.start <= ms) & (self.end >= ms)]
+            counts = numpy.bincount(kinds, minlength=len(self.kinds))
+            return Counter(dict(zip(self.kinds, counts.tolist())))
+
+        return Counter(self.kinds[kind] for kind, state, start, end in
+                       zip(self.kind, self.state, self.start, self.end)
+                       if state == self.PENDING and start <= ms <= end)
+
+    def count(self, kind, state):
+        kind = self.kinds.index(kind)
+        if 'numpy' in sys.modules:
+            return int(numpy.count_nonzero((self.kind == kind) &
+                                           (self.state == state)))
+        return sum(1 for k, s in zip(self.kind, self.state)
+                   if k == kind and s == state)
+
+    def timed_delay(self, kind):
+        kind = self.kinds.index(kind)
+        if 'numpy' in sys.modules:
+            return float(self.delay[(self.kind == kind) &
+                                    (self.state == self.TIMED)].sum())
+        return sum(d for k, s, d in zip(self.kind, self.state, self.delay)
+                   if k == kind and s == self.TIMED)
+
+
 class SpeedScan(HexSearch):
 
     # Call base initialization, set step_distance
@@ -493,6 +617,22 @@ class SpeedScan(HexSearch):
         self.location_change_date = datetime.utcnow()
         self.queues = [[]]
         self.queue_version = 0
+        # Cells and spawnpoints of the queue items by index, see SpeedQueue.
+        self.cells = []
+        self.cell_locs = []
+        self.cell_steps = []
+        self.sp_ids = []
+        self.sp_index = {}
+        # Tile of each cell, and the center and radius of each tile.
+        self.cell_tiles = []
+        self.tile_centers = []
+        self.tile_radii = []
+        # Queue items of each cell's bands and of each spawnpoint, reused by
+        # schedule() until they change or their earliest window ends.
+        self.band_items = {}
+        self.sp_items = {}
+        self.spawn_point_links = SpawnPointLinks(
+            args.spawnpoint_links_dir)
         self.ready = False
         self.empty_hive = False
         self.spawns_found = 0
@@ -540,6 +680,16 @@ class SpeedScan(HexSearch):
             )) else ScannedLocation.new_loc(e[1])
 
         self.scans = scans
+        self.cells = list(scans.keys())
+        self.cell_locs = [scans[cell]['loc'] for cell in self.cells]
+        self.cell_steps = [scans[cell]['step'] for cell in self.cells]
+        self._generate_tiles()
+        self.sp_ids = []
+        self.sp_index = {}
+        self.band_items = {}
+        self.sp_items = {}
+        self.spawn_point_links.reset(self.cells, self.cell_locs,
+                                     self.location_change_date)
         db_update_queue.put((ScannedLocation, initial))
         log.info('%d steps created', len(scans))
         self.band_spacing = int(10 * 60 / len(scans))
@@ -557,6 +707,9 @@ class SpeedScan(HexSearch):
         ScannedLocation.link_spawn_points(scans, initial, spawnpoints,
                                           self.step_distance, scan_spawn_point,
                                           force=True)
+        for link in scan_spawn_point.values():
+            self.spawn_point_links.add(link['scannedlocation'],
+                                       [link['spawnpoint']])
         if len(scan_spawn_point):
             log.info('%d relations found between the spawn points and steps',
                      len(scan_spawn_point))
@@ -608,27 +761,30 @@ class SpeedScan(HexSearch):
                 (step, (location[0], location[1], altitude), 0, 0))
         return generated_locations
 
+    # Groups the cells in tiles of about a kilometer.
+    def _generate_tiles(self):
+        tiles = {}
+        self.cell_tiles = []
+        for loc in self.cell_locs:
+            key = (int(math.floor(loc[0] * 100)),
+                   int(math.floor(loc[1] * 100)))
+            self.cell_tiles.append(tiles.setdefault(key, len(tiles)))
+
+        locs = [[] for _ in range(len(tiles))]
+        for tile, loc in zip(self.cell_tiles, self.cell_locs):
+            locs[tile].append(loc)
+        self.tile_centers = [(sum(loc[0] for loc in l) / len(l),
+                              sum(loc[1] for loc in l) / len(l))
+                             for l in locs]
+        self.tile_radii = [max(distance(center, loc) for loc in l)
+                           for center, l in zip(self.tile_centers, locs)]
+
     def get_overseer_message(self):
-        n = 0
         ms = (datetime.utcnow() - self.refresh_date).total_seconds() + \
             self.refresh_ms
-        counter = {
-            'TTH': 0,
-            'spawn': 0,
-            'band': 0,
-        }
-        for item in self.queues[0]:
-            if item.get('done', False):
-                continue
-
-            if ms > item['end']:
-                continue
-
-            if ms < item['start']:
-                break
-
-            n += 1
-            counter[item['kind']] += 1
+        q = self.queues[0]
+        counter = q.waiting(ms) if q else Counter()
+        n = sum(counter.values())
 
         message = ('Scanning status: {} total waiting, {} initial bands, ' +
                    '{} TTH searches, and {} new spawns').format(
@@ -648,6 +804,8 @@ class SpeedScan(HexSearch):
     # Function to empty all queues in the queues list
     def empty_queues(self):
         self.queues = [[]]
+        # Workers still scanning an item must not update the next queue.
+        self.queue_version += 1
 
     # How long to delay since last action
     def delay(self, last_scan_date):
@@ -680,11 +838,14 @@ class SpeedScan(HexSearch):
         log.info('Refreshing queue')
         self.ready = False
         now_date = datetime.utcnow()
+        # Items of the old queue that ended are missed.
+        old_q = self.queues[0]
+        if old_q:
+            old_q.mark_missed((now_date - self.refresh_date).total_seconds() +
+                              self.refresh_ms)
         self.refresh_date = now_date
         self.refresh_ms = now_date.minute * 60 + now_date.second
         self.queue_version += 1
-        old_q = deepcopy(self.queues[0])
-        queue = []
 
         # Measure the time it takes to refresh the queue
         start = time.time()
@@ -692,30 +853,56 @@ class SpeedScan(HexSearch):
         # prefetch all scanned locations
         scanned_locations = ScannedLocation.get_by_cellids(list(self.scans.keys()))
 
-        # extract all spawnpoints into a dict with spawnpoint
-        # id -> spawnpoint for easy access later
         cell_to_linked_spawn_points = (
-            ScannedLocation.get_cell_to_linked_spawn_points(
-                list(self.scans.keys()), self.location_change_date))
-        sp_by_id = {}
-        for sps in cell_to_linked_spawn_points.values():
-            for sp in sps:
-                sp_by_id[sp['id']] = sp
-
-        for cell, scan in self.scans.items():
-            queue += ScannedLocation.get_times(scan, now_date,
-                                               scanned_locations)
-            queue += SpawnPoint.get_times(cell, scan, now_date,
-                                          self.args.spawn_delay,
-                                          cell_to_linked_spawn_points,
-                                          sp_by_id)
+            self.spawn_point_links.get_cell_to_linked_spawn_points())
+
+        # Only items of bands and spawnpoints that changed, or with a window
+        # that ended since they were last built, are built again within the
+        # hour.
+        hour = now_date.replace(minute=0, second=0, microsecond=0)
+        items = []
+        updated = 0
+        for i, cell in enumerate(self.cells):
+            scan = self.scans[cell]
+            s = scanned_locations.get(cell)
+            if s is None:
+                s = ScannedLocation.new_loc(scan['loc'])
+            signature = (s['done'], s['band1'], s['band2'], s['band3'],
+                         s['band4'], s['band5'], s['midpoint'], s['width'])
+            cached = self._cached_items(self.band_items, cell, signature,
+                                        now_date, hour)
+            # The window of a cell without bands always starts now.
+            if cached is None or s['band1'] == -1:
+                updated += 1
+                cached = self._cache_items(
+                    self.band_items, cell, signature, hour, i,
+                    ScannedLocation.get_times(scan, now_date,
+                                              scanned_locations))
+            items += cached
+
+            for sp in cell_to_linked_spawn_points.get(cell, []):
+                signature = (cell, sp['missed_count'], sp['earliest_unseen'],
+                             sp['latest_seen'], sp['links'], sp['kind'],
+                             sp['last_scanned'])
+                cached = self._cached_items(self.sp_items, sp['id'],
+                                            signature, now_date, hour)
+                if cached is None:
+                    updated += 1
+                    times, expires = SpawnPoint.get_times(
+                        sp, scan, now_date, self.args.spawn_delay)
+                    cached = self._cache_items(
+                        self.sp_items, sp['id'], signature, hour, i, times,
+                        expires)
+                items += cached
+
+        queue = SpeedQueue(items, self.cell_tiles, len(self.tile_centers))
         end = time.time()
 
-        queue.sort(key=itemgetter('start'))
         self.queues[0] = queue
         self.ready = True
-        log.info('New queue created with %d entries in %f seconds', len(queue),
-                 (end - start))
+        log.info('New queue created with %d entries in %f seconds, %d ' +
+                 'bands and spawnpoints updated', len(queue), (end - start),
+                 updated)
         # Avoiding refreshing the Queue when the initial scan is complete, and
         # there are no spawnpoints in the hive.
         if len(queue) == 0:
@@ -724,25 +911,11 @@ class SpeedScan(HexSearch):
             # Enclosing in try: to avoid divide by zero exceptions from
             # killing overseer
             try:
-
-                # Possible 'done' values are 'Missed', 'Scanned', None, or
-                # number
-                Not_none_list = [e for e in old_q if e.get(
-                    'done', None) is not None]
-                Missed_list = [e for e in Not_none_list if e.get(
-                    'done', None) == 'Missed']
-                Scanned_list = [e for e in Not_none_list if e.get(
-                    'done', None) == 'Scanned']
-                Timed_list = [e for e in Not_none_list if type(
-                    e['done']) is not str]
-                spawns_timed_list = [e for e in Timed_list if e['kind'] == 'spawn']
-                spawns_timed = len(spawns_timed_list)
-                bands_timed = len(
-                    [e for e in Timed_list if e['kind'] == 'band'])
-                spawns_all = spawns_timed + \
-                    len([e for e in Scanned_list if e['kind'] == 'spawn'])
-                spawns_missed = len(
-                    [e for e in Missed_list if e['kind'] == 'spawn'])
+                spawns_timed = old_q.count('spawn', SpeedQueue.TIMED)
+                bands_timed = old_q.count('band', SpeedQueue.TIMED)
+                spawns_all = spawns_timed + old_q.count('spawn',
+                                                        SpeedQueue.SCANNED)
+                spawns_missed = old_q.count('spawn', SpeedQueue.MISSED)
                 band_percent = self.band_status()
                 kinds = {}
                 tth_ranges = {}
@@ -750,8 +923,9 @@ class SpeedScan(HexSearch):
                 self.active_sp = 0
                 found_percent = 100.0
                 spawns_reached = 100.0
-                spawnpoints = SpawnPoint.select_in_hex_by_cellids(
-                    list(self.scans.keys()), self.location_change_date)
+                spawnpoints = [sp for sps in
+                               cell_to_linked_spawn_points.values()
+                               for sp in sps]
                 for sp in spawnpoints:
                     if sp['missed_count'] > 5:
                         continue
@@ -809,10 +983,7 @@ class SpeedScan(HexSearch):
                              spawns_missed, spawns_reached)
 
                 if spawns_timed:
-                    average = reduce(
-                        lambda x, y: x + y['done'],
-                        spawns_timed_list,
-                        0) / spawns_timed
+                    average = old_q.timed_delay('spawn') / spawns_timed
                     log.info('%d Pokemon found, %d were targeted, with an ' +
                              'average delay of %d sec', spawns_all,
                              spawns_timed, average)
@@ -860,152 +1031,87 @@ class SpeedScan(HexSearch):
                         repr(e)))
                 traceback.print_exc(file=sys.stdout)
 
+    # Returns the cached queue items of a band or spawnpoint, or None if they
+    # have to be built again. Windows are moved to the next hour when they
+    # start before the hour of the refresh, so nothing is reused once the
+    # hour changes.
+    @staticmethod
+    def _cached_items(cache, key, signature, now_date, hour):
+        cached = cache.get(key)
+        if (cached is None or cached[0] != signature or cached[1] != hour or
+                cached[2] is not None and now_date > cached[2]):
+            return None
+
+        return cached[3]
+
+    # Caches the queue items built from the queue dicts of a band or
+    # spawnpoint, until the earliest window ends at expires seconds after the
+    # hour. Bands expire with their window.
+    def _cache_items(self, cache, key, signature, hour, cell, times,
+                     expires=None):
+        items = []
+        for t in times:
+            sp = -1
+            if t['sp'] is not None:
+                sp = self.sp_index.get(t['sp'])
+                if sp is None:
+                    sp = self.sp_index[t['sp']] = len(self.sp_ids)
+                    self.sp_ids.append(t['sp'])
+            else:
+                expires = t['end']
+            items.append((t['start'], t['end'],
+                          SpeedQueue.kinds.index(t['kind']), cell, sp))
+
+        if expires is not None:
+            expires = hour + timedelta(seconds=expires)
+        cache[key] = (signature, hour, expires, items)
+        return items
+
     # Find the best item to scan next
     def next_item(self, status):
-        # Thread safety: don't let multiple threads get the same "best item".
-        with self.lock_next_item:
-            # Score each item in the queue by # of due spawns or scan time
-            # bands can be filled.
+        # Score each item in the queue by # of due spawns or scan time
+        # bands can be filled.
 
-            while not self.ready:
-                time.sleep(1)
+        while not self.ready:
+            time.sleep(1)
 
+        # Workers search the queue at the same time, and only take the lock
+        # to claim or park the item they found. A worker whose item was
+        # claimed by another one first searches again.
+        for attempt in range(3):
             now_date = datetime.utcnow()
             q = self.queues[0]
+            queue_version = self.queue_version
             ms = ((now_date - self.refresh_date).total_seconds() +
                   self.refresh_ms)
-            best = {}
             if not status['latitude']:
                 worker_loc = None
             else:
                 worker_loc = [status['latitude'], status['longitude']]
             last_action = status['last_scan_date']
 
-            # Logging.
-            log.debug('Enumerating %s scan locations in queue.',
-                      len(q))
-
-            # Keep some stats for logging purposes. If something goes wrong,
-            # we can track what happened.
-            count_claimed = 0
-            count_parked = 0
-            count_missed = 0
-            count_fresh_band = 0
-            count_early = 0
-            count_late = 0
-            min_parked_time_remaining = 0
-            min_fresh_band_time_remaining = 0
-
-            # Check all scan locations possible in the queue.
-            for i, item in enumerate(q):
-                # If already claimed by another worker or done, pass.
-                if item.get('done', False):
-                    count_claimed += 1
-                    continue
-
-                # If the item is parked by a different thread (or by a
-                # different account, which should be on that one thread),
-                # pass.
-                our_parked_name = status['username']
-                if 'parked_name' in item:
-                    # We use 'parked_last_update' to determine when the
-                    # last time was since the thread passed the item with the
-                    # same thread name & username. If it's been too long, unset
-                    # the park so another worker can pick it up.
-                    now = default_timer()
-                    max_parking_idle_seconds = 3 * 60
-                    time_passed = now - item.get('parked_last_update', now)
-                    time_remaining = (max_parking_idle_seconds - time_passed)
-
-                    # Update logging stats.
-                    if not min_parked_time_remaining:
-                        min_parked_time_remaining = time_remaining
-                    elif time_remaining < min_parked_time_remaining:
-                        min_parked_time_remaining = time_remaining
-
-                    # Check parked status.
-                    if (time_passed > max_parking_idle_seconds):
-                        # Unpark & don't skip it.
-                        item.pop('parked_name', None)
-                        item.pop('parked_last_update', None)
-                    else:
-                        # Still parked and not our item. Skip it.
-                        if item.get('parked_name') != our_parked_name:
-                            count_parked += 1
-                            continue
-
-                # If already timed out, mark it as Missed and check next.
-                if ms > item['end']:
-                    count_missed += 1
-                    item['done'] = 'Missed' if not item.get(
-                        'done', False) else item['done']
-                    continue
-
-                # If we just did a fresh band recently, wait a few seconds to
-                # space out the band scans.
-                if now_date < self.next_band_date:
-                    count_fresh_band += 1
-
-                    # Update logging stats.
-                    band_time_remaining = (self.next_band_date - now_date)
-                    if not min_fresh_band_time_remaining:
-                        min_fresh_band_time_remaining = band_time_remaining
-                    elif band_time_remaining < min_fresh_band_time_remaining:
-                        min_fresh_band_time_remaining = band_time_remaining
-
-                    continue
-
-                # If we are going to get there before it starts then ignore.
-                loc = item['loc']
-                if worker_loc:
-                    meters = distance(loc, worker_loc)
-                    secs_to_arrival = meters / self.args.kph * 3.6
-                    secs_waited = (now_date - last_action).total_seconds()
-                    secs_to_arrival = max(secs_to_arrival - secs_waited, 0)
-                else:
-                    meters = 0
-                    secs_to_arrival = 0
-                if ms + secs_to_arrival < item['start']:
-                    count_early += 1
-                    continue
-
-                # If we can't make it there before it disappears, don't bother
-                # trying.
-                if ms + secs_to_arrival > item['end']:
-                    count_late += 1
-                    continue
-
-                # Bands are top priority to find new spawns first
-                score = 1e12 if item['kind'] == 'band' else (
-                    1e6 if item['kind'] == 'TTH' else 1)
-
-                # For spawns, score is purely based on how close they are to
-                # last worker position
-                score = score / (meters + 10.0)
-
-                if score > best.get('score', 0):
-                    best = {'score': score, 'i': i,
-                            'secs_to_arrival': secs_to_arrival}
-                    best.update(item)
+            # If we just did a fresh band recently, wait a few seconds to
+            # space out the band scans.
+            if now_date < self.next_band_date:
+                best, counts = {}, {}
+                log.debug('Skipping queue search, %s time remaining for '
+                          'next fresh band.', self.next_band_date - now_date)
+            else:
+                best, counts = self._find_best(q, ms, now_date, worker_loc,
+                                               last_action, status['username'])
 
             # If we didn't find one, log it.
-            if not best:
-                log.debug('Enumerating queue found no best location, with'
-                          + ' %s claimed, %s parked, %s missed, %s fresh band'
-                          + " skips, %s missed because we're early, %s because"
-                          + " we're too late. Minimum %s time remaining on"
-                          + ' parked item, and %s time remaining for next'
-                          + ' fresh band.',
-                          count_claimed,
-                          count_parked,
-                          count_missed,
-                          count_fresh_band,
-                          count_early,
-                          count_late,
-                          min_parked_time_remaining,
-                          min_fresh_band_time_remaining)
-            else:
-                log.debug('Enumerating queue found best location: %s.',
+            if not best and counts:
+                log.debug('Searching queue found no best location, with'
+                          + " %s parked, %s missed because we're early, %s"
+                          + " because we're too late. Minimum %s time"
+                          + ' remaining on parked item.',
+                          counts['parked'],
+                          counts['early'],
+                          counts['late'],
+                          counts['min_parked_time_remaining'])
+            elif best:
+                log.debug('Searching queue found best location: %s.',
                           repr(best))
 
             loc = best.get('loc', [])
@@ -1031,71 +1137,211 @@ class SpeedScan(HexSearch):
                 'invalid': ('Invalid response at step {}, abandoning ' +
                             'location.').format(step)
             }
-            try:
-                item = q[i]
-            except IndexError:
+            if i >= len(q):
                 messages['wait'] = ('Search aborting.'
                                     + ' Overseer refreshing queue.')
                 return -1, 0, 0, 0, messages, 0
 
             if best.get('score', 0) == 0:
-                if count_late > 0:
+                if counts.get('late', 0) > 0:
                     messages['wait'] = ('Not able to reach any scan'
                                         + ' under the speed limit.')
                 return -1, 0, 0, 0, messages, 0
 
-            meters = distance(loc, worker_loc) if worker_loc else 0
-            if (meters > (now_date - last_action).total_seconds() *
-                    self.args.kph / 3.6):
-                # Flag item as "parked" by a specific thread, because
-                # we're waiting for it. This will avoid all threads "walking"
-                # to the same item.
-                our_parked_name = status['username']
-                item['parked_name'] = our_parked_name
-
-                # CTRL+F 'parked_last_update' in this file for more info.
-                item['parked_last_update'] = default_timer()
-
-                messages['wait'] = 'Moving {}m to step {} for a {}.'.format(
-                    int(meters), step, best['kind'])
-                # So we wait while the worker arrives at the destination
-                # But we don't want to sleep too long or the item might get
-                # taken by another worker
-                if secs_to_arrival > 179 - self.args.scan_delay:
-                    secs_to_arrival = 179 - self.args.scan_delay
-                return -1, 0, 0, 0, messages, max(secs_to_arrival, 0)
-
-            # Check again if another worker heading there.
-            # TODO: Check if this is still necessary. I believe this was
-            # originally a failed attempt at thread safety, which still
-            # resulted in a race condition (multiple workers heading to the
-            # same spot). A thread Lock has since been added.
-            if item.get('done', False):
-                messages['wait'] = ('Skipping step {}. Other worker already ' +
-                                    'scanned.').format(step)
-                return -1, 0, 0, 0, messages, 0
-
-            if not self.ready:
-                messages['wait'] = ('Search aborting.'
-                                    + ' Overseer refreshing queue.')
-                return -1, 0, 0, 0, messages, 0
-
-            # If a new band, set the date to wait until for the next band.
-            if best['kind'] == 'band' and best['end'] - best['start'] > 5 * 60:
-                self.next_band_date = datetime.utcnow() + timedelta(
-                    seconds=self.band_spacing)
+            # Thread safety: don't let multiple threads get the same "best
+            # item".
+            with self.lock_next_item:
+                # Check again if another worker claimed or parked it, or
+                # took a fresh band, since we searched.
+                parked = q.parked.get(i)
+                if (q.state[i] != SpeedQueue.PENDING or
+                        parked and parked[0] != status['username'] and
+                        parked[1] != best['parked_last_update']):
+                    messages['wait'] = ('Skipping step {}. Other worker ' +
+                                        'already scanned.').format(step)
+                    continue
 
-            # Mark scanned
-            item['done'] = 'Scanned'
-            status['index_of_queue_item'] = i
-            status['queue_version'] = self.queue_version
+                if datetime.utcnow() < self.next_band_date:
+                    return -1, 0, 0, 0, messages, 0
+
+                if not self.ready or queue_version != self.queue_version:
+                    messages['wait'] = ('Search aborting.'
+                                        + ' Overseer refreshing queue.')
+                    return -1, 0, 0, 0, messages, 0
+
+                meters = distance(loc, worker_loc) if worker_loc else 0
+                if (meters > (now_date - last_action).total_seconds() *
+                        self.args.kph / 3.6):
+                    # Flag item as "parked" by a specific thread, because
+                    # we're waiting for it. This will avoid all threads
+                    # "walking" to the same item.
+                    our_parked_name = status['username']
+
+                    # CTRL+F 'parked_last_update' in this file for more info.
+                    q.parked[i] = [our_parked_name, default_timer()]
+
+                    messages['wait'] = (
+                        'Moving {}m to step {} for a {}.'.format(
+                            int(meters), step, best['kind']))
+                    # So we wait while the worker arrives at the destination
+                    # But we don't want to sleep too long or the item might
+                    # get taken by another worker
+                    if secs_to_arrival > 179 - self.args.scan_delay:
+                        secs_to_arrival = 179 - self.args.scan_delay
+                    return -1, 0, 0, 0, messages, max(secs_to_arrival, 0)
+
+                # If a new band, set the date to wait until for the next
+                # band.
+                if (best['kind'] == 'band' and
+                        best['end'] - best['start'] > 5 * 60):
+                    self.next_band_date = datetime.utcnow() + timedelta(
+                        seconds=self.band_spacing)
+
+                # Mark scanned
+                q.state[i] = SpeedQueue.SCANNED
+                q.parked.pop(i, None)
+                status['index_of_queue_item'] = i
+                status['queue_version'] = queue_version
 
             messages['search'] = 'Scanning step {} for a {}.'.format(
                 best['step'], best['kind'])
             return best['step'], best['loc'], 0, 0, messages, 0
 
+        return -1, 0, 0, 0, messages, 0
+
+    # Returns the best item in the queue for a worker, and stats of the
+    # items skipped for logging. Groups are searched by the score an item at
+    # the nearest point of their tile would have, and the search stops when
+    # that can't beat the best item found so far. Items are sorted on start,
+    # so the search of a group stops at the first item the worker would get
+    # to early from anywhere in its tile.
+    def _find_best(self, q, ms, now_date, worker_loc, last_action,
+                   our_parked_name):
+        best = {}
+        best_score = 0
+        # Keep some stats for logging purposes. If something goes wrong, we
+        # can track what happened.
+        counts = {'parked': 0, 'early': 0, 'late': 0,
+                  'min_parked_time_remaining': 0}
+        if not q:
+            return best, counts
+
+        secs_waited = (now_date - last_action).total_seconds()
+        tiles = []
+        for center, radius in zip(self.tile_centers, self.tile_radii):
+            if worker_loc:
+                # Distances are rounded out by a meter.
+                meters = distance(center, worker_loc)
+                tiles.append((max(meters - radius - 1, 0),
+                              meters + radius + 1))
+            else:
+                tiles.append((0, 0))
+
+        # Best score an item of each group could have, highest first.
+        kinds = len(SpeedQueue.kinds)
+        groups = sorted(
+            (-SpeedQueue.scores[g % kinds] / (tiles[g // kinds][0] + 10.0),
+             g) for g, group in enumerate(q.groups) if group)
+
+        for bound, g in groups:
+            if -bound < best_score:
+                break
+
+            group = q.groups[g]
+            # Move the head under the lock release() moves it back under, so
+            # an item put back meanwhile isn't skipped.
+            with self.lock_next_item:
+                head = q.group_heads[g]
+                while head < len(group) and (
+                        q.state[group[head][0]] != SpeedQueue.PENDING or
+                        group[head][2] < ms):
+                    head += 1
+                q.group_heads[g] = head
+
+            kind = g % kinds
+            latest_arrival = max(
+                tiles[g // kinds][1] / self.args.kph * 3.6 - secs_waited, 0)
+            for i, start, end, cell in itertools.islice(group, head, None):
+                if ms + latest_arrival < start:
+                    break
+
+                # If already claimed by another worker, done or timed out,
+                # pass.
+                if q.state[i] != SpeedQueue.PENDING or ms > end:
+                    continue
+
+                # If the item is parked by a different thread (or by a
+                # different account, which should be on that one thread),
+                # pass.
+                parked = q.parked.get(i)
+                parked_last_update = None
+                if parked:
+                    # We use 'parked_last_update' to determine when the
+                    # last time was since the thread passed the item with the
+                    # same thread name & username. If it's been too long, unset
+                    # the park so another worker can pick it up.
+                    now = default_timer()
+                    max_parking_idle_seconds = 3 * 60
+                    parked_last_update = parked[1]
+                    time_passed = now - parked_last_update
+                    time_remaining = (max_parking_idle_seconds - time_passed)
+
+                    # Update logging stats.
+                    if not counts['min_parked_time_remaining']:
+                        counts['min_parked_time_remaining'] = time_remaining
+                    elif time_remaining < counts['min_parked_time_remaining']:
+                        counts['min_parked_time_remaining'] = time_remaining
+
+                    # Check parked status, and don't skip it when it's been
+                    # too long. It's unparked when claimed.
+                    if (time_passed <= max_parking_idle_seconds and
+                            parked[0] != our_parked_name):
+                        # Still parked and not our item. Skip it.
+                        counts['parked'] += 1
+                        continue
+
+                # If we are going to get there before it starts then ignore.
+                loc = self.cell_locs[cell]
+                if worker_loc:
+                    meters = distance(loc, worker_loc)
+                    secs_to_arrival = meters / self.args.kph * 3.6
+                    secs_to_arrival = max(secs_to_arrival - secs_waited, 0)
+                else:
+                    meters = 0
+                    secs_to_arrival = 0
+                if ms + secs_to_arrival < start:
+                    counts['early'] += 1
+                    continue
+
+                # If we can't make it there before it disappears, don't bother
+                # trying.
+                if ms + secs_to_arrival > end:
+                    counts['late'] += 1
+                    continue
+
+                # For spawns, score is purely based on how close they are to
+                # last worker position
+                score = SpeedQueue.scores[kind] / (meters + 10.0)
+
+                if score > best_score or (score == best_score and
+                                          i < best['i']):
+                    best_score = score
+                    best = {'score': score, 'i': i,
+                            'secs_to_arrival': secs_to_arrival,
+                            'loc': loc, 'step': self.cell_steps[cell],
+                            'kind': SpeedQueue.kinds[kind], 'start': start,
+                            'end': end,
+                            'parked_last_update': parked_last_update}
+
+        return best, counts
+
     def task_done(self, status, parsed=False):
         if parsed:
+            # The scan links the spawnpoints it saw to its cell.
+            self.spawn_point_links.add(
+                cellid((status['latitude'], status['longitude'])),
+                parsed['sp_id_list'])
+
             # Record delay between spawn time and scanning for statistics
             # This now holds the actual time of scan in seconds
             scan_secs = parsed['scan_secs']
@@ -1105,38 +1351,44 @@ class SpeedScan(HexSearch):
             if status['queue_version'] != self.queue_version:
                 log.info('Step item has changed since queue refresh')
                 return
-            item = self.queues[0][status['index_of_queue_item']]
-            start_secs = item['start']
-            if item['kind'] == 'spawn':
+            q = self.queues[0]
+            i = status['index_of_queue_item']
+            kind = SpeedQueue.kinds[q.kind[i]]
+            step = self.cell_steps[q.cell[i]]
+            start_secs = q.start[i]
+            if kind == 'spawn':
                 start_secs -= self.args.spawn_delay
             start_delay = (scan_secs - start_secs) % 3600
-            safety_buffer = item['end'] - scan_secs
+            safety_buffer = q.end[i] - scan_secs
             if safety_buffer < 0:
                 log.warning('Too late by %d sec for a %s at step %d', -
-                            safety_buffer, item['kind'], item['step'])
+                            safety_buffer, kind, step)
 
             # If we had a 0/0/0 scan, then unmark as done so we can retry, and
             # save for Statistics
             elif parsed['bad_scan']:
-                self.scans_missed_list.append(cellid(item['loc']))
+                cell = self.cells[q.cell[i]]
+                self.scans_missed_list.append(cell)
                 # Only try for a set amount of times (BAD_SCAN_RETRY)
                 if self.args.bad_scan_retry > 0 and (
-                        self.scans_missed_list.count(cellid(item['loc'])) >
+                        self.scans_missed_list.count(cell) >
                         self.args.bad_scan_retry):
                     log.info('Step %d failed scan for %d times! Giving up...',
-                             item['step'], self.args.bad_scan_retry + 1)
+                             step, self.args.bad_scan_retry + 1)
                 else:
-                    item['done'] = None
-                    log.info('Putting back step %d in queue', item['step'])
+                    with self.lock_next_item:
+                        q.release(i)
+                    log.info('Putting back step %d in queue', step)
             else:
                 # Scan returned data
                 self.scans_done += 1
-                item['done'] = start_delay
+                q.state[i] = SpeedQueue.TIMED
+                q.delay[i] = start_delay
 
                 # Were we looking for spawn?
-                if item['kind'] == 'spawn':
+                if kind == 'spawn':
 
-                    sp_id = item['sp']
+                    sp_id = self.sp_ids[q.sp[i]]
                     # Did we find the spawn?
                     if sp_id in parsed['sp_id_list']:
                         self.spawns_found += 1
@@ -1148,17 +1400,16 @@ class SpeedScan(HexSearch):
                         self.spawns_missed_delay[
                             sp_id] = self.spawns_missed_delay.get(sp_id, [])
                         self.spawns_missed_delay[sp_id].append(start_delay)
-                        item['done'] = 'Scanned'
+                        q.state[i] = SpeedQueue.SCANNED
 
                 # For existing spawn points, if in any other queue items, mark
                 # 'scanned'
                 for sp_id in parsed['sp_id_list']:
-                    for item in self.queues[0]:
-                        if (sp_id == item.get('sp', None) and
-                                item.get('done', None) is None and
-                                scan_secs > item['start'] and
-                                scan_secs < item['end']):
-                            item['done'] = 'Scanned'
+                    for j in q.sp_items.get(self.sp_index.get(sp_id), ()):
+                        if (q.state[j] == SpeedQueue.PENDING and
+                                scan_secs > q.start[j] and
+                                scan_secs < q.end[j]):
+                            q.state[j] = SpeedQueue.SCANNED
 
 
 # The SchedulerFactory returns an instance of the correct type of scheduler.
@@ -49,8 +49,9 @@ from .account import setup_api, check_login, AccountSet
 from .apiRequests import gym_get_info, get_map_objects as gmo
 from .captcha import captcha_overseer_thread, handle_captcha
 from .models import (parse_map, GymDetails, parse_gyms, MainWorker,
-                     WorkerStatus, HashKeys)
+                     WorkerStatus, HashKeys, MapParser)
 from .proxy import get_new_proxy
+from .replay import ResponseRecorder
 from .transform import get_new_coords
 from .utils import now, distance
 
@@ -329,7 +330,7 @@ def worker_status_db_thread(threads_status, name, db_updates_queue):
 
 # The main search loop that keeps an eye on the over all process.
 def search_overseer_thread(args, new_location_queue, control_flags, heartb,
-                           db_updates_queue, wh_queue):
+                           db_updates_queue, wh_queue, db_write_behind=None):
 
     log.info('Search overseer starting...')
 
@@ -347,6 +348,17 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
     if args.gym_info:
         gym_cache = TTLCache(maxsize=10000, ttl=60)
 
+    # Map responses are processed off the search worker threads.
+    map_parser = None
+    if args.map_parser_threads > 0:
+        map_parser = MapParser(args.map_parser_threads,
+                               args.map_parser_queue_size)
+
+    # Responses recorded for contrib/replay-responses.py.
+    recorder = None
+    if args.record_responses:
+        recorder = ResponseRecorder(args.record_responses)
+
     '''
     Create a queue of accounts for workers to pull from. When a worker has
     failed too many times, it can get a new account from the queue and
@@ -498,7 +510,8 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
         argset = (
             args, account_queue, account_sets, account_failures,
             account_captchas, control_flags, threadStatus[workerId],
-            db_updates_queue, wh_queue, scheduler, key_scheduler, gym_cache)
+            db_updates_queue, wh_queue, scheduler, key_scheduler, gym_cache,
+            map_parser, recorder)
 
         t = Thread(target=search_worker_thread,
                    name='search-worker-{}'.format(i),
@@ -594,7 +607,8 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
             time.sleep(10)
         threadStatus['Overseer']['message'] += '\n' + get_stats_message(
             threadStatus, search_items_queue_array, db_updates_queue, wh_queue,
-            account_queue, account_failures, account_captchas)
+            account_queue, account_failures, account_captchas,
+            db_write_behind, map_parser)
 
         # If enabled, display statistics information into logs on a
         # periodic basis.
@@ -650,7 +664,8 @@ def wh_status_update(args, status, wh_queue, scheduler):
 
 def get_stats_message(threadStatus, search_items_queue_array, db_updates_queue,
                       wh_queue, account_queue, account_failures,
-                      account_captchas):
+                      account_captchas, db_write_behind=None,
+                      map_parser=None):
     overseer = threadStatus['Overseer']
     starttime = overseer['starttime']
     elapsed = now() - starttime
@@ -683,6 +698,19 @@ def get_stats_message(threadStatus, search_items_queue_array, db_updates_queue,
              account_queue.qsize(),
              len(account_failures), len(account_captchas))
 
+    if map_parser:
+        message += 'Map parser queues: {} map responses.\n'.format(
+            map_parser.qsize())
+
+    if db_write_behind:
+        stats = db_write_behind.stats()
+        message += (
+            'DB writes: {} rows pending, {} of {} merged, {} flushes, ' +
+            'flush latency {:.3f}s (max {:.3f}s)\n'
+        ).format(stats['pending_rows'], stats['rows_merged'],
+                 stats['rows_received'], stats['flushes'],
+                 stats['last_flush_latency'], stats['max_flush_latency'])
+
     message += (
         'Total active: {}  |  Success: {} ({:.1f}/hr) | ' +
         'Fails: {} ({:.1f}/hr) | Empties: {} ({:.1f}/hr) | ' +
@@ -797,7 +825,8 @@ def generate_hive_locations(current_location, step_distance,
 
 def search_worker_thread(args, account_queue, account_sets, account_failures,
                          account_captchas, control_flags, status, dbq, whq,
-                         scheduler, key_scheduler, gym_cache):
+                         scheduler, key_scheduler, gym_cache, map_parser,
+                         recorder):
 
     log.debug('Search worker thread starting...')
 
@@ -1045,9 +1074,15 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                         time.sleep(3)
                         break
 
+                    if recorder:
+                        recorder.record(
+                            'GET_MAP_OBJECTS', step_location, scan_date,
+                            response_dict['responses']['GET_MAP_OBJECTS'])
+
                     parsed = parse_map(args, response_dict, step_location,
                                        dbq, whq, key_scheduler, api, status,
-                                       scan_date, account, account_sets)
+                                       scan_date, account, account_sets,
+                                       map_parser)
 
                     scheduler.task_done(status, parsed)
                     if parsed['count'] > 0:
@@ -1167,6 +1202,11 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                             else:
                                 gym_responses[gym['gym_id']] = response[
                                     'responses']['GYM_GET_INFO']
+                                if recorder:
+                                    recorder.record(
+                                        'GYM_GET_INFO', step_location,
+                                        datetime.utcnow(),
+                                        gym_responses[gym['gym_id']])
                             del response
                             # Increment which gym we're on for status messages.
                             current_gym += 1
@@ -1,8 +1,15 @@
+import sys
 import math
 import geopy
 import geopy.distance
 import random
 
+# NumPy is optional, it's only used to transform many coordinates at once.
+try:
+    import numpy
+except ImportError:
+    pass
+
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
@@ -29,6 +36,34 @@ def transform_from_wgs_to_gcj(latitude, longitude):
     return adjust_lat, adjust_lon
 
 
+# Same as transform_from_wgs_to_gcj() for lists of latitudes and longitudes,
+# in one pass over arrays if NumPy is installed.
+def transform_many_from_wgs_to_gcj(latitudes, longitudes):
+    if 'numpy' not in sys.modules:
+        adjusted = [transform_from_wgs_to_gcj(lat, lng)
+                    for lat, lng in zip(latitudes, longitudes)]
+        return [x[0] for x in adjusted], [x[1] for x in adjusted]
+
+    latitude = numpy.asarray(latitudes, dtype=float)
+    longitude = numpy.asarray(longitudes, dtype=float)
+    adjust_lat = transform_lat(longitude - 105, latitude - 35.0, numpy)
+    adjust_lon = transform_long(longitude - 105, latitude - 35.0, numpy)
+    rad_lat = latitude / 180.0 * pi
+    magic = numpy.sin(rad_lat)
+    magic = 1 - ee * magic * magic
+    sqrt_magic = numpy.sqrt(magic)
+    adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) /
+                                         (magic * sqrt_magic) * pi)
+    adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic *
+                                         numpy.cos(rad_lat) * pi)
+
+    out_of_china = ((longitude < 72.004) | (longitude > 137.8347) |
+                    (latitude < 0.8293) | (latitude > 55.8271))
+    adjust_lat = numpy.where(out_of_china, latitude, latitude + adjust_lat)
+    adjust_lon = numpy.where(out_of_china, longitude, longitude + adjust_lon)
+    return adjust_lat.tolist(), adjust_lon.tolist()
+
+
 def is_location_out_of_china(latitude, longitude):
     if (longitude < 72.004 or longitude > 137.8347 or
             latitude < 0.8293 or latitude > 55.8271):
@@ -36,27 +71,27 @@ def is_location_out_of_china(latitude, longitude):
     return False
 
 
-def transform_lat(x, y):
+def transform_lat(x, y, mathlib=math):
     lat = (-100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y +
-           0.1 * x * y + 0.2 * math.sqrt(abs(x)))
-    lat += (20.0 * math.sin(6.0 * x * pi) + 20.0 *
-            math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lat += (20.0 * math.sin(y * pi) + 40.0 *
-            math.sin(y / 3.0 * pi)) * 2.0 / 3.0
-    lat += (160.0 * math.sin(y / 12.0 * pi) + 320 *
-            math.sin(y * pi / 30.0)) * 2.0 / 3.0
+           0.1 * x * y + 0.2 * mathlib.sqrt(abs(x)))
+    lat += (20.0 * mathlib.sin(6.0 * x * pi) + 20.0 *
+            mathlib.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lat += (20.0 * mathlib.sin(y * pi) + 40.0 *
+            mathlib.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    lat += (160.0 * mathlib.sin(y / 12.0 * pi) + 320 *
+            mathlib.sin(y * pi / 30.0)) * 2.0 / 3.0
     return lat
 
 
-def transform_long(x, y):
+def transform_long(x, y, mathlib=math):
     lon = (300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y +
-           0.1 * math.sqrt(abs(x)))
-    lon += (20.0 * math.sin(6.0 * x * pi) + 20.0 *
-            math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lon += (20.0 * math.sin(x * pi) + 40.0 *
-            math.sin(x / 3.0 * pi)) * 2.0 / 3.0
-    lon += (150.0 * math.sin(x / 12.0 * pi) + 300.0 *
-            math.sin(x / 30.0 * pi)) * 2.0 / 3.0
+           0.1 * mathlib.sqrt(abs(x)))
+    lon += (20.0 * mathlib.sin(6.0 * x * pi) + 20.0 *
+            mathlib.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lon += (20.0 * mathlib.sin(x * pi) + 40.0 *
+            mathlib.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    lon += (150.0 * mathlib.sin(x / 12.0 * pi) + 300.0 *
+            mathlib.sin(x / 30.0 * pi)) * 2.0 / 3.0
     return lon
 
 
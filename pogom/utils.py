@@ -20,9 +20,10 @@ from geopy.geocoders import GoogleV3
 from requests_futures.sessions import FuturesSession
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
-from cHaversine import haversine
 from pprint import pformat
 
+from .geo import haversine_distance_m
+
 log = logging.getLogger(__name__)
 
 
@@ -309,6 +310,11 @@ def get_args():
                         help=('Use speed scanning to identify spawn points ' +
                               'and then scan closest spawns.'),
                         action='store_true', default=False)
+    parser.add_argument('-spld', '--spawnpoint-links-dir',
+                        help=('Directory to save the links between speed ' +
+                              'scan steps and spawn points in, so a restart ' +
+                              'loads them instead of querying the database.'),
+                        default=None)
     parser.add_argument('-spin', '--pokestop-spinning',
                         help=('Spin Pokestops with 50%% probability.'),
                         action='store_true', default=False)
@@ -384,6 +390,62 @@ def get_args():
                         help=('Number of db threads; increase if the db ' +
                               'queue falls behind.'),
                         type=int, default=1)
+    parser.add_argument('--db-pool-size',
+                        help=('Maximum number of MySQL connections shared ' +
+                              'by the gym, account and lure DB modules.'),
+                        type=int, default=10)
+    parser.add_argument('--db-pool-timeout',
+                        help=('Time (in seconds) to wait for a free ' +
+                              'connection in the MySQL connection pool.'),
+                        type=float, default=30.0)
+    parser.add_argument('--record-responses',
+                        help=('Append the map and gym info responses of ' +
+                              'all scans to this file, to replay them with ' +
+                              'contrib/replay-responses.py.'),
+                        default=None)
+    parser.add_argument('--map-parser-threads',
+                        help=('Number of threads processing map responses ' +
+                              'after the search worker has read what it ' +
+                              'needs from them. 0 to process them on the ' +
+                              'search worker threads.'),
+                        type=int, default=0)
+    parser.add_argument('--map-parser-queue-size',
+                        help=('Map responses each map parser thread holds ' +
+                              'before search workers wait for it to catch ' +
+                              'up.'),
+                        type=int, default=50)
+    parser.add_argument('--db-flush-interval',
+                        help=('Time (in seconds) to coalesce queued DB ' +
+                              'updates per table before writing them.'),
+                        type=float, default=1.0)
+    parser.add_argument('--db-flush-rows',
+                        help=('Write a table\'s coalesced DB updates as ' +
+                              'soon as this many rows are pending.'),
+                        type=int, default=5000)
+    parser.add_argument('--db-upsert-mode',
+                        help=('How existing rows are upserted. "update" ' +
+                              'rewrites changed columns in place with ' +
+                              'INSERT ... ON DUPLICATE KEY UPDATE, ' +
+                              '"replace" deletes and re-inserts them with ' +
+                              'REPLACE.'),
+                        choices=['update', 'replace'], default='update')
+    parser.add_argument('--live-cache',
+                        help=('Keep active Pokemon, Pokestops, gyms and ' +
+                              'raids in memory and serve the map from it ' +
+                              'instead of querying the database. Has no ' +
+                              'effect with -os/--only-server.'),
+                        action='store_true', default=False)
+    parser.add_argument('--live-cache-changes',
+                        help=('Number of recent changes the live cache ' +
+                              'remembers to send the map only what changed ' +
+                              'since its last update.'),
+                        type=int, default=100000)
+    parser.add_argument('--stream-map-data',
+                        help=('Stream map data responses, encoding map ' +
+                              'objects as they are read from the database ' +
+                              'instead of building the whole response in ' +
+                              'memory first.'),
+                        action='store_true', default=False)
     parser.add_argument('-wh', '--webhook',
                         help='Define URL(s) to POST webhook information to.',
                         default=None, dest='webhooks', action='append')
@@ -407,12 +469,41 @@ def get_args():
                               'webhook queue falls behind.'),
                         type=int, default=1)
     parser.add_argument('-whc', '--wh-concurrency',
-                        help=('Async requests pool size.'), type=int,
+                        help=('Maximum number of requests in flight to ' +
+                              'each webhook.'), type=int,
                         default=25)
+    parser.add_argument('-whqs', '--wh-queue-size',
+                        help=('Maximum number of messages waiting for each ' +
+                              'webhook. The oldest ones are dropped when a ' +
+                              'webhook falls behind.'),
+                        type=int, default=10000)
+    parser.add_argument('-whmfs', '--wh-max-frame-size',
+                        help=('Maximum number of messages sent in one ' +
+                              'webhook request, 0 for no limit.'),
+                        type=int, default=1000)
+    parser.add_argument('-whod', '--wh-outbox-dir',
+                        help=('Directory of the persistent webhook outbox. ' +
+                              'Messages are written there before they are ' +
+                              'sent, and sent after a restart or once a ' +
+                              'webhook is back up. Disabled if not set.'),
+                        default=None)
+    parser.add_argument('-whor', '--wh-outbox-retention',
+                        help=('Minutes to keep the messages in the webhook ' +
+                              'outbox if they are not sent.'),
+                        type=int, default=60)
+    parser.add_argument('-whos', '--wh-outbox-size',
+                        help=('Maximum size (in MB) of the webhook outbox. ' +
+                              'The oldest messages are dropped past it.'),
+                        type=int, default=256)
     parser.add_argument('-whr', '--wh-retries',
                         help=('Number of times to retry sending webhook ' +
                               'data on failure.'),
                         type=int, default=3)
+    parser.add_argument('-whrb', '--wh-retry-budget',
+                        help=('Retries earned by each webhook request, so ' +
+                              'a webhook that is down is not flooded with ' +
+                              'retries.'),
+                        type=float, default=0.2)
     parser.add_argument('-wht', '--wh-timeout',
                         help='Timeout (in seconds) for webhook requests.',
                         type=float, default=1.0)
@@ -816,7 +907,7 @@ def cellid(loc):
 
 # Return approximate distance in meters.
 def distance(pos1, pos2):
-    return haversine((tuple(pos1))[0:2], (tuple(pos2))[0:2])
+    return haversine_distance_m(pos1, pos2)
 
 
 # Return True if distance between two locs is less than distance in meters.
@@ -862,6 +953,21 @@ def get_pokemon_data(pokemon_id):
     return get_pokemon_data.pokemon[str(pokemon_id)]
 
 
+# Translated (name, rarity, types) of every Pokemon, indexed by Pokemon id.
+# Built once, so map queries don't look up each row separately.
+def get_pokemon_details():
+    if not hasattr(get_pokemon_details, 'table'):
+        get_pokemon_data(1)
+        pokemon_ids = [int(x) for x in get_pokemon_data.pokemon]
+        table = [None] * (max(pokemon_ids) + 1)
+        for pokemon_id in pokemon_ids:
+            table[pokemon_id] = (get_pokemon_name(pokemon_id),
+                                 get_pokemon_rarity(pokemon_id),
+                                 get_pokemon_types(pokemon_id))
+        get_pokemon_details.table = table
+    return get_pokemon_details.table
+
+
 def get_pokemon_name(pokemon_id):
     return i8ln(get_pokemon_data(pokemon_id)['name'])
 
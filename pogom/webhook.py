@@ -1,11 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
 import logging
-import requests
+import itertools
 import threading
 
-from queue import Empty
+from collections import Counter, OrderedDict
+from requests.compat import urlparse
 from cachetools import LFUCache
 from timeit import default_timer
 
@@ -16,143 +24,672 @@ log = logging.getLogger(__name__)
 wh_lock = threading.Lock()
 
 
-def send_to_webhooks(args, session, message_frame):
-    if not args.webhooks:
-        # What are you even doing here...
-        log.critical('Called send_to_webhook() without webhooks.')
-        return
+class WebhookKeyCache(object):
+    '''
+    LFU cache of the key fields hash of the last message sent for each
+    ident of a message type, to only send messages that changed.
+
+    The idents are spread over shards, each with its own lock, so webhook
+    threads rarely wait for each other.
+    '''
+
+    def __init__(self, whtype, maxsize, shards=16):
+        self.whtype = whtype
+        size = max(maxsize // shards, 1)
+        self.shards = [(LFUCache(maxsize=size), threading.Lock())
+                       for _ in range(shards)]
+
+    # Returns whether the message changed since it was last sent, and
+    # remembers it.
+    def update(self, ident, message):
+        cache, lock = self.shards[hash(ident) % len(self.shards)]
+        new = key_hash(self.whtype, message)
+        with lock:
+            # Getting the old hash also updates the LFU usage count.
+            if cache.get(ident) == new:
+                return False
+            cache[ident] = new
+        return True
 
-    req_timeout = args.wh_timeout
 
-    for w in args.webhooks:
+# Extract the proper identifier. This list also controls which message
+# types are getting cached, and coalesced by the webhook endpoints.
+ident_fields = {
+    'pokestop': 'pokestop_id',
+    'pokemon': 'encounter_id',
+    'gym': 'gym_id',
+    'gym_details': 'id',
+    'raid': 'gym_id'
+}
+
+
+class WebhookEndpoint(object):
+    '''
+    Sends the webhook messages of one URL from its own thread, so a slow
+    receiver only delays its own messages.
+
+    Pending messages are coalesced per type and ident, the newest one is
+    sent in place of the older one, and the oldest messages are dropped
+    once more than --wh-queue-size are pending. At most --wh-concurrency
+    frames of --wh-max-frame-size messages are in flight at once, over
+    kept-alive connections. Failed frames are retried --wh-retries times,
+    as long as the retry budget allows it.
+
+    Endpoints that aren't framed, like Discord webhooks, get every message
+    on its own, as the request body.
+
+    With an outbox, the endpoint reads its messages from the outbox as it
+    has room for them instead, nothing is dropped, and failed frames are
+    retried until they're sent.
+    '''
+
+    # Seconds between two logs of the endpoint's stats.
+    stats_interval = 60
+    # Maximum seconds to wait before retrying a frame.
+    max_backoff = 60
+
+    def __init__(self, args, index, url, session, framed=True,
+                 headers=None, outbox=None):
+        self.url = url
+        self.session = session
+        self.framed = framed
+        self.headers = headers
+        self.outbox = outbox
+        self.timeout = args.wh_timeout
+        self.frame_interval = args.wh_frame_interval / 1000.0
+        self.max_frame_size = args.wh_max_frame_size if framed else 1
+        self.queue_size = args.wh_queue_size
+        self.retries = args.wh_retries
+        self.backoff_factor = args.wh_backoff_factor
+        self.retry_budget = args.wh_retry_budget
+        # Each frame sent earns retry_budget retries, up to max_retry_tokens,
+        # so a receiver that's down isn't flooded with retries.
+        self.max_retry_tokens = 10.0
+        self.retry_tokens = self.max_retry_tokens
+
+        self.in_flight = threading.BoundedSemaphore(args.wh_concurrency)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.room = threading.Condition(self.lock)
+        # Key -> (frame message, attempts, outbox seq), in the order they're
+        # sent.
+        self.pending = OrderedDict()
+        # Outbox seqs of the messages that are pending or in flight.
+        self.unsent = set()
+        self.first_pending = None
+        self.backoff_until = 0
+        self.unkeyed = itertools.count()
+
+        self.messages = 0
+        self.frames = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = Counter()
+        self.dropped = Counter()
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.stats_timer = default_timer()
+
+        t = threading.Thread(target=self.run,
+                             name='wh-sender-{}'.format(index))
+        t.daemon = True
+        t.start()
+
+        if outbox is not None:
+            t = threading.Thread(target=self.feed,
+                                 name='wh-outbox-{}'.format(index),
+                                 args=(outbox.register(url),))
+            t.daemon = True
+            t.start()
+
+    def put(self, whtype, message, attempts=0, seq=None):
+        ident = message.get(ident_fields.get(whtype))
+        if ident is None:
+            key = next(self.unkeyed)
+        else:
+            key = (whtype, ident)
+
+        with self.ready:
+            if key in self.pending:
+                if attempts:
+                    # A newer message is already waiting.
+                    self.unsent.discard(seq)
+                    return
+                self.coalesced[whtype] += 1
+                self.unsent.discard(self.pending[key][2])
+            elif len(self.pending) >= self.queue_size:
+                old, _, old_seq = self.pending.popitem(last=False)[1]
+                self.dropped[old['type']] += 1
+                self.unsent.discard(old_seq)
+            self.pending[key] = ({'type': whtype, 'message': message},
+                                 attempts, seq)
+            if seq is not None:
+                self.unsent.add(seq)
+            if self.first_pending is None:
+                self.first_pending = default_timer()
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            try:
+                self.in_flight.acquire()
+                try:
+                    frame = self._next_frame()
+                except Exception:
+                    # No request went out to give the permit back.
+                    self.in_flight.release()
+                    raise
+                self._post(frame)
+            except Exception as e:
+                log.exception('Exception in webhook sender for %s: %s.',
+                              self.url, e)
+
+    # Reads the messages from the outbox while there's room for them, and
+    # moves the endpoint's cursor past the messages that were sent.
+    def feed(self, seq):
+        while True:
+            try:
+                # Messages in flight count too, so the retries never make
+                # the endpoint drop a message.
+                with self.room:
+                    while len(self.unsent) >= self.queue_size:
+                        self.room.wait(1)
+                    room = self.queue_size - len(self.unsent)
+                    # Every message before seq was put, the ones still
+                    # unsent have to be sent again after a restart.
+                    self.outbox.commit(
+                        self.url, min(self.unsent) if self.unsent else seq)
+
+                seq, records = self.outbox.read(seq, room, 1)
+                for record_seq, record in records:
+                    self.put(record['type'], record['message'],
+                             seq=record_seq)
+            except Exception as e:
+                log.exception('Exception in webhook outbox reader for %s: '
+                              '%s.', self.url, e)
+
+    # Waits for the frame interval since the first pending message, or for
+    # a full frame, and takes the frame.
+    def _next_frame(self):
+        with self.ready:
+            while True:
+                now = default_timer()
+                if now - self.stats_timer > self.stats_interval:
+                    self._log_stats(now)
+                if not self.pending:
+                    self.ready.wait(self.stats_interval)
+                    continue
+
+                due = self.backoff_until
+                if (not self.max_frame_size or
+                        len(self.pending) < self.max_frame_size):
+                    due = max(due, self.first_pending + self.frame_interval)
+                if due <= now:
+                    break
+                self.ready.wait(due - now)
+
+            size = self.max_frame_size or len(self.pending)
+            frame = []
+            while self.pending and len(frame) < size:
+                frame.append(self.pending.popitem(last=False)[1])
+            self.first_pending = now if self.pending else None
+
+        return frame
+
+    def _post(self, frame):
+        log.debug('Sending %d items to webhook %s.', len(frame), self.url)
         try:
-            # Disable keep-alive and set streaming to True, so we can skip
-            # the response content.
-            future = session.post(w, json=message_frame,
-                                  timeout=(None, req_timeout),
-                                  background_callback=__wh_request_completed,
-                                  headers={'Connection': 'close'},
-                                  stream=True)
-            future.add_done_callback(__wh_future_completed)
-        except requests.exceptions.ReadTimeout:
-            log.exception('Response timeout on webhook endpoint %s.', w)
-        except requests.exceptions.RequestException as e:
-            log.exception('Request exception on webhook: %s.', e)
-
-
-def wh_updater(args, queue, key_caches):
+            if self.framed:
+                data = [item[0] for item in frame]
+            else:
+                data = frame[0][0]['message']
+            future = self.session.post(self.url, json=data,
+                                       headers=self.headers,
+                                       timeout=(None, self.timeout))
+        except Exception as e:
+            self._completed(frame, default_timer(), None, e)
+            return
+
+        start = default_timer()
+        future.add_done_callback(
+            lambda f: self._completed(frame, start, f, f.exception()))
+
+    def _completed(self, frame, start, future, exc):
+        self.in_flight.release()
+        latency = default_timer() - start
+        # Connection and server errors are retried, the receiver won't
+        # accept the frame any better the next time otherwise.
+        retry = exc is not None
+        if exc is None and future.result().status_code >= 400:
+            status = future.result().status_code
+            exc = 'HTTP status {}'.format(status)
+            retry = status >= 500
+
+        with self.lock:
+            self.frames += 1
+            self.retry_tokens = min(self.retry_tokens + self.retry_budget,
+                                    self.max_retry_tokens)
+            if exc is None:
+                self.messages += len(frame)
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                self.backoff_until = 0
+                self.unsent.difference_update(item[2] for item in frame)
+                self.room.notify()
+                return
+
+            self.failed += 1
+            attempts = frame[0][1] + 1
+            # The outbox keeps the messages until the webhook is back.
+            retry = retry and (self.outbox is not None or (
+                attempts <= self.retries and self.retry_tokens >= 1))
+            if retry:
+                self.retry_tokens = max(self.retry_tokens - 1, 0)
+                self.retried += 1
+                self.backoff_until = default_timer() + min(
+                    self.backoff_factor * 2 ** min(attempts - 1, 16),
+                    self.max_backoff)
+            else:
+                self.unsent.difference_update(item[2] for item in frame)
+                self.room.notify()
+
+        log.warning('Webhook %s failed to receive %d items%s: %s.', self.url,
+                    len(frame), ', retrying' if retry else '', exc)
+        if retry:
+            for message, _, seq in frame:
+                self.put(message['type'], message['message'], attempts, seq)
+
+    def _log_stats(self, now):
+        sent = self.frames - self.failed
+        if self.frames or self.dropped:
+            log.info('Webhook %s: sent %d items in %d frames (%.0f ms avg, '
+                     '%.0f ms max), %d failed frames, %d retries, %d '
+                     'pending, coalesced %s, dropped %s.', self.url,
+                     self.messages, sent,
+                     self.latency_total * 1000 / sent if sent else 0,
+                     self.latency_max * 1000, self.failed, self.retried,
+                     len(self.pending), dict(self.coalesced),
+                     dict(self.dropped))
+
+        self.messages = self.frames = self.failed = self.retried = 0
+        self.coalesced.clear()
+        self.dropped.clear()
+        self.latency_total = self.latency_max = 0.0
+        self.stats_timer = now
+
+
+class WebhookOutboxSegment(object):
+    '''
+    Segment file of the webhook outbox, with the records of records seqs
+    from first_seq on, and an mmap'd index of their offsets and times.
+
+    Records are written before their index entry, so the records that
+    weren't completely written before a crash are dropped when the segment
+    is opened again. They're read through a file of their own, so reads
+    don't have to wait for appends.
+    '''
+
+    # Index entry: offset of the record + 1, 0 if it's not written yet, and
+    # time it was written.
+    index_entry = struct.Struct('<Qd')
+    # Record header: length and CRC32 of the payload.
+    header = struct.Struct('<II')
+
+    def __init__(self, directory, first_seq, records):
+        self.first_seq = first_seq
+        self.records = records
+        path = os.path.join(directory, '{:020d}'.format(first_seq))
+        self.data_path = path + '.log'
+        self.index_path = path + '.idx'
+
+        self.data = io.open(self.data_path, 'a+b', buffering=0)
+        self.reader = io.open(self.data_path, 'rb', buffering=0)
+        self.read_lock = threading.Lock()
+        if not os.path.exists(self.index_path):
+            io.open(self.index_path, 'wb').close()
+        self.index_file = io.open(self.index_path, 'r+b', buffering=0)
+        length = records * self.index_entry.size
+        if os.fstat(self.index_file.fileno()).st_size < length:
+            self.index_file.truncate(length)
+        self.index = mmap.mmap(self.index_file.fileno(), length)
+
+        self.count = 0
+        while (self.count < records and
+               self.index_entry.unpack_from(
+                   self.index, self.count * self.index_entry.size)[0]):
+            self.count += 1
+        while self.count and self.read(self.count - 1) is None:
+            self.count -= 1
+            self.index_entry.pack_into(
+                self.index, self.count * self.index_entry.size, 0, 0)
+        self.size = self._end(self.count - 1) if self.count else 0
+        if os.fstat(self.data.fileno()).st_size > self.size:
+            self.data.truncate(self.size)
+
+    @property
+    def full(self):
+        return self.count >= self.records
+
+    @property
+    def end_seq(self):
+        return self.first_seq + self.count
+
+    def append(self, payload, when):
+        record = self.header.pack(len(payload),
+                                  zlib.crc32(payload) & 0xffffffff)
+        self.data.write(record + payload)
+        self.index_entry.pack_into(
+            self.index, self.count * self.index_entry.size, self.size + 1,
+            when)
+        self.size += len(record) + len(payload)
+        self.count += 1
+
+    def time(self, i):
+        return self.index_entry.unpack_from(
+            self.index, i * self.index_entry.size)[1]
+
+    # Returns the payload of record i, or None if it's not completely
+    # written or the segment was deleted.
+    def read(self, i):
+        with self.read_lock:
+            if self.reader.closed:
+                return None
+            offset = self.index_entry.unpack_from(
+                self.index, i * self.index_entry.size)[0] - 1
+            self.reader.seek(offset)
+            header = self.reader.read(self.header.size)
+            if len(header) < self.header.size:
+                return None
+            length, crc = self.header.unpack(header)
+            payload = self.reader.read(length)
+        if (len(payload) < length or
+                zlib.crc32(payload) & 0xffffffff != crc):
+            return None
+        return payload
+
+    def _end(self, i):
+        offset = self.index_entry.unpack_from(
+            self.index, i * self.index_entry.size)[0] - 1
+        self.data.seek(offset)
+        length = self.header.unpack(self.data.read(self.header.size))[0]
+        return offset + self.header.size + length
+
+    def sync(self):
+        os.fsync(self.data.fileno())
+        self.index.flush()
+
+    def close(self):
+        with self.read_lock:
+            self.index.close()
+            self.index_file.close()
+            self.reader.close()
+            self.data.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.data_path)
+        os.remove(self.index_path)
+
+
+class WebhookOutbox(object):
+    '''
+    Append-only log of the webhook messages that passed the caches, in
+    --wh-outbox-dir, so they aren't lost on a restart or held in memory
+    while a webhook is down.
+
+    Every webhook reads the log from its own cursor, the seq of the first
+    message it didn't send yet. The cursors are saved every second and the
+    webhooks replay the log from them after a restart. Segments are deleted
+    once every webhook sent them, or when they're older than
+    --wh-outbox-retention minutes or make the outbox larger than
+    --wh-outbox-size MB.
+    '''
+
+    # Records in each segment.
+    segment_records = 10000
+    # Seconds between two syncs of the outbox.
+    sync_interval = 1
+
+    def __init__(self, directory, retention, max_size):
+        self.directory = directory
+        self.retention = retention * 60
+        self.max_size = max_size * 1024 * 1024
+        self.cursors_path = os.path.join(directory, 'cursors.json')
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.cursors = {}
+        self.registered = set()
+        self.saved = True
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = [
+            WebhookOutboxSegment(directory, seq, self.segment_records)
+            for seq in sorted(int(name[:-4])
+                              for name in os.listdir(directory)
+                              if name.endswith('.log') and
+                              name[:-4].isdigit())]
+        if not self.segments or self.segments[-1].full:
+            self._add_segment()
+        try:
+            with open(self.cursors_path) as f:
+                self.cursors = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        log.info('Webhook outbox %s has %d messages.', directory,
+                 self.segments[-1].end_seq - self.segments[0].first_seq)
+
+        t = threading.Thread(target=self.run, name='wh-outbox')
+        t.daemon = True
+        t.start()
+
+    def _add_segment(self):
+        seq = self.segments[-1].end_seq if self.segments else 0
+        self.segments.append(WebhookOutboxSegment(
+            self.directory, seq, self.segment_records))
+        return self.segments[-1]
+
+    def append(self, whtype, message):
+        payload = json.dumps({'type': whtype, 'message': message},
+                             separators=(',', ':')).encode('utf-8')
+        with self.appended:
+            segment = self.segments[-1]
+            if segment.full:
+                segment.sync()
+                segment = self._add_segment()
+            segment.append(payload, time.time())
+            self.appended.notify_all()
+
+    # Returns the cursor of a webhook. New webhooks start at the end of the
+    # log.
+    def register(self, name):
+        with self.lock:
+            self.registered.add(name)
+            end = self.segments[-1].end_seq
+            if self.cursors.get(name, end + 1) > end:
+                self.cursors[name] = end
+                self.saved = False
+            return self.cursors[name]
+
+    def commit(self, name, seq):
+        with self.lock:
+            if self.cursors.get(name) != seq:
+                self.cursors[name] = seq
+                self.saved = False
+
+    # Returns up to count records from seq on, waiting up to timeout
+    # seconds for one, and the seq to read next. Messages that were deleted
+    # or are older than the retention are skipped. The records are picked
+    # under the lock and read after it's released, so appends don't wait
+    # for them.
+    def read(self, seq, count, timeout):
+        found = []
+        with self.appended:
+            if seq >= self.segments[-1].end_seq:
+                self.appended.wait(timeout)
+            expired = time.time() - self.retention
+            for segment in self.segments:
+                if (seq >= segment.end_seq or not segment.count or
+                        segment.time(segment.count - 1) < expired):
+                    continue
+                seq = max(seq, segment.first_seq)
+                while seq < segment.end_seq and len(found) < count:
+                    i = seq - segment.first_seq
+                    seq += 1
+                    if segment.time(i) >= expired:
+                        found.append((segment, i))
+                if len(found) >= count:
+                    break
+            else:
+                seq = max(seq, self.segments[-1].end_seq)
+
+        records = []
+        for segment, i in found:
+            payload = segment.read(i)
+            if payload is not None:
+                records.append((segment.first_seq + i,
+                                json.loads(payload.decode('utf-8'))))
+        return seq, records
+
+    def run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self._sync()
+            except Exception as e:
+                log.exception('Exception in webhook outbox: %s.', e)
+
+    def _sync(self):
+        self.segments[-1].sync()
+
+        with self.lock:
+            end = self.segments[-1].end_seq
+            sent = min([self.cursors[name] for name in self.registered] or
+                       [end])
+            expired = time.time() - self.retention
+            size = sum(segment.size for segment in self.segments)
+            while len(self.segments) > 1:
+                segment = self.segments[0]
+                if segment.count and segment.end_seq > sent:
+                    if segment.time(segment.count - 1) >= expired:
+                        if size <= self.max_size:
+                            break
+                        log.warning('Webhook outbox is over %d MB, dropping '
+                                    '%d unsent messages.',
+                                    self.max_size // (1024 * 1024),
+                                    segment.end_seq - max(
+                                        sent, segment.first_seq))
+                size -= segment.size
+                self.segments.pop(0).delete()
+
+            if self.saved:
+                return
+            cursors = dict(self.cursors)
+            self.saved = True
+
+        # Replaced at once, so a crash can't leave half of the cursors.
+        try:
+            with open(self.cursors_path + '.tmp', 'w') as f:
+                json.dump(cursors, f)
+            getattr(os, 'replace', os.rename)(self.cursors_path + '.tmp',
+                                              self.cursors_path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to save webhook outbox cursors to %s: %s',
+                        self.cursors_path, repr(e))
+
+
+class WebhookDispatcher(object):
+    '''
+    Hands the messages that passed the caches to every --webhook endpoint.
+
+    Other endpoints, like the Discord webhooks of the standalone scanners,
+    are added with add_endpoint() and sent to directly. Endpoints on the
+    same host share a connection pool.
+
+    With --wh-outbox-dir, the messages are written to the outbox, and the
+    --webhook endpoints read them from there.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.endpoints = {}
+        self.outbox = None
+        if args.webhooks and args.wh_outbox_dir:
+            self.outbox = WebhookOutbox(args.wh_outbox_dir,
+                                        args.wh_outbox_retention,
+                                        args.wh_outbox_size)
+        self.webhooks = [self.add_endpoint(url, outbox=self.outbox)
+                         for url in args.webhooks or []]
+
+    def add_endpoint(self, url, framed=True, headers=None, outbox=None):
+        with self.lock:
+            if url not in self.endpoints:
+                host = urlparse(url).netloc
+                if host not in self.sessions:
+                    # Retries are done by the endpoints, to stay in their
+                    # budget.
+                    self.sessions[host] = get_async_requests_session(
+                        0, 0, self.args.wh_concurrency)
+                self.endpoints[url] = WebhookEndpoint(
+                    self.args, len(self.endpoints), url,
+                    self.sessions[host], framed, headers, outbox)
+            return self.endpoints[url]
+
+    def put(self, whtype, message):
+        if self.outbox is not None:
+            self.outbox.append(whtype, message)
+            return
+        for endpoint in self.webhooks:
+            endpoint.put(whtype, message)
+
+
+def wh_updater(args, queue, key_caches, dispatcher):
     wh_threshold_timer = default_timer()
     wh_over_threshold = False
 
-    # Set up one session to use for all requests.
-    # Requests to the same host will reuse the underlying TCP
-    # connection, giving a performance increase.
-    session = get_async_requests_session(
-        args.wh_retries,
-        args.wh_backoff_factor,
-        args.wh_concurrency)
-
-    # Extract the proper identifier. This list also controls which message
-    # types are getting cached.
-    ident_fields = {
-        'pokestop': 'pokestop_id',
-        'pokemon': 'encounter_id',
-        'gym': 'gym_id',
-        'gym_details': 'id',
-        'raid': 'gym_id'
-    }
-
     # Instantiate WH LFU caches for all cached types. We separate the caches
     # by ident_field types, because different ident_field (message) types can
     # use the same name for their ident field.
-    for key in ident_fields:
-        key_caches[key] = LFUCache(maxsize=args.wh_lfu_size)
-
-    # Prepare to send data per timed message frames instead of per object.
-    frame_interval_sec = (args.wh_frame_interval / 1000)
-    frame_first_message_time_sec = default_timer()
-    frame_messages = []
-    first_message = True
+    with wh_lock:
+        for key in ident_fields:
+            if key not in key_caches:
+                key_caches[key] = WebhookKeyCache(key, args.wh_lfu_size)
 
     # How low do we want the queue size to stay?
     wh_warning_threshold = 100
     # How long can it be over the threshold, in seconds?
-    # Default: 5 seconds per 100 in threshold + frame_interval_sec.
+    # Default: 5 seconds per 100 in threshold.
     wh_threshold_lifetime = int(5 * (wh_warning_threshold / 100.0))
-    wh_threshold_timer += frame_interval_sec
 
     # The forever loop.
     while True:
         try:
             # Loop the queue.
-            try:
-                timeout = frame_interval_sec if len(
-                    frame_messages) > 0 else None
-                whtype, message = queue.get(True, timeout)
-            except Empty:
-                pass
+            whtype, message = queue.get()
+
+            # Get the proper cache if this type has one.
+            key_cache = key_caches.get(whtype)
+
+            # Get the unique identifier to check our cache, if it has one.
+            ident = message.get(ident_fields.get(whtype), None)
+
+            # Only send if the message changed since it was last sent.
+            if ident is None or key_cache is None:
+                # We don't know what it is, or it doesn't have a cache,
+                # so let's just log and send as-is.
+                log.debug('Queued webhook item of uncached type: %s.',
+                          whtype)
+                send = True
             else:
-                frame_message = {'type': whtype, 'message': message}
-
-                # Get the proper cache if this type has one.
-                key_cache = None
-
-                if whtype in key_caches:
-                    key_cache = key_caches[whtype]
-
-                # Get the unique identifier to check our cache, if it has one.
-                ident = message.get(ident_fields.get(whtype), None)
-
-                # cachetools in Python2.7 isn't thread safe, so we add a lock.
-                with wh_lock:
-                    # Only send if identifier isn't already in cache.
-                    if ident is None or key_cache is None:
-                        # We don't know what it is, or it doesn't have a cache,
-                        # so let's just log and send as-is.
-                        log.debug('Queued webhook item of uncached type: %s.',
-                                  whtype)
-                        frame_messages.append(frame_message)
-                    elif ident not in key_cache:
-                        key_cache[ident] = message
-                        log.debug('Queued %s to webhook: %s.', whtype, ident)
-                        frame_messages.append(frame_message)
-                    else:
-                        # Make sure to call key_cache[ident] in all branches
-                        # so it updates the LFU usage count.
-                        # If the object has changed in an important way, send
-                        # new data to webhooks.
-                        if __wh_object_changed(whtype, key_cache[ident],
-                                               message):
-                            key_cache[ident] = message
-                            frame_messages.append(frame_message)
-                            log.debug('Queued updated %s to webhook: %s.',
-                                      whtype, ident)
-                        else:
-                            log.debug('Not queuing %s to webhook: %s.', whtype,
-                                      ident)
-                queue.task_done()
-            # Store the time when we added the first message instead of the
-            # time when we last cleared the messages, so we more accurately
-            # measure time spent getting messages from our queue.
-            now = default_timer()
-            num_messages = len(frame_messages)
-
-            if num_messages == 1 and first_message:
-                frame_first_message_time_sec = now
-                first_message = False
-
-            # If enough time has passed, send the message frame.
-            time_passed_sec = now - frame_first_message_time_sec
-
-            if num_messages > 0 and (time_passed_sec >
-                                     frame_interval_sec):
-                log.debug('Sending %d items to %d webhook(s).',
-                          num_messages,
-                          len(args.webhooks))
-                send_to_webhooks(args, session, frame_messages)
-
-                frame_messages = []
-                first_message = True
+                send = key_cache.update(ident, message)
+                log.debug('%s %s to webhook: %s.',
+                          'Queued' if send else 'Not queuing', whtype, ident)
+
+            if send:
+                dispatcher.put(whtype, message)
+            queue.task_done()
 
             # Webhook queue moving too slow.
             if (not wh_over_threshold) and (
@@ -168,8 +705,7 @@ def wh_updater(args, queue, key_caches):
                     if timediff_sec > wh_threshold_lifetime:
                         log.warning('Webhook queue has been > %d (@%d);'
                                     + ' for over %d seconds,'
-                                    + ' try increasing --wh-concurrency'
-                                    + ' or --wh-threads.',
+                                    + ' try increasing --wh-threads.',
                                     wh_warning_threshold,
                                     queue.qsize(),
                                     wh_threshold_lifetime)
@@ -180,68 +716,46 @@ def wh_updater(args, queue, key_caches):
 
 # Helpers
 
-# Background handler for completed webhook futures.
-def __wh_future_completed(future):
-    # Handle any exceptions that might've occurred.
+# Fields that make a webhook message of a cached type worth sending again.
+# Don't trust last_modified fields.
+key_fields = {
+    # lure_expiration is a UTC timestamp so it's good (Y).
+    'pokestop': (
+        'enabled', 'latitude', 'longitude', 'lure_expiration',
+        'active_fort_modifier'
+    ),
+    'pokemon': (
+        'spawnpoint_id', 'pokemon_id', 'latitude', 'longitude',
+        'disappear_time', 'move_1', 'move_2', 'individual_stamina',
+        'individual_defense', 'individual_attack', 'form', 'cp',
+        'pokemon_level'
+    ),
+    'gym': (
+        'team_id', 'guard_pokemon_id', 'enabled', 'latitude', 'longitude',
+        'raid_active_until', 'occupied_since', 'total_cp',
+        'slots_available'
+    ),
+    'gym_details': ('latitude', 'longitude', 'team', 'pokemon'),
+    'raid': (
+        'spawn', 'start', 'end', 'pokemon_id', 'latitude', 'longitude'
+    )
+}
+
+
+# Hash of the key fields of a webhook message. Messages with equal key fields
+# have equal hashes.
+def key_hash(whtype, message):
+    values = tuple(message.get(k) for k in key_fields[whtype])
     try:
-        exc = future.exception(timeout=0)
-
-        if exc:
-            log.exception("Something's wrong with your webhook: %s.", exc)
-    except Exception as ex:
-        log.exception('Unexpected exception in exception info: %s.', ex)
-
-
-# Background handler for completed webhook requests from requests lib.
-def __wh_request_completed(sess, resp):
-    # Instantly close the response to release the connection back to the pool.
-    resp.close()
-
-
-def __get_key_fields(whtype):
-    key_fields = {
-        # lure_expiration is a UTC timestamp so it's good (Y).
-        'pokestop': [
-            'enabled', 'latitude', 'longitude', 'lure_expiration',
-            'active_fort_modifier'
-        ],
-        'pokemon': [
-            'spawnpoint_id', 'pokemon_id', 'latitude', 'longitude',
-            'disappear_time', 'move_1', 'move_2', 'individual_stamina',
-            'individual_defense', 'individual_attack', 'form', 'cp',
-            'pokemon_level'
-        ],
-        'gym': [
-            'team_id', 'guard_pokemon_id', 'enabled', 'latitude', 'longitude',
-            'raid_active_until', 'occupied_since', 'total_cp',
-            'slots_available'
-        ],
-        'gym_details': ['latitude', 'longitude', 'team', 'pokemon'],
-        'raid': [
-            'spawn', 'start', 'end', 'pokemon_id', 'latitude', 'longitude'
-        ]
-    }
-
-    return key_fields.get(whtype, [])
-
-
-# Determine if a webhook object has changed in any important way (and
-# requires a resend).
-def __wh_object_changed(whtype, old, new):
-    # Only test for important fields: don't trust last_modified fields.
-    fields = __get_key_fields(whtype)
-
-    if not fields:
-        log.debug('Received an object of unknown type %s.', whtype)
-        return True
-
-    return not __dict_fields_equal(fields, old, new)
-
-
-# Determine if two dicts have equal values for all keys in a list.
-def __dict_fields_equal(keys, a, b):
-    for k in keys:
-        if a.get(k) != b.get(k):
-            return False
-
-    return True
+        return hash(values)
+    except TypeError:
+        # Gym details have a list of Pokemon dicts.
+        return hash(__hashable(values))
+
+
+def __hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, __hashable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(__hashable(v) for v in value)
+    return value
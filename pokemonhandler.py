@@ -1,7 +1,6 @@
 import calendar
 from threading import Thread
 
-import requests
 import json
 from queue import Queue
 from datetime import datetime as dt
@@ -9,7 +8,7 @@ from datetime import datetime as dt
 
 from accounts import *
 from geography import *
-from pogom.fnord_webhook import wh_updater
+from pogom.webhook import wh_updater, WebhookDispatcher
 
 args = None
 queue = []
@@ -22,6 +21,7 @@ with open(pokemon) as data_file:
 
 wh_key_cache = {}
 wh_updates_queue = Queue()
+wh_dispatcher = None
 
 headers = {
     'User-Agent': 'discord-simple-webhook (0.0.1)',
@@ -37,8 +37,11 @@ def pms2(pokemon_id, cell_id):
 
 def s2msg(msg_to_send):
     if args.s2_hook:
-        d = json.dumps({'content': msg_to_send})
-        requests.post(args.s2_hook, headers=headers, data=d)
+        # Sent by the webhook subsystem, so scanner threads don't wait for
+        # Discord.
+        discord = wh_dispatcher.add_endpoint(args.s2_hook, framed=False,
+                                             headers=headers)
+        discord.put('discord', {'content': msg_to_send})
 
 
 def send_to_webhook(pkmn):
@@ -69,14 +72,16 @@ def send_to_webhook(pkmn):
 
 
 def set_args(args_in):
-    global args
+    global args, wh_dispatcher
     args = args_in
 
-    # Thread to process webhook updates.
+    # Threads to process webhook updates, and send them to each webhook.
+    wh_dispatcher = WebhookDispatcher(args)
     for i in range(args.wh_threads):
         log.debug('Starting wh-updater worker thread %d', i)
         t = Thread(target=wh_updater, name='wh-updater-{}'.format(i),
-                   args=(args, wh_updates_queue, wh_key_cache))
+                   args=(args, wh_updates_queue, wh_key_cache,
+                         wh_dispatcher))
         t.daemon = True
         t.start()
 
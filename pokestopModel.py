@@ -1,6 +1,9 @@
+import heapq
 import logging
+import math
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from exceptions import ValueError
-from itertools import islice
 
 from geography import step_position, center_geolocation, box_around, move_towards
 from gymdbsql import spawnpoints_in_box
@@ -92,15 +95,69 @@ def create_pokestops(stops_to_check):
 
 def update_distances(point_list, radius=39):
     DISTANCE = 2 * radius
+    cutoffs = longitude_cutoffs(point_list, DISTANCE)
+    grid = NeighbourGrid(point_list, DISTANCE)
     for idx, point in enumerate(point_list):
         if idx % 500 == 0:
             print("Processing point at index " + str(idx))
-        cutoff_long = step_position(point.coords, 0, DISTANCE)
-        for point2 in islice(point_list, idx + 1, None):
-            point_longitude = point2.coords[1]
-            if point_longitude > cutoff_long[1]:
-                break
-            point.add_neighbours(point2, DISTANCE)
+        # The stops after this one, up to the first one past the longitude
+        # cutoff, that are close enough to be neighbours.
+        for idx2 in grid.candidates(point, idx + 1, cutoffs[idx]):
+            point.add_neighbours(point_list[idx2], DISTANCE)
+
+
+# Index of the first stop after each stop that is further east than the
+# distance. Stops come sorted by longitude from the database, otherwise
+# they're scanned like before.
+def longitude_cutoffs(point_list, distance):
+    longitudes = [point.coords[1] for point in point_list]
+    cutoffs = []
+    is_sorted = all(a <= b for a, b in zip(longitudes, longitudes[1:]))
+    for idx, point in enumerate(point_list):
+        cutoff_long = step_position(point.coords, 0, distance)[1]
+        if is_sorted:
+            cutoffs.append(bisect_right(longitudes, cutoff_long, idx + 1))
+            continue
+        end = idx + 1
+        while end < len(longitudes) and longitudes[end] <= cutoff_long:
+            end += 1
+        cutoffs.append(end)
+    return cutoffs
+
+
+class NeighbourGrid:
+    """
+    Stops in cells at least as large as the distance, so the stops within
+    the distance of a stop are in its cell or the 8 around it. The cells
+    are made a bit larger than needed so rounding doesn't lose any.
+    """
+
+    def __init__(self, point_list, distance):
+        # Degrees of latitude for the distance, as by equi_rect_distance_m.
+        self.cell_lat = 1.01 * math.degrees(distance / 6371000.0)
+        max_lat = max([abs(point.coords[0]) for point in point_list] or [0])
+        self.cell_lng = self.cell_lat / max(math.cos(math.radians(max_lat)),
+                                            1e-6)
+        self.cells = defaultdict(list)
+        for idx, point in enumerate(point_list):
+            self.cells[self.cell(point)].append(idx)
+
+    def cell(self, point):
+        return (int(math.floor(point.coords[0] / self.cell_lat)),
+                int(math.floor(point.coords[1] / self.cell_lng)))
+
+    # Indexes of the stops from start to end near the stop, in order. The
+    # indexes in each cell are in order too.
+    def candidates(self, point, start, end):
+        row, column = self.cell(point)
+        result = []
+        for r in (row - 1, row, row + 1):
+            for c in (column - 1, column, column + 1):
+                cell = self.cells.get((r, c), ())
+                result.extend(cell[bisect_left(cell, start):
+                                   bisect_left(cell, end)])
+        result.sort()
+        return result
 
 
 def find_largest_stop_group(stops):
@@ -115,22 +172,56 @@ def find_largest_groups(point_list,min_size=3):
     for stop in point_list:
         all_coords[stop.coords] = stop
 
+    # Each pass over the stops picks the groups of the current size, in
+    # order. Instead of checking every stop in every pass, the stops are
+    # kept in heaps by the size of their group, and only the groups of the
+    # stops that have a picked stop as a neighbour are checked again.
+    positions = dict((id(stop), idx) for idx, stop in enumerate(point_list))
+    listed_by = defaultdict(set)
+    for idx, stop in enumerate(point_list):
+        for neighbour in stop.neighbours:
+            listed_by[id(neighbour)].add(idx)
+    sizes = [len(stop.collected_neighbours()) for stop in point_list]
+    by_size = defaultdict(list)
+    for idx, size in enumerate(sizes):
+        by_size[size].append(idx)
+
     result_coords = []
     num_stops_found = 0
-    max_stop_group = find_largest_stop_group(point_list)
+    max_stop_group = max(sizes or [0])
     for counter in range(max_stop_group, min_size-1, -1):
-        for poke_stop_ in point_list:
+        candidates = by_size.pop(counter, [])
+        heapq.heapify(candidates)
+        position = -1
+        while candidates:
+            idx = heapq.heappop(candidates)
+            poke_stop_ = point_list[idx]
+            if (idx <= position or sizes[idx] != counter or
+                    poke_stop_.coords not in all_coords):
+                continue
+            position = idx
             intersected_ = poke_stop_.collected_neighbours()
-            if len(intersected_) == counter and poke_stop_.coords in all_coords:
-                locations = [n.coords for n in intersected_]
-                result_coords.append((center_geolocation(locations), poke_stop_.collected_neighbours()))
-                num_stops_found += len(locations)
-                for location in locations:
-                    if location in all_coords:
-                        del all_coords[location]
-                # clear out neighbours so they dont contribute to further collected_neighhbours
-                for stop in intersected_:
-                    stop.neighbours = []
+            locations = [n.coords for n in intersected_]
+            result_coords.append((center_geolocation(locations), poke_stop_.collected_neighbours()))
+            num_stops_found += len(locations)
+            for location in locations:
+                if location in all_coords:
+                    del all_coords[location]
+            # clear out neighbours so they dont contribute to further collected_neighhbours
+            changed = set()
+            for stop in intersected_:
+                changed.update(listed_by[id(stop)])
+                if id(stop) in positions:
+                    changed.add(positions[id(stop)])
+                stop.neighbours = []
+            for idx2 in changed:
+                size = len(point_list[idx2].collected_neighbours())
+                if size != sizes[idx2]:
+                    sizes[idx2] = size
+                    if size == counter:
+                        heapq.heappush(candidates, idx2)
+                    elif size < counter:
+                        by_size[size].append(idx2)
     log.info("Found {} stops".format(str(num_stops_found)))
     return result_coords
 
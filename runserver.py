@@ -21,13 +21,16 @@ from accountdbsql import set_account_db_args
 from gymdbsql import set_args
 from pogom.app import Pogom
 from pogom.utils import (get_args, now, gmaps_reverse_geolocate,
-                         log_resource_usage_loop, get_debug_dump_link)
+                         log_resource_usage_loop, get_debug_dump_link,
+                         get_pokemon_details)
 from pogom.altitude import get_gmaps_altitude
 
 from pogom.models import (init_database, create_tables, drop_tables,
-                          PlayerLocale, SpawnPoint, db_updater, clean_db_loop,
-                          verify_table_encoding, verify_database_schema)
-from pogom.webhook import wh_updater
+                          PlayerLocale, SpawnPoint, DbWriteBehind, db_updater,
+                          clean_db_loop, verify_table_encoding,
+                          verify_database_schema)
+from pogom.webhook import wh_updater, WebhookDispatcher
+from pogom.livecache import LiveCache
 
 from pogom.proxy import load_proxies, check_proxies, proxies_refresher
 from pogom.search import search_overseer_thread
@@ -307,6 +310,10 @@ def main():
 
     args.root_path = os.path.dirname(os.path.abspath(__file__))
 
+    # Translated Pokemon details for the map, built once for the locale.
+    if not args.no_server:
+        get_pokemon_details()
+
     # Control the search status (running or not) across threads.
     control_flags = {
       'on_demand': Event(),
@@ -329,11 +336,22 @@ def main():
     # DB Updates
     db_updates_queue = Queue()
 
+    # Pending updates are coalesced per table before hitting the database.
+    # Shared by all db-updater threads so rows are deduplicated across them.
+    db_write_behind = DbWriteBehind(args.db_flush_interval,
+                                    args.db_flush_rows)
+
+    # Only a process that scans sees the updates needed to keep it current.
+    live_cache = None
+    if args.live_cache and app and not args.only_server:
+        live_cache = LiveCache(args.live_cache_changes)
+        live_cache.load()
+
     # Thread(s) to process database updates.
     for i in range(args.db_threads):
         log.debug('Starting db-updater worker thread %d', i)
         t = Thread(target=db_updater, name='db-updater-{}'.format(i),
-                   args=(db_updates_queue, db))
+                   args=(db_updates_queue, db, db_write_behind, live_cache))
         t.daemon = True
         t.start()
 
@@ -357,11 +375,13 @@ def main():
                  args.wh_types,
                  args.webhooks)
 
-        # Thread to process webhook updates.
+        # Threads to process webhook updates, and send them to each webhook.
+        wh_dispatcher = WebhookDispatcher(args)
         for i in range(args.wh_threads):
             log.debug('Starting wh-updater worker thread %d', i)
             t = Thread(target=wh_updater, name='wh-updater-{}'.format(i),
-                       args=(args, wh_updates_queue, wh_key_cache))
+                       args=(args, wh_updates_queue, wh_key_cache,
+                             wh_dispatcher))
             t.daemon = True
             t.start()
 
@@ -420,7 +440,8 @@ def main():
                 log.info('Finished exporting spawn points')
 
         argset = (args, new_location_queue, control_flags,
-                  heartbeat, db_updates_queue, wh_updates_queue)
+                  heartbeat, db_updates_queue, wh_updates_queue,
+                  db_write_behind)
 
         log.debug('Starting a %s search thread', args.scheduler)
         search_thread = Thread(target=search_overseer_thread,
@@ -442,6 +463,7 @@ def main():
         init_cache_busting(app)
 
         app.set_control_flags(control_flags)
+        app.set_live_cache(live_cache)
         app.set_heartbeat_control(heartbeat)
         app.set_location_queue(new_location_queue)
         ssl_context = None
@@ -9,6 +9,7 @@ from behaviours import beh_safe_do_gym_scan
 from geofence import filter_for_geofence
 from geography import gym_moves_generator, step_position
 from gymdbsql import gymscannercoordinates, set_args
+from pogom.geo import equi_rect_distance_m, equi_rect_distances_m
 from scannerutil import *
 from workers import wrap_account
 
@@ -68,10 +69,11 @@ def find_closest(current_list, first):
     shortest_idx = -1
     coordinates_ = first["coordinates"]
     max_longitude = 1000
+    distances = equi_rect_distances_m(coordinates_, [gym["coordinates"] for gym in current_list])
     for idx, gym in enumerate(current_list):
         if gym["longitude"] > max_longitude:
             break
-        current_distance = vincenty(coordinates_, gym["coordinates"]).m
+        current_distance = distances[idx]
         if current_distance < shortest_distance:
             shortest_distance = current_distance
             shortest_idx = idx
@@ -87,7 +89,7 @@ def length_of_route(current_route):
     prev_gym = None
     for gym in current_route:
         if prev_gym is not None:
-            length += vincenty(prev_gym, gym["coordinates"]).m
+            length += equi_rect_distance_m(prev_gym, gym["coordinates"])
         prev_gym = gym["coordinates"]
     return length
 
@@ -99,7 +101,8 @@ streams = []
 
 initialPosition = location(args)
 if args.radius is not None:
-    filtered = [x for x in gym_map if vincenty(initialPosition, x["coordinates"]).m < args.radius]
+    distances = equi_rect_distances_m(initialPosition, [x["coordinates"] for x in gym_map])
+    filtered = [x for x, d in zip(gym_map, distances) if d < args.radius]
     gym_map = filtered
 
 while len(gym_map) > 0:
@@ -109,7 +112,7 @@ while len(gym_map) > 0:
     distance = 0
     while len(gym_map) > 0:
         next_gym = find_closest(gym_map, prev)
-        distance += vincenty(prev["coordinates"], next_gym["coordinates"]).m
+        distance += equi_rect_distance_m(prev["coordinates"], next_gym["coordinates"])
         if distance > MAX_LEN:
             streams.append(stream)
             log.info("Created stream " + str(len(streams)) + ", with " + str(
@@ -1,6 +1,5 @@
 import datetime
 import logging
-import math
 import random
 import sys
 import time
@@ -13,6 +12,8 @@ import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from pogom.geo import equi_rect_distance, equi_rect_distance_m
+
 
 def setup_logging(file_name=None):
     if not file_name:
@@ -39,21 +40,6 @@ def in_radius(loc1, loc2, distance):
     return equi_rect_distance(loc1, loc2) < distance
 
 
-# Return equirectangular approximation distance in km.
-def equi_rect_distance(loc1, loc2):
-    r = 6371  # Radius of the earth in km.
-    lat1 = math.radians(loc1[0])
-    lat2 = math.radians(loc2[0])
-    x = (math.radians(loc2[1]) - math.radians(loc1[1])
-         ) * math.cos(0.5 * (lat2 + lat1))
-    y = lat2 - lat1
-    return r * math.sqrt(x * x + y * y)
-
-
-def equi_rect_distance_m(loc1, loc2):
-    return equi_rect_distance(loc1, loc2) * 1000
-
-
 def distance_to_fort(player_location, fort):
     return equi_rect_distance_m(player_location, fort_as_coordinate(fort))
 
@@ -1,32 +1,41 @@
+import random
 import unittest
 
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 
-from geopy.distance import vincenty
+from pogom.geo import equi_rect_distance_m
 
 
 class SpawnPoints:
+    """The spawnpoints of a cell, or of all the cells. The queries by time use a SpawnWindows index of them"""
+
     def __init__(self, spawnpoints):
         self.spawnpoints = sorted(spawnpoints, key=lambda spawnpoint: spawnpoint.start())
+        self.windows = SpawnWindows(self.spawnpoints)
+        self.by_id = {}
+        for spawnpoint in reversed(self.spawnpoints):
+            self.by_id[spawnpoint.id] = spawnpoint
 
     def points_that_can_spawn(self, last_not_seen_time, seen_time):
-        return [x for x in self.spawnpoints if x.could_have_spawned(last_not_seen_time, seen_time)]
+        return self.points_that_can_spawn_soh(second_of_hour(last_not_seen_time), second_of_hour(seen_time))
+
+    def points_that_can_spawn_soh(self, last_not_seen_time_soh, seen_time_soh):
+        return [self.spawnpoints[idx] for idx in self.windows.overlapping(last_not_seen_time_soh, seen_time_soh)]
 
     def all_matching_spanwpoints(self, seen_at):
-        return [x for x in self.spawnpoints if x.spawns_at(seen_at)]
+        return self.points_that_can_spawn(seen_at, seen_at)
 
     def search_points_for_runner(self, last_not_seen_time, seen_time):
         expanded_start_window = last_not_seen_time - timedelta(minutes=5)
-        first_window = [x for x in self.spawnpoints if x.could_have_spawned(expanded_start_window, seen_time)]
+        first_window = self.points_that_can_spawn(expanded_start_window, seen_time)
         if len(first_window) > 0:
             return first_window
         expanded_start_window = last_not_seen_time - timedelta(minutes=10)
-        return [x for x in self.spawnpoints if x.could_have_spawned(expanded_start_window, seen_time)]
+        return self.points_that_can_spawn(expanded_start_window, seen_time)
 
     def spawn_point(self, spawn_point_id):
-        for spawnpoint in self.spawnpoints:
-            if spawnpoint.id == spawn_point_id:
-                return spawnpoint
+        return self.by_id.get(spawn_point_id)
 
     def explain(self, pokemon_id, last_not_seen_time, seen_time):
         result = "Pokeomn {} in window {}-{} with".format(str(pokemon_id), str(second_of_hour(last_not_seen_time)),
@@ -48,6 +57,30 @@ def second_of_hour(time):
     return time.minute * 60 + time.second
 
 
+class SpawnWindows:
+    """Index of the start windows of spawnpoints, in seconds of the hour.
+
+    The start and the end of each window are kept in two sorted lists, so the windows that start or end within an
+    observation, which is what SpawnPoint.overlaps() tests, are found by bisecting them. Windows and observations
+    that wrap around the hour end an hour later, like overlaps() normalizes them."""
+
+    def __init__(self, spawnpoints):
+        windows = [spawnpoint.startwindow() for spawnpoint in spawnpoints]
+        self.starts = sorted((start, idx) for idx, (start, end) in enumerate(windows))
+        self.ends = sorted((end + 3600 if end < start else end, idx) for idx, (start, end) in enumerate(windows))
+        self.start_times = [time for time, idx in self.starts]
+        self.end_times = [time for time, idx in self.ends]
+
+    def overlapping(self, first, last):
+        """Indexes of the windows that start or end after first and before last, in the order of the spawnpoints"""
+        if last < first:
+            last += 3600
+        found = set()
+        for times, entries in ((self.start_times, self.starts), (self.end_times, self.ends)):
+            found.update(idx for time, idx in entries[bisect_right(times, first):bisect_left(times, last)])
+        return sorted(found)
+
+
 class SpawnPoint:
     def __init__(self, row):
         self.id = row["id"]
@@ -68,7 +101,7 @@ class SpawnPoint:
             otherspawnpoint.neighbours.append(self)
 
     def is_within_range(self, position, m):
-        return vincenty(self.location(), position).m <= m
+        return equi_rect_distance_m(self.location(), position) <= m
 
     def neightbours_with_self(self):
         neighbours = self.neighbours[:]
@@ -238,6 +271,38 @@ class SpawnpointsExpandedStartWindow(unittest.TestCase):
         self.assertEqual(2, len(points.search_points_for_runner(unseen, seen)))
 
 
+class SpawnpointsWrappingHour(unittest.TestCase):
+    def test(self):
+        point = {"id": 1, "latitude": 43.2, "longitude": 48.6, "kind": "hhss", "links": "hh??", "latest_seen": 1850,
+                 "earliest_unseen": 1900, "s2cell": 1234, "altitude": 40}  # 50-100
+        point2 = {"id": 2, "latitude": 43.2, "longitude": 48.6, "kind": "hhss", "links": "hh??", "latest_seen": 1750,
+                  "earliest_unseen": 1850, "s2cell": 1234, "altitude": 40}  # 3550-50
+        points = SpawnPoints([SpawnPoint(point), SpawnPoint(point2)])
+        unseen = datetime(2016, 12, 1, 2, 59, 55)
+        seen = datetime(2016, 12, 1, 3, 1, 0)
+        self.assertEqual([2], [x.id for x in points.points_that_can_spawn(unseen, seen)])
+        unseen = datetime(2016, 12, 1, 3, 0, 40)
+        seen = datetime(2016, 12, 1, 3, 1, 0)
+        self.assertEqual([1], [x.id for x in points.points_that_can_spawn(unseen, seen)])
+        self.assertEqual(2, points.spawn_point(2).id)
+        self.assertIsNone(points.spawn_point(3))
+
+
+class SpawnWindowsMatchOverlaps(unittest.TestCase):
+    def test(self):
+        rnd = random.Random(42)
+        spawn_points = [SpawnPoint({"id": idx, "latitude": 43.2, "longitude": 48.6,
+                                    "kind": rnd.choice(["hhhs", "hhss", "hsss", "ssss"]), "links": "hh??",
+                                    "latest_seen": rnd.randrange(3600), "earliest_unseen": rnd.randrange(3600)})
+                        for idx in range(500)]
+        points = SpawnPoints(spawn_points)
+        for _ in range(500):
+            first = rnd.randrange(3600)
+            last = rnd.choice([first, (first + rnd.randrange(600)) % 3600, rnd.randrange(3600)])
+            expected = [x for x in points.spawnpoints if x.could_have_spawned_soh(first, last)]
+            self.assertEqual(expected, points.points_that_can_spawn_soh(first, last))
+
+
 class OverlapTest(unittest.TestCase):
     def test(self):
         spawn_point_time = (20, 40)
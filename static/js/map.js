@@ -30,6 +30,7 @@ var languageLookupThreshold = 3
 var searchMarkerStyles
 
 var timestamp
+var seq
 var excludedPokemon = []
 var notifiedPokemon = []
 var notifiedRarity = []
@@ -1441,6 +1442,8 @@ function loadRawData() {
         type: 'GET',
         data: {
             'timestamp': timestamp,
+            'seq': seq,
+            'compact': true,
             'pokemon': loadPokemon,
             'lastpokemon': lastpokemon,
             'pokestops': loadPokestops,
@@ -1807,13 +1810,29 @@ function updateSpawnPoints() {
     })
 }
 
+// Map objects are sent as {fields: [...], rows: [[...], ...]} when requested
+// with compact: true.
+function unpackRows(table) {
+    if (!table || !table.fields) {
+        return table
+    }
+
+    return table.rows.map(function (values) {
+        var row = {}
+        table.fields.forEach(function (field, i) {
+            row[field] = values[i]
+        })
+        return row
+    })
+}
+
 function updateMap() {
     loadRawData().done(function (result) {
-        processPokemons(result.pokemons)
-        $.each(result.pokestops, processPokestop)
-        $.each(result.gyms, processGym)
-        $.each(result.scanned, processScanned)
-        $.each(result.spawnpoints, processSpawnpoint)
+        processPokemons(unpackRows(result.pokemons))
+        $.each(unpackRows(result.pokestops), processPokestop)
+        $.each(unpackRows(result.gyms), processGym)
+        $.each(unpackRows(result.scanned), processScanned)
+        $.each(unpackRows(result.spawnpoints), processSpawnpoint)
         // showInBoundsMarkers(mapData.pokemons, 'pokemon')
         showInBoundsMarkers(mapData.lurePokemons, 'pokemon')
         showInBoundsMarkers(mapData.gyms, 'gym')
@@ -1851,6 +1870,7 @@ function updateMap() {
             }, reincludedPokemon)
         }
         timestamp = result.timestamp
+        seq = result.seq
         lastUpdateTime = Date.now()
     })
 }
@@ -26,3 +26,11 @@ class UtilsTest(unittest.TestCase):
 
         # Unknown ID raises KeyError
         self.assertRaises(KeyError, utils.get_pokemon_name, 12367)
+
+    def test_get_pokemon_details(self):
+        details = utils.get_pokemon_details()
+        for pokemon_id in (1, 149):
+            self.assertEqual((utils.get_pokemon_name(pokemon_id),
+                              utils.get_pokemon_rarity(pokemon_id),
+                              utils.get_pokemon_types(pokemon_id)),
+                             details[pokemon_id])